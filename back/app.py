@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
+import hashlib
 import json
+import re
+import threading
 import sys
 from pathlib import Path
 import jwt 
@@ -16,6 +19,7 @@ from werkzeug.utils import secure_filename
 import os
 from dotenv import load_dotenv
 from tools.wb_header import get_wb_headers
+from tools.json_provider import init_json
 
 # 加载环境变量
 load_dotenv('.env.production')
@@ -24,18 +28,33 @@ from db.init_db import init_database
 from db import book_tools
 from db.book_tools import (
     get_all_books,
+    get_books_after,
     create_book,
     get_book_by_isbn,
     get_books_count,
     update_book,
     delete_book,
     add_book_to_user, 
+    add_books_to_user,
     get_user_books, 
+    get_user_bookshelf,
+    get_shelf_etag,
     remove_book_from_user,
     get_user_books_count
 )
-from db import DBSession
-from db.user_tools import authenticate_user, get_user_by_id, register_user, get_all_users, update_user
+from db import DBSession, init_app
+from db.counters import start_reconciler
+from db.enrich_queue import async_enabled, get_job, get_queue_stats, start_workers
+from db.bulk_import import detect_format, import_books
+from db.export import EXPORT_MIME_TYPES, export_books
+from db.facets import DEFAULT_FACET_LIMIT, get_facets
+from db.stats import get_stats
+from db.serialization import parse_fields
+from tools.bookdata.circuit import all_metrics
+from tools.bookdata.nlc_cache import get_cache
+from tools.bookdata.nlc_client import get_client
+from tools.bookdata.nlc_index import get_index
+from db.user_tools import authenticate_user, get_user_by_id, register_user, get_all_users, update_user, delete_user
 
 # 配置封面图片存储路径
 IMG_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -49,32 +68,68 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['COVER_FOLDER'] = COVER_FOLDER
 app.config['DEFAULT_COVER'] = DEFAULT_COVER
 
+# 每个请求共享一个数据库会话，请求结束时统一提交或回滚
+init_app(app)
+# 安装了orjson时使用更快的JSON编码
+init_json(app)
+
 
 
 # 配置文件路径
 config_path = Path(__file__).parent / "config.ini"
 
-# 读取或创建配置文件
-config = configparser.ConfigParser()
-if config_path.exists():
-    config.read(config_path)
-else:
-    config['INIT'] = {'initialized': 'False'}
-
-# 检查是否需要初始化
-if config.getboolean('INIT', 'initialized', fallback=False) == False:
-    print("首次启动，正在初始化数据库...")
-    db_path = os.path.expandvars(os.getenv('DATABASE_URL', 'sqlite:///${BASE_DIR}/back/db/book_manage.db'))
-    if not init_database(db_path):
-        print("数据库初始化失败!")
-        exit(1)
-    # 更新初始化状态
-    config['INIT']['initialized'] = 'True'
-    with open(config_path, 'w') as f:
-        config.write(f)
-    print("数据库初始化完成，已更新初始化状态")
-else:
-    print("非首次启动，跳过数据库初始化")
+
+def init_database_once():
+    """首次启动时初始化数据库(建表、创建管理员账户)，完成后记入config.ini"""
+    # 读取或创建配置文件
+    config = configparser.ConfigParser()
+    if config_path.exists():
+        config.read(config_path)
+    else:
+        config['INIT'] = {'initialized': 'False'}
+
+    # 检查是否需要初始化
+    if config.getboolean('INIT', 'initialized', fallback=False) == False:
+        print("首次启动，正在初始化数据库...")
+        db_path = os.path.expandvars(os.getenv('DATABASE_URL', 'sqlite:///${BASE_DIR}/back/db/book_manage.db'))
+        if not init_database(db_path):
+            raise RuntimeError("数据库初始化失败!")
+        # 更新初始化状态
+        config['INIT']['initialized'] = 'True'
+        with open(config_path, 'w') as f:
+            config.write(f)
+        print("数据库初始化完成，已更新初始化状态")
+    else:
+        print("非首次启动，跳过数据库初始化")
+
+
+def setup_app():
+    """应用启动设置: 初始化数据库，启动计数校正和后台补全线程
+    每个工作进程在处理第一个请求前执行一次；导入本模块(命令行工具、测试)时不执行，不会启动后台线程
+    """
+    init_database_once()
+    # 定期按实际数据校正计数缓存(秒，0为不启用)
+    start_reconciler(int(os.getenv('DB_COUNTER_RECONCILE_INTERVAL', '0') or 0))
+    # 启用异步补全时才启动后台补全线程(ENRICH_WORKERS，0为不启动，改为单独运行 python -m db.enrich_queue work)；
+    # 未启用时工作线程只会空转轮询队列，每次轮询都要争用SQLite写锁
+    if async_enabled():
+        start_workers()
+
+
+_setup_lock = threading.Lock()
+_setup_done = False
+
+
+@app.before_request
+def ensure_setup():
+    global _setup_done
+    # 测试中由测试自行准备数据库
+    if _setup_done or app.testing:
+        return
+    with _setup_lock:
+        if not _setup_done:
+            setup_app()
+            _setup_done = True
 
 # 全局CORS配置
 @app.after_request
@@ -250,6 +305,13 @@ def validate_token(current_user):
         'role': current_user.role
     })
 
+def get_fields_arg():
+    """请求参数fields: 逗号分隔的书籍字段或预设(list/all)，为空时返回全部字段
+    Raises:
+        ValueError: 含有不支持的字段
+    """
+    return parse_fields(request.args.get('fields'))
+
 @app.route('/api/hello')
 def hello():
     return jsonify({'message': 'Hello, World!'})
@@ -260,27 +322,105 @@ def handle_books():
         # 获取分页参数，默认为第1页，每页20条
         page = int(request.args.get('page', 1))
         per_page = int(request.args.get('per_page', 20))
-        
-        # 获取分页数据和总数
-        books = get_all_books(page=page, per_page=per_page)
-        total = get_books_count()
-        
-        return jsonify({
-            'items': books,
-            'total': total,
-            'page': page,
-            'per_page': per_page
-        })
+        try:
+            fields = get_fields_arg()
+            # 筛选参数: genre/country/era/publisher/year_min/year_max/opac_nlc_class
+            filters = book_tools.parse_filters(request.args)
+            # facets=1时附带分面计数(读取预先维护的BookFacet表)
+            facets = get_facets() if request.args.get('facets', '0').lower() in ('1', 'true') else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # 传入cursor参数(首页为空字符串)时使用键集分页
+        if 'cursor' in request.args:
+            try:
+                books, next_cursor = get_books_after(
+                    cursor=request.args.get('cursor'),
+                    per_page=per_page,
+                    sort=request.args.get('sort', 'isbn'),
+                    fields=fields,
+                    filters=filters
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            result = {
+                'items': books,
+                'total': get_books_count(filters),
+                'per_page': per_page,
+                'next_cursor': next_cursor
+            }
+        else:
+            # 获取分页数据和总数
+            books = get_all_books(page=page, per_page=per_page, fields=fields, filters=filters)
+            result = {
+                'items': books,
+                'total': get_books_count(filters),
+                'page': page,
+                'per_page': per_page
+            }
+        if facets is not None:
+            result['facets'] = facets
+        return jsonify(result)
         
     elif request.method == 'POST':
         data = request.get_json()
         result = create_book(data)
         return jsonify(result), 201
 
+@app.route('/api/books/facets', methods=['GET'])
+def get_books_facets():
+    """获取分面计数
+    参数: dimensions=逗号分隔的维度(genre/country/era/publisher/publish_year/opac_nlc_class)，limit=每个维度返回的取值数
+    返回: {维度: [{"value": 取值, "count": 书籍数}]}
+    """
+    dimensions = [d.strip() for d in request.args.get('dimensions', '').split(',') if d.strip()]
+    try:
+        limit = int(request.args.get('limit', DEFAULT_FACET_LIMIT))
+        return jsonify(get_facets(dimensions, limit))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/books/batch', methods=['GET', 'POST'])
+def get_books_batch():
+    """批量获取书籍
+    GET参数: isbns=逗号分隔的ISBN, enrich=1时后台获取本地不存在的书籍, fields=返回字段
+    POST数据: {"isbns": [...], "enrich": true/false, "fields": [...]}
+    返回:
+        {
+            "books": {ISBN: 书籍信息},
+            "missing": [本地不存在的ISBN],
+            "invalid": [无效的ISBN],
+            "queued": [已加入后台获取的ISBN]
+        }
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        isbns = data.get('isbns')
+        enrich = bool(data.get('enrich', False))
+        fields = data.get('fields') or request.args.get('fields')
+    else:
+        isbns = [isbn for isbn in request.args.get('isbns', '').split(',') if isbn.strip()]
+        enrich = request.args.get('enrich', '0').lower() in ('1', 'true')
+        fields = request.args.get('fields')
+
+    if not isbns or not isinstance(isbns, list):
+        return jsonify({'error': '缺少isbns参数'}), 400
+
+    try:
+        result = book_tools.get_books_by_isbns(isbns, fields=fields)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    result['queued'] = book_tools.enqueue_enrichment(result['missing']) if enrich else []
+    return jsonify(result)
+
 @app.route('/api/books/<isbn>', methods=['GET'])
 def handle_book(isbn):
     try:
-        book = get_book_by_isbn(isbn)
+        fields = get_fields_arg()
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        book = get_book_by_isbn(isbn, fields=fields)
         if not book:
             return jsonify({
                 'success': False,
@@ -315,7 +455,7 @@ def update_book_route(current_user, isbn):
                 'message': '缺少请求数据'
             }), 400
             
-        result = update_book(isbn, data)
+        result = update_book(isbn, data, fields=request.args.get('fields'))
         if not result['success']:
             return jsonify(result), 400
         return jsonify(result)
@@ -347,6 +487,114 @@ def delete_book_route(current_user, isbn):
             'message': f'删除书籍失败: {str(e)}'
         }), 500
 
+@app.route('/api/stats', methods=['GET'])
+@token_required
+def stats_route(current_user):
+    """数据统计(仅管理员)，读取汇总表，见db/stats.py"""
+    if current_user.role != 'admin':
+        return jsonify({
+            'success': False,
+            'message': '权限不足: 只有管理员可以查看统计'
+        }), 403
+    return jsonify(get_stats())
+
+@app.route('/api/books/<isbn>/enrichment', methods=['GET'])
+def get_enrichment_job(isbn):
+    """查询书籍信息补全任务的状态(pending/running/done/not_found/failed)，见db/enrich_queue.py"""
+    job = get_job(isbn)
+    if not job:
+        return jsonify({
+            'success': False,
+            'message': '没有该书籍的补全任务'
+        }), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/admin/enrichment', methods=['GET'])
+@token_required
+def enrichment_stats_route(current_user):
+    """补全任务队列各状态的任务数(仅管理员)"""
+    if current_user.role != 'admin':
+        return jsonify({
+            'success': False,
+            'message': '权限不足: 只有管理员可以查看补全队列'
+        }), 403
+    return jsonify(get_queue_stats())
+
+@app.route('/api/admin/upstream', methods=['GET'])
+@token_required
+def upstream_stats_route(current_user):
+    """国家图书馆上游的熔断器状态、查询客户端统计、查询缓存和本地元数据索引统计(仅管理员)"""
+    if current_user.role != 'admin':
+        return jsonify({
+            'success': False,
+            'message': '权限不足: 只有管理员可以查看上游状态'
+        }), 403
+    cache = get_cache()
+    index = get_index()
+    return jsonify({
+        'breakers': all_metrics(),
+        'client': get_client().stats(),
+        'cache': cache.stats() if cache else None,
+        'index': index.stats() if index else None
+    })
+
+@app.route('/api/books/export', methods=['GET'])
+@token_required
+def export_books_route(current_user):
+    """流式导出书籍目录(仅管理员)
+    参数:
+        format: ndjson(默认)/csv
+        fields: 逗号分隔的书籍字段或预设(list/all)
+        gzip: 1时gzip压缩，下载文件名追加.gz
+    """
+    if current_user.role != 'admin':
+        return jsonify({
+            'success': False,
+            'message': '权限不足: 只有管理员可以导出书籍'
+        }), 403
+
+    fmt = request.args.get('format', 'ndjson')
+    gzip = request.args.get('gzip', '0').lower() in ('1', 'true')
+    try:
+        chunks = export_books(fmt, request.args.get('fields'), gzip)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    filename = f'books.{fmt}' + ('.gz' if gzip else '')
+    response = Response(
+        chunks,
+        mimetype='application/gzip' if gzip else EXPORT_MIME_TYPES[fmt]
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/admin/books/import', methods=['POST'])
+@token_required
+def import_books_route(current_user):
+    """批量导入书籍(仅管理员)
+    上传字段file: JSON数组、NDJSON或CSV文件(可为国家图书馆格式)
+    参数format: 可选，默认按文件扩展名判断
+    返回导入报告: {total, inserted, updated, rejected, rejected_details}
+    """
+    if current_user.role != 'admin':
+        return jsonify({
+            'success': False,
+            'message': '权限不足: 只有管理员可以导入书籍'
+        }), 403
+
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    try:
+        fmt = request.form.get('format') or request.args.get('format') or detect_format(file.filename)
+        stream = TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+        report = import_books(stream, fmt)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(report)
+
 @app.route('/api/users', methods=['POST'])
 @token_required
 def create_user(current_user):
@@ -539,8 +787,7 @@ def manage_user(current_user, user_id):
                         'message': '不能删除管理员用户'
                     }
                 }), 400
-            session.delete(user)
-            session.commit()
+            delete_user(user.username)
             return jsonify({'message': '用户删除成功'})
 
 @app.route('/api/books/search', methods=['GET'])
@@ -552,7 +799,14 @@ def search_books():
         return jsonify({'error': 'Missing search parameters'}), 400
     
     try:
-        books = book_tools.search_books(search_field, search_value)
+        books = book_tools.search_books(
+            search_field,
+            search_value,
+            page=int(request.args.get('page', 1)),
+            per_page=int(request.args.get('per_page', book_tools.SEARCH_PER_PAGE)),
+            fields=get_fields_arg(),
+            filters=book_tools.parse_filters(request.args)
+        )
         return jsonify(books)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
@@ -571,6 +825,52 @@ def get_bookshelf(current_user):
     bookshelf = get_user_books(user_id=current_user.user_id)
     return jsonify(bookshelf), 201
 
+@app.route('/api/bookshelf/books', methods=['GET'])
+@token_required
+def get_bookshelf_books(current_user):
+    """获取用户书架及书籍详情(一次查询)
+    参数:
+        page: 页码(默认1)
+        per_page: 每页数量(默认20，最多100)
+        sort: 排序字段 title/publish_year/nums(默认title)
+        order: asc/desc(默认asc)
+        fields: 逗号分隔的书籍字段，默认返回全部字段
+    书架和书籍信息未变化时，携带If-None-Match的请求返回304
+    """
+    # ETag由书架版本号、书籍版本号和查询参数决定，命中时无需执行JOIN查询
+    etag = '{}-{}'.format(
+        get_shelf_etag(current_user.user_id),
+        hashlib.sha1(request.query_string).hexdigest()[:12]
+    )
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = min(int(request.args.get('per_page', 20)), 100)
+        items, total = get_user_bookshelf(
+            user_id=current_user.user_id,
+            page=page,
+            per_page=per_page,
+            sort=request.args.get('sort', 'title'),
+            order=request.args.get('order', 'asc'),
+            fields=get_fields_arg()
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response = jsonify({
+        'items': items,
+        'total': total,
+        'page': page,
+        'per_page': per_page
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 
 @app.route('/api/bookshelf/<isbn>', methods=['POST', 'DELETE'])
 @token_required
@@ -588,11 +888,38 @@ def manage_bookshelf(current_user, isbn):
             return jsonify({'error': f'添加书籍失败: {str(e)}'}), 500
             
     elif request.method == 'DELETE':
-        with DBSession() as session:
-            result = remove_book_from_user(isbn, current_user.user_id)
-            if not result:
-                return jsonify({'error': 'Book not found in your shelf'}), 404
+        # quantity为空时移除整条记录，否则减少相应数量；无效的数量返回400，不能当作移除整条记录
+        quantity = request.args.get('quantity')
+        if quantity is not None:
+            if not re.fullmatch(r'\d+', quantity.strip()) or int(quantity) <= 0:
+                return jsonify({'error': '数量必须是大于0的整数'}), 400
+            quantity = int(quantity)
+        try:
+            result = remove_book_from_user(isbn, current_user.user_id, quantity)
             return jsonify(result)
+        except ValueError as e:
+            # 数量已校验，剩下的错误只有书籍不在书架中
+            return jsonify({'error': str(e)}), 404
+
+
+@app.route('/api/bookshelf/batch', methods=['POST'])
+@token_required
+def add_bookshelf_batch(current_user):
+    """批量添加书籍到书架
+    请求体: {"items": [{"isbn": "...", "quantity": 1}, ...]}，在一个事务中完成
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items必须是非空数组'}), 400
+    try:
+        pairs = [(item['isbn'], item.get('quantity', 1)) for item in items]
+        result = add_books_to_user(current_user.user_id, pairs)
+        return jsonify(result), 201
+    except (KeyError, TypeError, AttributeError):
+        return jsonify({'error': '每项必须包含isbn'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
 
 # 封面图片上传API
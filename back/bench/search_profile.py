@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""书名/作者检索基准测试：大书库上的检索延迟
+
+在临时数据库中生成--books本书籍(书名由常用字随机组成，作者从--authors个姓名中选取)并建立检索索引，
+再对各类查询(单字、双字、多字、拼音、首字母、带筛选条件、深分页)各执行--rounds次，
+统计每次search_books调用的延迟分位数和结果数，目标是50万本书时p50低于10ms。
+
+用法: python bench/search_profile.py [--books 500000] [--authors 5000] [--rounds 50]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from db import DBSession, search_index
+from db.book_tools import parse_filters, search_books
+from db.db import dispose_engine, get_engine
+from db.migrations import migrate
+from models import Book
+
+CHARS = '的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理'
+GENRES = ['小说', '散文', '诗歌', '历史', '哲学', '经济', '计算机', '艺术']
+
+QUERIES = [
+    ('单字', 'title', '国', {}),
+    ('双字', 'title', '中国', {}),
+    ('多字', 'title', '中国发展史', {}),
+    ('拼音', 'title', 'zhongguo', {}),
+    ('首字母', 'title', 'zg', {}),
+    ('作者', 'author', '作者12', {}),
+    ('筛选', 'title', '中国', {'genre': '哲学', 'year_min': '1990'}),
+    ('深分页', 'title', '国', {'page': 200}),
+]
+
+
+def _isbn(n):
+    return f'978{n:010d}'
+
+
+def build_library(books, authors, batch_size=5000):
+    rnd = random.Random(0)
+    author_names = [f'作者{i}' for i in range(authors)]
+    engine = get_engine()
+    migrate(engine)
+    start = time.perf_counter()
+    for first in range(0, books, batch_size):
+        rows = []
+        for n in range(first, min(first + batch_size, books)):
+            title = ''.join(rnd.choice(CHARS) for _ in range(rnd.randint(2, 10)))
+            rows.append({
+                'isbn': _isbn(n), 'title': title, 'author': rnd.choice(author_names),
+                'genre': rnd.choice(GENRES), 'publish_year': rnd.randint(1950, 2024),
+            })
+        with DBSession() as session:
+            session.bulk_insert_mappings(Book, rows)
+            search_index.index_books(session, rows)
+    with engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+    return time.perf_counter() - start
+
+
+def run_query(field, value, options, rounds):
+    filters = parse_filters({k: v for k, v in options.items() if k != 'page'})
+    page = options.get('page', 1)
+    samples = []
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        try:
+            result = search_books(field, value, page=page, filters=filters)
+        except Exception:
+            # search_books在没有结果时抛出异常
+            result = []
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+        'results': len(result),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=500000)
+    parser.add_argument('--authors', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    db_file = Path(tempfile.mkdtemp()) / 'bench_search.db'
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_file}'
+    dispose_engine()
+    print(f'生成 {args.books} 本书籍并建立索引用时 {build_library(args.books, args.authors):.1f}s')
+
+    print(f"{'查询':<8}{'字段':<8}{'内容':<14}{'p50 ms':>10}{'p99 ms':>10}{'本页结果':>10}")
+    for name, field, value, options in QUERIES:
+        result = run_query(field, value, options, args.rounds)
+        print(f"{name:<8}{field:<8}{value:<14}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{result['results']:>10}")
+    dispose_engine()
+
+
+if __name__ == '__main__':
+    main()
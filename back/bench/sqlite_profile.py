@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""SQLite连接方案基准测试：长写事务期间的并发读延迟和吞吐量
+
+写线程每个事务插入一大批书籍(--batch)并在提交前继续持有事务(--hold秒)，模拟批量导入等长事务。
+回滚日志模式(compat)下写事务的修改超出页缓存后需要独占锁溢出到数据库文件，提交时同样持有独占锁，
+期间读请求只能等待；WAL模式(performance)下读请求读取快照，不受写事务影响。
+读线程按主键随机查询单本书，统计吞吐量、延迟分位数和出错次数(等待锁超时等)。
+
+用法: python bench/sqlite_profile.py [--books 20000] [--readers 4] [--seconds 5] [--batch 20000] [--hold 0.2]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from sqlalchemy import text
+
+from db.db import SQLITE_PROFILES, dispose_engine, get_engine
+from models import Base
+
+
+def _isbn(n):
+    return f'978{n:010d}'
+
+
+def run_profile(profile, args):
+    db_file = Path(tempfile.mkdtemp()) / f'bench_{profile}.db'
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_file}'
+    os.environ['DB_SQLITE_PROFILE'] = profile
+    os.environ['DB_POOL_SIZE'] = str(args.readers + 2)
+    dispose_engine()
+    engine = get_engine()
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            text('INSERT INTO Book (isbn, title, author) VALUES (:isbn, :title, :author)'),
+            [{'isbn': _isbn(i), 'title': f'书名{i}', 'author': f'作者{i % 500}'} for i in range(args.books)]
+        )
+
+    stop = threading.Event()
+    latencies = [[] for _ in range(args.readers)]
+    errors = [0] * args.readers
+    writes = [0]
+
+    def writer():
+        n = args.books
+        while not stop.is_set():
+            with engine.begin() as conn:
+                conn.execute(
+                    text('INSERT INTO Book (isbn, title, author) VALUES (:isbn, :title, :author)'),
+                    [{'isbn': _isbn(n + i), 'title': f'新书{n + i}', 'author': f'作者{i % 500}'}
+                     for i in range(args.batch)]
+                )
+                # 模拟事务中的其他工作，延长事务持有时间
+                time.sleep(args.hold)
+            n += args.batch
+            writes[0] += args.batch
+
+    def reader(slot):
+        rnd = random.Random(slot)
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    conn.execute(
+                        text('SELECT * FROM Book WHERE isbn = :isbn'),
+                        {'isbn': _isbn(rnd.randrange(args.books))}
+                    ).fetchall()
+            except Exception:
+                errors[slot] += 1
+                continue
+            latencies[slot].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=writer)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    dispose_engine()
+
+    samples = sorted(latency for slot in latencies for latency in slot)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000 if samples else 0.0
+
+    return {
+        'profile': profile,
+        'reads_per_sec': len(samples) / args.seconds,
+        'writes_per_sec': writes[0] / args.seconds,
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+        'max_ms': samples[-1] * 1000 if samples else 0.0,
+        'read_errors': sum(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=20000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--batch', type=int, default=20000, help='每个写事务插入的书籍数')
+    parser.add_argument('--hold', type=float, default=0.2, help='写事务提交前继续持有的秒数')
+    parser.add_argument('--profiles', nargs='+', default=list(SQLITE_PROFILES))
+    args = parser.parse_args()
+
+    print(f"{'profile':<12}{'reads/s':>10}{'writes/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+          f"{'read errors':>13}")
+    for profile in args.profiles:
+        result = run_profile(profile, args)
+        print(f"{result['profile']:<12}{result['reads_per_sec']:>10.0f}{result['writes_per_sec']:>10.0f}"
+              f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['max_ms']:>10.1f}"
+              f"{result['read_errors']:>13}")
+
+
+if __name__ == '__main__':
+    main()
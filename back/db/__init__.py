@@ -1,4 +1,4 @@
 # This empty __init__.py file makes the directory a Python package
-from .db import get_session, DBSession
+from .db import get_session, DBSession, get_engine, dispose_engine, get_pool_stats, init_app, savepoint
 
-__all__ = ['get_session', 'DBSession']
+__all__ = ['get_session', 'DBSession', 'get_engine', 'dispose_engine', 'get_pool_stats', 'init_app', 'savepoint']
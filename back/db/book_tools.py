@@ -1,9 +1,25 @@
 # -*- coding: utf-8 -*-
+import base64
+import json
+import logging
 import re
 
-from db import get_session
+from sqlalchemy import column, delete, func, literal_column, select, table, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
+
+from db import DBSession, savepoint, counters, enrich_queue, facets, search_index, stats
+from db.fts import FTS_MIN_QUERY_LENGTH, FTS_TABLE, build_match_query, fts_available
+from db.serialization import book_columns, book_to_dict, parse_fields, row_to_dict
+from db.singleflight import flights
 from models import Book, UserBook
-from tools.bookdata import get_book_info, get_book_data
+from tools.bookdata import (
+    get_book_info,
+    get_book_data,
+    validate_isbn,
+    isbn10_to_isbn13,
+    isbn13_to_isbn10
+)
 
 def format_isbn(isbn: str) -> str:
     """格式化ISBN：移除所有非数字字符并验证长度"""
@@ -13,13 +29,25 @@ def format_isbn(isbn: str) -> str:
     return cleaned_isbn
 
 
+def _load_rows(session, isbns, fields):
+    """按给定ISBN顺序查询书籍，返回fields对应的行"""
+    rows = {row[0]: row for row in session.execute(
+        select(*book_columns(fields)).where(Book.isbn.in_(isbns))
+    )}
+    return [rows[isbn] for isbn in isbns if isbn in rows]
+
+
 ## 查询
 
 # 从国家图书馆API获取书籍信息
 def fetch_book_auto(isbn):
-    """从国家图书馆API获取书籍信息"""
+    """从国家图书馆API获取书籍信息，同一ISBN的并发调用只查询一次"""
+    return flights.do(f'fetch:{_flight_key(isbn)}', _fetch_book_auto, isbn)
 
-    
+def _flight_key(isbn):
+    return normalize_isbn(isbn) or str(isbn)
+
+def _fetch_book_auto(isbn):
     try:
         # 获取原始书籍数据
         raw_data = get_book_info(isbn)
@@ -33,135 +61,411 @@ def fetch_book_auto(isbn):
             
         return book_data
     except Exception as e:
-        import logging
         logging.error(f"获取书籍信息失败: {e}")
         return None
 
-# 根据ISBN获取书籍
-def get_book_by_isbn(isbn):
-    """根据ISBN获取书籍详情"""
-    session = get_session()
+def import_book(isbn):
+    """本地不存在时从国家图书馆获取书籍信息并入库
+    同一ISBN的并发调用(含其他工作进程)合并为一次获取和入库，等待者共享结果；
+    入库在独立会话中提交后才返回，请求中调用时应在请求级会话写入之前调用
+    Args:
+        isbn: 书籍ISBN
+    Returns:
+        tuple: (状态, 书籍数据)，状态为'created'(本次入库)、'exists'(本地已存在)或'not_found'(无法获取)
+    """
+    return flights.do(f'import:{_flight_key(isbn)}', _import_book, isbn)
+
+def _import_book(isbn):
+    # 使用独立会话而不是请求级会话: 入库在交出结果和释放跨进程锁之前提交，
+    # 等待的线程和其他进程随即能查到这本书
+    # 其他进程可能在等锁期间已入库
+    with DBSession(independent=True) as session:
+        if session.query(Book.isbn).filter_by(isbn=isbn).first():
+            return 'exists', None
+    # 直接调用_fetch_book_auto，持有import锁时不再获取fetch锁
+    book_data = _fetch_book_auto(isbn)
+    if not book_data:
+        return 'not_found', None
     try:
+        with DBSession(independent=True):
+            create_book(book_data)
+    except IntegrityError:
+        # 其他途径(如后台补全)已先入库
+        return 'exists', book_data
+    return 'created', book_data
+
+# 根据ISBN获取书籍
+def get_book_by_isbn(isbn, fields=None):
+    """根据ISBN获取书籍详情
+    Args:
+        isbn: 书籍ISBN
+        fields: 返回字段，为空时返回全部字段
+    """
+    fields = parse_fields(fields)
+    with DBSession() as session:
         formatted_isbn = format_isbn(isbn)
-        book = session.query(Book).filter_by(isbn=formatted_isbn).first()
-        if not book:
+        row = session.execute(
+            select(*book_columns(fields)).where(Book.isbn == formatted_isbn)
+        ).first()
+        if not row:
             return None
             
-        return {
-            'isbn': book.isbn,
-            'title': book.title,
-            'author': book.author,
-            'translator': book.translator or '',
-            'genre': book.genre or '',
-            'country': book.country or '',
-            'era': book.era or '',
-            'opac_nlc_class': book.opac_nlc_class or '',
-            'publisher': book.publisher,
-            'publish_year': book.publish_year,
-            'page': book.page,
-            'cover_url': book.cover_url or '',
-            'description': book.description or ''
+        return row_to_dict(row, fields)
+
+# 批量查询的ISBN数量上限和每条IN查询的ISBN数
+BATCH_MAX_ISBNS = 5000
+BATCH_CHUNK_SIZE = 500
+
+def normalize_isbn(isbn):
+    """规范化ISBN输入，返回校验通过的ISBN，无效时返回None"""
+    if not isinstance(isbn, str):
+        return None
+    return validate_isbn(re.sub(r'[^0-9Xx]', '', isbn).upper())
+
+# 根据ISBN列表批量获取书籍
+def get_books_by_isbns(isbns, chunk_size=BATCH_CHUNK_SIZE, fields=None):
+    """在一个会话中分块IN查询批量获取书籍
+    Args:
+        isbns: ISBN列表(最多BATCH_MAX_ISBNS个)，ISBN-10与ISBN-13互相匹配
+        chunk_size: 每条查询的ISBN数
+        fields: 返回字段，为空时返回全部字段
+    Returns:
+        dict: {
+            'books': {请求的ISBN: 书籍信息},
+            'missing': 本地不存在的ISBN列表(规范化后),
+            'invalid': 格式或校验位无效的ISBN列表
         }
-    finally:
-        session.close()
+    Raises:
+        ValueError: ISBN数量超过上限
+    """
+    if len(isbns) > BATCH_MAX_ISBNS:
+        raise ValueError(f'一次最多查询{BATCH_MAX_ISBNS}个ISBN')
+    fields = parse_fields(fields)
+
+    requested = {}
+    invalid = []
+    for isbn in isbns:
+        normalized = normalize_isbn(isbn)
+        if normalized:
+            requested.setdefault(normalized, isbn)
+        else:
+            invalid.append(isbn)
+
+    # 每个等价写法映射回规范化后的请求ISBN
+    lookup = {}
+    for normalized in requested:
+        for variant in isbn_variants(normalized):
+            lookup.setdefault(variant, []).append(normalized)
+
+    found = {}
+    keys = list(lookup)
+    columns = book_columns(fields)
+    with DBSession() as session:
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            for row in session.execute(select(*columns).where(Book.isbn.in_(chunk))):
+                for normalized in lookup[row[0]]:
+                    found.setdefault(normalized, row_to_dict(row, fields))
+
+    return {
+        'books': {requested[normalized]: book for normalized, book in found.items()},
+        'missing': [normalized for normalized in requested if normalized not in found],
+        'invalid': invalid
+    }
+
+# 后台补全书籍信息(从国家图书馆获取后入库)
+def enqueue_enrichment(isbns):
+    """将本地不存在的书籍加入补全任务队列(见enrich_queue.py)，已在队列中的ISBN不重复加入
+    Returns:
+        list: 本次新加入队列的ISBN
+    """
+    return enrich_queue.enqueue_isbns(isbns)
+
+# 可按取值筛选的字段(多个取值以逗号分隔，按IN匹配)
+FILTER_FIELDS = ('genre', 'country', 'era', 'publisher')
+
+def parse_filters(params):
+    """解析书籍筛选参数
+    Args:
+        params: 参数映射(如request.args)，支持:
+            genre/country/era/publisher: 取值，多个以逗号分隔
+            year_min/year_max: 出版年范围(含边界)
+            opac_nlc_class: 中图分类号前缀
+    Returns:
+        dict: 筛选条件，没有筛选时为空字典
+    Raises:
+        ValueError: 参数无效
+    """
+    filters = {}
+    for field in FILTER_FIELDS:
+        value = params.get(field)
+        if value:
+            values = list(dict.fromkeys(v.strip() for v in value.split(',') if v.strip()))
+            if values:
+                filters[field] = values
+    for key in ('year_min', 'year_max'):
+        value = params.get(key)
+        if value not in (None, ''):
+            try:
+                filters[key] = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'无效的{key}: {value}')
+    prefix = (params.get('opac_nlc_class') or '').strip()
+    if prefix:
+        filters['opac_nlc_class'] = prefix
+    return filters
+
+def _filter_conditions(filters):
+    """将筛选条件转换为Book表上的查询条件
+    等值/IN条件配合(字段, isbn)复合索引，结果按isbn有序时无需额外排序；
+    分类号前缀按范围查询(>= prefix AND < prefix_next)以使用索引
+    """
+    if not filters:
+        return []
+    conditions = []
+    for field in FILTER_FIELDS:
+        values = filters.get(field)
+        if values:
+            column = getattr(Book, field)
+            conditions.append(column == values[0] if len(values) == 1 else column.in_(values))
+    if 'year_min' in filters:
+        conditions.append(Book.publish_year >= filters['year_min'])
+    if 'year_max' in filters:
+        conditions.append(Book.publish_year <= filters['year_max'])
+    prefix = filters.get('opac_nlc_class')
+    if prefix:
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        conditions += [Book.opac_nlc_class >= prefix, Book.opac_nlc_class < upper]
+    return conditions
 
 # 获取书籍总数
-def get_books_count():
-    """获取书籍总数"""
-    session = get_session()
-    try:
-        return session.query(Book).count()
-    finally:
-        session.close()
+def get_books_count(filters=None):
+    """获取书籍总数
+    无筛选时读取计数缓存，只按单个分面字段取值筛选时读取分面计数，其余情况执行COUNT查询
+    """
+    if not filters:
+        return counters.get_count(counters.BOOKS)
+    if len(filters) == 1 and facets.facets_available():
+        (field, values), = filters.items()
+        if field in FILTER_FIELDS:
+            # 同一字段的不同取值互不重叠，计数可直接相加
+            return sum(facets.get_facet_count(field, value) for value in values)
+    with DBSession() as session:
+        return session.execute(
+            select(func.count()).select_from(Book).where(*_filter_conditions(filters))
+        ).scalar()
 
 # 获取所有书籍(支持分页)
-def get_all_books(page=None, per_page=None):
+def get_all_books(page=None, per_page=None, fields=None, filters=None):
     """获取所有书籍(支持分页)
     Args:
         page: 页码(从1开始)
         per_page: 每页数量
+        fields: 返回字段，为空时返回全部字段
+        filters: parse_filters返回的筛选条件
     Returns:
         list: 书籍列表，每条数据保持原有结构
     """
-    session = get_session()
-    try:
-        query = session.query(Book)
+    fields = parse_fields(fields)
+    with DBSession() as session:
+        statement = select(*book_columns(fields))\
+            .where(*_filter_conditions(filters)).order_by(Book.isbn)
         
         # 应用分页
         if page is not None and per_page is not None:
             offset = (page - 1) * per_page
-            query = query.offset(offset).limit(per_page)
+            statement = statement.offset(offset).limit(per_page)
             
-        books = query.all()
-        return [{
-            'isbn': book.isbn,
-            'title': book.title,
-            'author': book.author,
-            'translator': book.translator or '',
-            'genre': book.genre or '',
-            'country': book.country or '',
-            'era': book.era or '',
-            'opac_nlc_class': book.opac_nlc_class or '',
-            'publisher': book.publisher,
-            'publish_year': book.publish_year,
-            'page': book.page,
-            'cover_url': book.cover_url or '',
-            'description': book.description or ''
-        } for book in books]
-    finally:
-        session.close()
+        return [row_to_dict(row, fields) for row in session.execute(statement)]
+
+# 键集分页支持的排序字段
+CURSOR_SORT_FIELDS = ('isbn', 'title')
+
+def encode_cursor(sort, book):
+    """根据一页的最后一本书生成分页游标"""
+    key = [book['isbn']] if sort == 'isbn' else [book[sort], book['isbn']]
+    raw = json.dumps([sort] + key, ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """解析分页游标
+    Returns:
+        tuple: (排序字段, 键值列表)
+    Raises:
+        ValueError: 游标格式无效
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        sort, key = data[0], data[1:]
+    except (ValueError, TypeError, IndexError, KeyError, UnicodeError):
+        raise ValueError('无效的分页游标')
+    if not isinstance(data, list) or sort not in CURSOR_SORT_FIELDS \
+            or len(key) != (1 if sort == 'isbn' else 2):
+        raise ValueError('无效的分页游标')
+    return sort, key
+
+# 按游标获取书籍(键集分页)
+def get_books_after(cursor=None, per_page=20, sort='isbn', fields=None, filters=None):
+    """按游标获取下一页书籍，深翻页不扫描之前的行，插入新书时页面内容保持稳定
+    Args:
+        cursor: 上一页返回的next_cursor，为空时返回第一页
+        per_page: 每页数量
+        sort: 排序字段(isbn/title)，传入cursor时以游标中的排序字段为准
+        fields: 返回字段，为空时返回全部字段
+        filters: parse_filters返回的筛选条件
+    Returns:
+        tuple: (书籍列表, 下一页游标或None)
+    Raises:
+        ValueError: 游标或排序字段无效
+    """
+    key = None
+    if cursor:
+        sort, key = decode_cursor(cursor)
+    elif sort not in CURSOR_SORT_FIELDS:
+        raise ValueError(f'不支持的排序字段: {sort}')
+    fields = parse_fields(fields)
+    # 排序字段不在返回字段中时也需要选取，用于生成游标
+    selected = fields if sort in fields else (*fields, sort)
+
+    with DBSession() as session:
+        statement = select(*book_columns(selected)).where(*_filter_conditions(filters))
+        if sort == 'isbn':
+            if key:
+                statement = statement.where(Book.isbn > key[0])
+            statement = statement.order_by(Book.isbn)
+        else:
+            column = getattr(Book, sort)
+            if key:
+                statement = statement.where(tuple_(column, Book.isbn) > tuple_(*key))
+            statement = statement.order_by(column, Book.isbn)
+
+        # 多取一条判断是否还有下一页
+        rows = session.execute(statement.limit(per_page + 1)).all()
+        next_cursor = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            next_cursor = encode_cursor(sort, dict(zip(selected, rows[-1])))
+        return [row_to_dict(row, fields) for row in rows], next_cursor
+
+# 搜索结果每页默认数量与上限
+SEARCH_PER_PAGE = 20
+SEARCH_MAX_PER_PAGE = 100
+
+# 按书名/作者搜索时检索的全文索引列
+SEARCH_FTS_COLUMNS = {
+    'title': ('title',),
+    'author': ('author', 'translator'),
+}
+
+def _search_text(session, field, value, limit, offset, fields, conditions):
+    """按书名/作者搜索
+    使用拼音/二元组检索索引，索引的结果即为最终结果(无结果或翻过最后一页时为空)；
+    索引不能处理该查询时依次尝试FTS5全文索引(按BM25排序)、LIKE查询
+    """
+    isbns = search_index.search(session, field, value, limit, offset, conditions)
+    if isbns is not None:
+        return _load_rows(session, isbns, fields)
+
+    if fts_available() and len(value) >= FTS_MIN_QUERY_LENGTH:
+        fts = table(FTS_TABLE, column('rowid'))
+        statement = select(*book_columns(fields))\
+            .select_from(Book.__table__.join(fts, literal_column('Book.rowid') == fts.c.rowid))\
+            .where(text(f'{FTS_TABLE} MATCH :query'), *conditions)\
+            .order_by(text(f'bm25({FTS_TABLE})')).limit(limit).offset(offset)
+        return session.execute(statement, {
+            'query': build_match_query(SEARCH_FTS_COLUMNS[field], value)
+        }).all()
+
+    like_column = Book.title if field == 'title' else Book.author
+    return session.execute(
+        select(*book_columns(fields)).where(like_column.like(f'%{value}%'), *conditions)
+        .order_by(Book.title, Book.isbn).limit(limit).offset(offset)
+    ).all()
+
+def isbn_variants(isbn):
+    """完整ISBN的所有等价写法(ISBN-10与978前缀的ISBN-13互相转换)"""
+    variants = {isbn}
+    if len(isbn) == 10:
+        variants.add(isbn10_to_isbn13(isbn))
+    else:
+        isbn10 = isbn13_to_isbn10(isbn)
+        if isbn10:
+            variants.add(isbn10)
+    return variants
+
+def _search_isbn(session, value, limit, offset, fields, conditions):
+    """按ISBN搜索
+    完整且校验通过的ISBN按主键精确查找(含ISBN-10/13等价形式)，本地没有时才从国家图书馆获取；
+    不完整的输入按前缀范围查询(isbn >= prefix AND isbn < prefix_next)，可使用主键索引
+    """
+    cleaned = re.sub(r'[^0-9Xx]', '', value).upper()
+    if not cleaned:
+        raise ValueError('无效的ISBN')
+
+    columns = book_columns(fields)
+    full_isbn = validate_isbn(cleaned)
+    if full_isbn:
+        variants = isbn_variants(full_isbn)
+        statement = select(*columns).where(*conditions).order_by(Book.isbn)
+        rows = session.execute(statement.where(Book.isbn.in_(variants))).all()
+        if not rows and enrich_queue.async_enabled():
+            # 只加入补全队列，获取到后再次搜索即可查到；查无此书或已失败的任务不因搜索重新执行
+            enrich_queue.enqueue_isbns([full_isbn], retry_ended=False)
+        elif not rows:
+            status, _ = import_book(full_isbn)
+            if status != 'not_found':
+                # 创建书籍记录后重新查询
+                rows = session.execute(statement.where(Book.isbn.in_(variants))).all()
+        return rows[offset:offset + limit]
+
+    upper = cleaned[:-1] + chr(ord(cleaned[-1]) + 1)
+    return session.execute(
+        select(*columns).where(Book.isbn >= cleaned, Book.isbn < upper, *conditions)
+        .order_by(Book.isbn).limit(limit).offset(offset)
+    ).all()
 
 # 根据关键字搜索图书
-def search_books(field, value):
+def search_books(field, value, page=1, per_page=SEARCH_PER_PAGE, fields=None, filters=None):
     """根据字段搜索图书
     参数:
         field: 搜索字段(isbn/title/author)
         value: 搜索值
+        page: 页码(从1开始)
+        per_page: 每页数量(不超过SEARCH_MAX_PER_PAGE)
+        fields: 返回字段，为空时返回全部字段
+        filters: parse_filters返回的筛选条件
     返回:
-        图书列表
+        图书列表，书名/作者搜索按相关度排序
     异常:
         ValueError: 搜索字段无效
         Exception: 搜索结果为空
     """
-    session = get_session()
-    try:
+    with DBSession() as session:
         valid_fields = ['isbn', 'title', 'author']
         if field not in valid_fields:
             raise ValueError('Invalid search field')
+        if page < 1 or per_page < 1:
+            raise ValueError('Invalid page parameters')
+        per_page = min(per_page, SEARCH_MAX_PER_PAGE)
+        offset = (page - 1) * per_page
+        fields = parse_fields(fields)
+        conditions = _filter_conditions(filters)
         
         if field == 'isbn':
-            # 先查询本地数据库
-            books = session.query(Book).filter(Book.isbn.like(f'%{value}%')).all()
-            
-            # 如果没有结果，尝试从API获取
-            if not books:
-                book_data = fetch_book_auto(value)
-                if book_data:
-                    # 创建书籍记录
-                    create_book(book_data)
-                    # 重新查询
-                    books = session.query(Book).filter_by(isbn=value).all()
-                    
-        elif field == 'title':
-            books = session.query(Book).filter(Book.title.like(f'%{value}%')).all()
+            rows = _search_isbn(session, value, per_page, offset, fields, conditions)
         else:
-            books = session.query(Book).filter(Book.author.like(f'%{value}%')).all()
+            rows = _search_text(session, field, value, per_page, offset, fields, conditions)
         
-        if not books:
+        if not rows:
             raise Exception('No books found matching the search criteria')
         
-        return [book.to_dict() for book in books]
-    finally:
-        session.close()
+        return [row_to_dict(row, fields) for row in rows]
 
 # 获取用户书籍总数
 def get_user_books_count(user_id):
-    """获取用户书籍总数"""
-    session = get_session()
-    try:
-        return session.query(UserBook).filter_by(user_id=user_id).count()
-    finally:
-        session.close()
+    """获取用户书籍总数(读取计数缓存)"""
+    return counters.get_count(counters.user_books_key(user_id))
 
 # 获取用户书架中的书籍
 def get_user_books(user_id):
@@ -173,14 +477,61 @@ def get_user_books(user_id):
     Returns:
         list: 用户书籍列表，每条数据保持原有结构
     """
-    session = get_session()
-    try:
+    with DBSession() as session:
         query = session.query(UserBook).filter_by(user_id=user_id)
         return [{'isbn': ub.isbn, 'nums': ub.nums} for ub in query.all()]
-    finally:
-        session.close()
 
 
+# 书架可排序字段
+SHELF_SORT_FIELDS = ('title', 'publish_year', 'nums')
+
+def get_shelf_etag(user_id):
+    """书架ETag：书架或书籍信息变化时改变"""
+    return '{}-{}-{}'.format(
+        user_id,
+        counters.get_count(counters.shelf_version_key(user_id)),
+        counters.get_count(counters.CATALOG_VERSION)
+    )
+
+# 获取用户书架(含书籍详情)
+def get_user_bookshelf(user_id, page=1, per_page=20, sort='title', order='asc', fields=None):
+    """通过一次JOIN查询获取用户书架及书籍信息
+    Args:
+        user_id: 用户ID
+        page: 页码(从1开始)
+        per_page: 每页数量
+        sort: 排序字段(title/publish_year/nums)
+        order: 排序方向(asc/desc)
+        fields: 需要返回的书籍字段列表，为空时返回全部字段(isbn和nums总是返回)
+    Returns:
+        tuple: (书架条目列表, 条目总数)
+    Raises:
+        ValueError: 分页、排序或字段参数无效
+    """
+    if page < 1 or per_page < 1:
+        raise ValueError('无效的分页参数')
+    if sort not in SHELF_SORT_FIELDS:
+        raise ValueError(f'不支持的排序字段: {sort}')
+    if order not in ('asc', 'desc'):
+        raise ValueError(f'不支持的排序方向: {order}')
+    fields = parse_fields(fields)
+
+    sort_column = UserBook.nums if sort == 'nums' else getattr(Book, sort)
+    if order == 'desc':
+        sort_column = sort_column.desc()
+
+    with DBSession() as session:
+        rows = session.query(UserBook.nums, *book_columns(fields))\
+            .join(Book, Book.isbn == UserBook.isbn)\
+            .filter(UserBook.user_id == user_id)\
+            .order_by(sort_column, Book.isbn)\
+            .limit(per_page).offset((page - 1) * per_page).all()
+        items = []
+        for row in rows:
+            item = row_to_dict(row[1:], fields)
+            item['nums'] = row[0]
+            items.append(item)
+        return items, get_user_books_count(user_id)
 
 
 # 增加
@@ -189,8 +540,7 @@ def get_user_books(user_id):
 # 创建书籍
 def create_book(data):
     """创建新书"""
-    session = get_session()
-    try:
+    with DBSession() as session:
         # 必填字段验证
         required_fields = ['isbn', 'title']
         for field in required_fields:
@@ -214,7 +564,9 @@ def create_book(data):
             description=data.get('description', '')
         )
         session.add(book)
-        session.commit()
+        session.flush()
+        counters.bump(session, counters.BOOKS, 1)
+        search_index.index_book(session, book.isbn, book.title, book.author)
         return {
             'success': True,
             'message': 'Book created',
@@ -225,84 +577,94 @@ def create_book(data):
                 'publisher': book.publisher
             }
         }
-    finally:
-        session.close()
 
 # 根据ISBN创建新书
 def create_book_isbn(isbn):
-    """根据ISBN创建新书
+    """根据ISBN创建新书，同一ISBN的并发请求共享一次获取和入库的结果
+    启用异步补全时只创建占位记录并加入补全队列，立即返回
     Args:
         isbn: 书籍ISBN号
     Returns:
         dict: {
             'success': bool,  # 操作是否成功
             'message': str,   # 结果消息
-            'book': dict      # 创建的书籍信息(成功时)
+            'book': dict,     # 创建的书籍信息(成功时)
+            'enrichment': str # 异步补全时为'pending'
         }
     """
-    session = get_session()
     try:
-        # 检查书籍是否已存在
-        existing_book = session.query(Book).filter_by(isbn=isbn).first()
-        if existing_book:
-            return {
-                'success': False,
-                'message': f'书籍已存在: {existing_book.title}',
-                'book': None
-            }
-
-        # 从API获取书籍信息
-        book_data = fetch_book_auto(isbn)
-        if not book_data:
+        if enrich_queue.async_enabled():
+            return _create_placeholder_isbn(isbn)
+        status, _ = import_book(isbn)
+        if status == 'not_found':
             return {
                 'success': False,
                 'message': '无法从API获取书籍信息',
                 'book': None
             }
 
-        # 使用create_book创建书籍
-        result = create_book(book_data)
-        if not result.get('success', False):
+        with DBSession() as session:
+            book = session.query(Book).filter_by(isbn=isbn).first()
+            if status == 'exists':
+                return {
+                    'success': False,
+                    'message': f'书籍已存在: {book.title}',
+                    'book': None
+                }
             return {
-                'success': False,
-                'message': result.get('message', '创建书籍失败'),
-                'book': None
-            }
-
-        # 获取创建的书籍信息
-        new_book = session.query(Book).filter_by(isbn=isbn).first()
-        return {
-            'success': True,
-            'message': '书籍创建成功',
-            'book': {
-                'isbn': new_book.isbn,
-                'title': new_book.title,
-                'author': new_book.author,
-                'publisher': new_book.publisher
+                'success': True,
+                'message': '书籍创建成功',
+                'book': {
+                    'isbn': book.isbn,
+                    'title': book.title,
+                    'author': book.author,
+                    'publisher': book.publisher
+                }
             }
-        }
     except Exception as e:
-        session.rollback()
-        import logging
         logging.error(f"创建书籍时发生错误: {str(e)}")
         return {
             'success': False,
             'message': f'创建书籍时发生错误: {str(e)}',
             'book': None
         }
-    finally:
-        session.close()
+
+
+def _create_placeholder_isbn(isbn):
+    """异步补全时创建占位记录并加入补全队列"""
+    clean_isbn = normalize_isbn(isbn)
+    if clean_isbn != isbn:
+        return {
+            'success': False,
+            'message': '无效的ISBN',
+            'book': None
+        }
+    with DBSession() as session:
+        if not enrich_queue.create_placeholder(session, isbn):
+            book = session.query(Book).filter_by(isbn=isbn).first()
+            return {
+                'success': False,
+                'message': f'书籍已存在: {book.title}',
+                'book': None
+            }
+    return {
+        'success': True,
+        'message': '书籍已创建，正在从国家图书馆获取书籍信息',
+        'book': {'isbn': isbn, 'title': isbn, 'author': None, 'publisher': None},
+        'enrichment': enrich_queue.PENDING
+    }
 
 
 ## 修改
 
 
 # 更新书籍信息
-def update_book(isbn, data):
+def update_book(isbn, data, fields=None):
     """更新书籍信息
     Args:
         isbn: 要更新的书籍ISBN
         data: 包含更新字段的字典
+        fields: 返回的书籍字段，为空时返回全部字段
     Returns:
         dict: {
             'success': bool,  # 操作是否成功
@@ -312,72 +674,60 @@ def update_book(isbn, data):
     Raises:
         ValueError: 如果ISBN无效或必填字段缺失
     """
-    session = get_session()
-    try:
-        # 验证ISBN格式
-        formatted_isbn = format_isbn(isbn)
-        
-        # 获取要更新的书籍
-        book = session.query(Book).filter_by(isbn=formatted_isbn).first()
-        if not book:
+    with DBSession() as session:
+        try:
+            # 验证ISBN格式
+            formatted_isbn = format_isbn(isbn)
+            fields = parse_fields(fields)
+
+            # 在保存点中修改，失败时只撤销本次更新，请求中之前的写入保留
+            with savepoint(session):
+                # 获取要更新的书籍
+                book = session.query(Book).filter_by(isbn=formatted_isbn).first()
+                if not book:
+                    return {
+                        'success': False,
+                        'message': '书籍不存在',
+                        'book': None
+                    }
+
+                # 更新可修改字段
+                updatable_fields = [
+                    'title', 'author', 'translator', 'genre', 'country', 
+                    'era', 'opac_nlc_class', 'publisher', 'publish_year',
+                    'page', 'cover_url', 'description'
+                ]
+
+                for field in updatable_fields:
+                    if field in data:
+                        setattr(book, field, data[field])
+
+                # 提交更改
+                session.flush()
+                counters.bump(session, counters.CATALOG_VERSION, 1)
+                if 'title' in data or 'author' in data:
+                    search_index.index_book(session, book.isbn, book.title, book.author)
+
+            # 返回更新后的书籍数据
+            return {
+                'success': True,
+                'message': '书籍更新成功',
+                'book': book_to_dict(book, fields)
+            }
+        except ValueError as e:
             return {
                 'success': False,
-                'message': '书籍不存在',
+                'message': f'参数错误: {str(e)}',
                 'book': None
             }
-            
-        # 更新可修改字段
-        updatable_fields = [
-            'title', 'author', 'translator', 'genre', 'country', 
-            'era', 'opac_nlc_class', 'publisher', 'publish_year',
-            'page', 'cover_url', 'description'
-        ]
-        
-        for field in updatable_fields:
-            if field in data:
-                setattr(book, field, data[field])
-        
-        # 提交更改
-        session.commit()
-        
-        # 返回更新后的书籍数据
-        return {
-            'success': True,
-            'message': '书籍更新成功',
-            'book': {
-                'isbn': book.isbn,
-                'title': book.title,
-                'author': book.author,
-                'translator': book.translator,
-                'genre': book.genre,
-                'country': book.country,
-                'era': book.era,
-                'opac_nlc_class': book.opac_nlc_class,
-                'publisher': book.publisher,
-                'publish_year': book.publish_year,
-                'page': book.page,
-                'cover_url': book.cover_url,
-                'description': book.description
+        except Exception as e:
+            import logging
+            logging.error(f"更新书籍失败: {str(e)}")
+            return {
+                'success': False,
+                'message': f'更新书籍失败: {str(e)}',
+                'book': None
             }
-        }
-    except ValueError as e:
-        session.rollback()
-        return {
-            'success': False,
-            'message': f'参数错误: {str(e)}',
-            'book': None
-        }
-    except Exception as e:
-        session.rollback()
-        import logging
-        logging.error(f"更新书籍失败: {str(e)}")
-        return {
-            'success': False,
-            'message': f'更新书籍失败: {str(e)}',
-            'book': None
-        }
-    finally:
-        session.close()
 
 
 ## 删除
@@ -389,58 +739,82 @@ def delete_book(isbn):
     先删除用户书籍关联，再删除书籍本身
     使用事务确保数据一致性
     """
-    session = get_session()
-    try:
-        session.begin()
-        
-        # 1. 先删除用户书籍关联
-        session.query(UserBook).filter_by(isbn=isbn).delete()
-        
-        # 2. 删除书籍本身
-        book = session.query(Book).filter_by(isbn=isbn).first()
-        if not book:
-            session.rollback()
+    with DBSession() as session:
+        try:
+            book = session.query(Book).filter_by(isbn=isbn).first()
+            if not book:
+                return {
+                    'success': False,
+                    'message': '书籍不存在'
+                }
+
+            # 在保存点中删除，失败时只撤销本次删除，请求中之前的写入保留
+            with savepoint(session):
+                # 1. 先删除用户书籍关联，同时减少相关用户的书架计数和汇总
+                shelf_rows = session.query(UserBook.user_id, UserBook.nums).filter_by(isbn=isbn).all()
+                session.query(UserBook).filter_by(isbn=isbn).delete()
+                for user_id, nums in shelf_rows:
+                    _bump_shelf(session, user_id, -1, -nums)
+
+                # 2. 删除书籍本身
+                search_index.unindex_book(session, isbn)
+                session.delete(book)
+                session.flush()
+                counters.bump(session, counters.BOOKS, -1)
+                counters.bump(session, counters.CATALOG_VERSION, 1)
+            
             return {
-                'success': False,
-                'message': '书籍不存在'
+                'success': True,
+                'message': '书籍删除成功'
             }
             
-        session.delete(book)
-        session.commit()
-        
-        return {
-            'success': True,
-            'message': '书籍删除成功'
-        }
-        
-    except Exception as e:
-        session.rollback()
-        import logging
-        logging.error(f"删除书籍失败: {str(e)}", exc_info=True)
-        print(f"Error deleting book: {str(e)} - rolling back transaction")
-        
-        # 检查是否是外键约束错误
-        if "foreign key constraint" in str(e).lower():
+        except Exception as e:
+            import logging
+            logging.error(f"删除书籍失败: {str(e)}", exc_info=True)
+            print(f"Error deleting book: {str(e)} - rolling back transaction")
+            
+            # 检查是否是外键约束错误
+            if "foreign key constraint" in str(e).lower():
+                return {
+                    'success': False,
+                    'message': '删除失败：存在关联数据'
+                }
+                
             return {
                 'success': False,
-                'message': '删除失败：存在关联数据'
+                'message': f'删除书籍失败: {str(e)}'
             }
-            
-        return {
-            'success': False,
-            'message': f'删除书籍失败: {str(e)}'
-        }
-    finally:
-        session.close()
-        print("Database session closed")
 
 
 # 用户书籍
 
 
+def _validate_quantity(quantity):
+    if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity <= 0:
+        raise ValueError("数量必须是大于0的整数")
+
+
+def _shelf_upsert(statement):
+    """书架增量写入: 已有记录时在数据库中累加数量，并发添加不会丢失"""
+    return statement.on_conflict_do_update(
+        index_elements=[UserBook.user_id, UserBook.isbn],
+        set_={'nums': UserBook.nums + statement.excluded.nums}
+    ).returning(UserBook.isbn, UserBook.nums)
+
+
+def _bump_shelf(session, user_id, added, copies):
+    """书架记录数变化added、册数变化copies后更新计数、书架汇总和书架版本"""
+    if added:
+        counters.bump(session, counters.user_books_key(user_id), added)
+    stats.bump_shelf(session, user_id, added, copies)
+    counters.bump(session, counters.shelf_version_key(user_id), 1)
+
+
 # 增加书籍到用户书架
 def add_book_to_user(isbn, user_id, quantity=1):
     """添加书籍到个人书库
+    数量由一条 INSERT ... ON CONFLICT DO UPDATE SET nums = nums + excluded.nums RETURNING
+    语句在数据库中累加，并发添加不会丢失
     Args:
         isbn: 书籍ISBN
         user_id: 用户ID
@@ -450,68 +824,107 @@ def add_book_to_user(isbn, user_id, quantity=1):
     Raises:
         ValueError: 数量无效或无法获取书籍信息
     """
-    session = get_session()
-    try:
-        # 检查书籍是否存在
-        book = session.query(Book).filter_by(isbn=isbn).first()
-        if not book:
-            # 从外部API获取书籍信息
-            book_data = fetch_book_auto(isbn)
-            if not book_data:
-                raise ValueError("无法获取书籍信息")
-            
-            # 创建书籍
-            create_book(book_data)
-            book = session.query(Book).filter_by(isbn=isbn).first()
-
-        # 验证数量
-        if quantity <= 0:
-            raise ValueError("添加数量必须大于0")
-
-        # 添加用户-书籍关联
-        user_book = session.query(UserBook).filter_by(
-            user_id=user_id, isbn=isbn
-        ).with_for_update().first()
-        
-        if user_book:
-            user_book.nums += quantity
-            session.flush()
-        else:
-            user_book = UserBook(user_id=user_id, isbn=isbn, nums=quantity)
-            session.add(user_book)
-            
-        session.commit()
-        session.refresh(user_book)
-        return {
+    _validate_quantity(quantity)
+    pending = False
+    with DBSession() as session:
+        # 先只读检查书籍是否存在，需要从外部API获取时不会在网络请求期间持有写锁
+        if not session.query(Book.isbn).filter_by(isbn=isbn).first():
+            if enrich_queue.async_enabled():
+                if normalize_isbn(isbn) != isbn:
+                    raise ValueError("无效的ISBN")
+                # 先以占位记录加入书架，由后台补全书籍信息
+                enrich_queue.create_placeholder(session, isbn)
+                pending = True
+            else:
+                status, _ = import_book(isbn)
+                if status == 'not_found':
+                    raise ValueError("无法获取书籍信息")
+
+        statement = insert(UserBook).values(user_id=user_id, isbn=isbn, nums=quantity)
+        row = session.execute(_shelf_upsert(statement)).first()
+
+        # 累加后的数量等于本次添加数量说明是新插入的记录(已有记录的数量至少为1)
+        _bump_shelf(session, user_id, 1 if row.nums == quantity else 0, quantity)
+        result = {
             'message': f'成功添加{quantity}本书籍',
-            'current_count': user_book.nums
+            'current_count': row.nums
+        }
+        if pending:
+            # 书籍信息正在后台获取，可通过补全任务状态接口查询进度
+            result['enrichment'] = enrich_queue.PENDING
+        return result
+
+# 批量增加书籍到用户书架
+def add_books_to_user(user_id, items):
+    """在一个事务中批量添加书籍到个人书库
+    Args:
+        user_id: 用户ID
+        items: (isbn, 数量)列表，同一ISBN出现多次时数量累加
+    Returns:
+        dict: {
+            'message': str,
+            'counts': {isbn: 添加后的数量}
+        }
+    Raises:
+        ValueError: 数量无效或书籍不存在(先调用enqueue_enrichment或create_book_isbn入库)
+    """
+    quantities = {}
+    for isbn, quantity in items:
+        _validate_quantity(quantity)
+        quantities[isbn] = quantities.get(isbn, 0) + quantity
+    if not quantities:
+        raise ValueError("没有要添加的书籍")
+
+    with DBSession() as session:
+        isbns = list(quantities)
+        existing = set()
+        for i in range(0, len(isbns), BATCH_CHUNK_SIZE):
+            chunk = isbns[i:i + BATCH_CHUNK_SIZE]
+            existing.update(isbn for (isbn,) in session.query(Book.isbn).filter(Book.isbn.in_(chunk)))
+        missing = [isbn for isbn in isbns if isbn not in existing]
+        if missing:
+            raise ValueError(f"书籍不存在: {', '.join(missing[:20])}")
+
+        counts = {}
+        for i in range(0, len(isbns), BATCH_CHUNK_SIZE):
+            rows = [{'user_id': user_id, 'isbn': isbn, 'nums': quantities[isbn]}
+                    for isbn in isbns[i:i + BATCH_CHUNK_SIZE]]
+            for isbn, nums in session.execute(_shelf_upsert(insert(UserBook).values(rows))):
+                counts[isbn] = nums
+        added = sum(1 for isbn, nums in counts.items() if nums == quantities[isbn])
+        _bump_shelf(session, user_id, added, sum(quantities.values()))
+        return {
+            'message': f'成功添加{sum(quantities.values())}本书籍',
+            'counts': counts
         }
-    finally:
-        session.close()
 
 # 从用户书架中移除书籍
-def remove_book_from_user(isbn, user_id):
+def remove_book_from_user(isbn, user_id, quantity=None):
     """从用户书架中移除书籍
     Args:
         isbn: 书籍ISBN
         user_id: 用户ID
+        quantity: 减少的数量，为空或不小于现有数量时移除整条记录
     Returns:
-        dict: 操作结果消息
+        dict: 操作结果消息(current_count为剩余数量)
     Raises:
-        ValueError: 如果书籍不在用户书架中
+        ValueError: 数量无效或书籍不在用户书架中
     """
-    session = get_session()
-    try:
-        user_book = session.query(UserBook).filter_by(
-            user_id=user_id,
-            isbn=isbn
-        ).first()
-        
-        if not user_book:
+    if quantity is not None:
+        _validate_quantity(quantity)
+    with DBSession() as session:
+        key = (UserBook.user_id == user_id) & (UserBook.isbn == isbn)
+        if quantity is not None:
+            row = session.execute(
+                update(UserBook).where(key, UserBook.nums > quantity)
+                .values(nums=UserBook.nums - quantity).returning(UserBook.nums)
+            ).first()
+            if row:
+                _bump_shelf(session, user_id, 0, -quantity)
+                return {'message': f'成功移除{quantity}本书籍', 'current_count': row.nums}
+
+        row = session.execute(delete(UserBook).where(key).returning(UserBook.nums)).first()
+        if not row:
             raise ValueError('书籍不在用户书架中')
-            
-        session.delete(user_book)
-        session.commit()
-        return {'message': 'Book removed from user'}
-    finally:
-        session.close()
+        _bump_shelf(session, user_id, -1, -row.nums)
+        return {'message': 'Book removed from user', 'current_count': 0}
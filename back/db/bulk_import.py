@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# back/db/bulk_import.py
+"""书籍批量导入
+
+流式读取JSON数组、NDJSON或CSV文件，国家图书馆格式的记录(含authors/tags/pubdate等字段)
+经get_book_data转换，按批校验后用 INSERT ... ON CONFLICT(isbn) DO UPDATE 分块写入，
+每块一个事务，计数缓存和检索索引在同一事务中更新。已存在的书籍只更新导入记录中有值的字段。
+
+用法: python -m db.bulk_import books.json [--format json|ndjson|csv] [--chunk-size 1000]
+"""
+
+import argparse
+import csv
+import io
+import json
+import re
+import sys
+from pathlib import Path
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from db import DBSession, counters, savepoint, search_index
+from db.book_tools import normalize_isbn
+from db.serialization import BOOK_FIELDS
+from models import Book
+from tools.bookdata import get_book_data
+
+IMPORT_FORMATS = ('json', 'ndjson', 'csv')
+DEFAULT_CHUNK_SIZE = 1000
+# 报告中最多列出的拒绝记录数
+MAX_REJECTED_DETAILS = 1000
+# 国家图书馆原始数据特有的字段
+_NLC_KEYS = ('authors', 'tags', 'pubdate', 'pages', 'comments')
+# 字符串字段的最大长度(与Book模型一致)
+_MAX_LENGTHS = {
+    column.name: column.type.length
+    for column in Book.__table__.columns
+    if getattr(column.type, 'length', None)
+}
+
+
+def detect_format(filename):
+    """根据文件扩展名判断格式"""
+    suffix = Path(filename or '').suffix.lower().lstrip('.')
+    if suffix in ('jsonl', 'ndjson'):
+        return 'ndjson'
+    if suffix in IMPORT_FORMATS:
+        return suffix
+    raise ValueError(f'无法识别的文件格式: {filename}')
+
+
+def _iter_json(fp, chunk_size=65536):
+    """流式解析JSON数组，逐个返回元素；顶层为对象时返回该对象"""
+    decoder = json.JSONDecoder()
+    buf = fp.read(chunk_size).lstrip()
+    if not buf.startswith('['):
+        data = json.loads(buf + fp.read())
+        yield from (data if isinstance(data, list) else [data])
+        return
+
+    pos = 1
+    eof = False
+    while True:
+        # 跳过空白和逗号，必要时补充读取
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+        if pos >= len(buf):
+            raise ValueError('JSON数组未结束')
+        if buf[pos] == ']':
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield obj
+        pos = end
+        if pos > chunk_size:
+            buf, pos = buf[pos:], 0
+
+
+def _iter_ndjson(fp):
+    for line in fp:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_records(fp, fmt):
+    """按格式流式读取记录"""
+    if fmt == 'json':
+        return _iter_json(fp)
+    if fmt == 'ndjson':
+        return _iter_ndjson(fp)
+    if fmt == 'csv':
+        return csv.DictReader(fp)
+    raise ValueError(f'不支持的格式: {fmt}')
+
+
+def _to_int(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, int):
+        return value
+    match = re.match(r'\s*(\d+)', str(value))
+    return int(match.group(1)) if match else None
+
+
+def convert_record(record):
+    """将一条导入记录转换为Book字段字典
+    Returns:
+        tuple: (书籍字典, None) 或 (None, 拒绝原因)
+    """
+    if not isinstance(record, dict):
+        return None, '记录不是对象'
+    if any(key in record for key in _NLC_KEYS) and 'author' not in record:
+        record = get_book_data(record)
+        if not record:
+            return None, '无法转换国家图书馆格式数据'
+
+    isbn = normalize_isbn(record.get('isbn') or '')
+    if not isbn:
+        return None, 'ISBN无效'
+    title = (record.get('title') or '').strip()
+    if not title:
+        return None, '缺少书名'
+
+    book = {}
+    for field in BOOK_FIELDS:
+        value = record.get(field)
+        if field in ('publish_year', 'page'):
+            value = _to_int(value)
+        elif value is not None:
+            value = str(value).strip()[:_MAX_LENGTHS.get(field)]
+        book[field] = value
+    book['isbn'] = isbn
+    book['title'] = title[:_MAX_LENGTHS['title']]
+    # 不满足表约束的数值置空，而不是拒绝整条记录
+    if book['publish_year'] is not None and not 1800 <= book['publish_year'] <= 2100:
+        book['publish_year'] = None
+    if book['page'] is not None and book['page'] <= 0:
+        book['page'] = None
+    return book, None
+
+
+def write_books(books):
+    """在一个事务中写入一块记录
+    已存在的ISBN只更新记录中提供了值的字段，缺少或为空的字段保留原值(如只有isbn,title两列的CSV不会清空作者)
+    Args:
+        books: ISBN到convert_record结果的映射
+    Returns:
+        tuple: (新增数, 更新数)
+    """
+    with DBSession() as session, savepoint(session):
+        # savepoint在查询已存在的ISBN之前取得写锁，其他写入者不能在查询和写入之间插入同一ISBN，计数保持准确
+        isbns = list(books)
+        existing = {isbn for (isbn,) in session.query(Book.isbn).filter(Book.isbn.in_(isbns))}
+        statement = insert(Book.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=['isbn'],
+            set_={field: func.coalesce(statement.excluded[field], Book.__table__.c[field])
+                  for field in BOOK_FIELDS if field != 'isbn'}
+        ).returning(Book.isbn, Book.title, Book.author)
+        # 按写入后的书名和作者重建检索索引(部分字段更新时以数据库中的值为准)
+        indexed = [row._asdict() for row in session.execute(statement, list(books.values()))]
+
+        inserted = len(isbns) - len(existing)
+        counters.bump(session, counters.BOOKS, inserted)
+        if existing:
+            counters.bump(session, counters.CATALOG_VERSION, 1)
+        search_index.index_books(session, indexed)
+        return inserted, len(existing)
+
+
+def import_books(fp, fmt, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """从文件对象批量导入书籍
+    Args:
+        fp: 文本文件对象
+        fmt: 格式(json/ndjson/csv)
+        chunk_size: 每个事务写入的记录数
+        progress: 可选回调，每写入一块后以当前报告调用
+    Returns:
+        dict: {
+            'total': 读取的记录数,
+            'inserted': 新增数,
+            'updated': 更新数,
+            'rejected': 拒绝数,
+            'rejected_details': [{'record': 记录序号(从1开始), 'isbn': ISBN, 'reason': 原因}]
+        }
+    """
+    report = {'total': 0, 'inserted': 0, 'updated': 0, 'rejected': 0, 'rejected_details': []}
+
+    def reject(index, record, reason):
+        report['rejected'] += 1
+        if len(report['rejected_details']) < MAX_REJECTED_DETAILS:
+            isbn = record.get('isbn') if isinstance(record, dict) else None
+            report['rejected_details'].append({'record': index, 'isbn': isbn, 'reason': reason})
+
+    def flush(chunk):
+        inserted, updated = write_books(chunk)
+        report['inserted'] += inserted
+        report['updated'] += updated
+        chunk.clear()
+        if progress:
+            progress(report)
+
+    # 同一块内ISBN重复时以后出现的记录为准
+    chunk = {}
+    for index, record in enumerate(iter_records(fp, fmt), start=1):
+        report['total'] += 1
+        book, reason = convert_record(record)
+        if reason:
+            reject(index, record, reason)
+            continue
+        chunk[book['isbn']] = book
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+    if chunk:
+        flush(chunk)
+    return report
+
+
+def import_file(path, fmt=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """从文件路径批量导入书籍"""
+    fmt = fmt or detect_format(path)
+    with io.open(path, 'r', encoding='utf-8-sig', newline='') as fp:
+        return import_books(fp, fmt, chunk_size=chunk_size, progress=progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量导入书籍(JSON/NDJSON/CSV/国家图书馆格式)')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=IMPORT_FORMATS)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    def progress(report):
+        print(f"已处理 {report['total']} 条: 新增 {report['inserted']}, "
+              f"更新 {report['updated']}, 拒绝 {report['rejected']}", file=sys.stderr)
+
+    report = import_file(args.path, args.format, args.chunk_size, progress)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
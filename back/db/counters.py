@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# back/db/counters.py
+"""总数计数缓存
+
+列表接口需要的书籍总数、用户总数、用户书架书籍数保存在Counter表中，
+由写操作在同一事务中增减，读取时只需一次主键查询。
+计数由迁移(seed_counters)按实际数据初始化，此后写操作以UPSERT增减，不存在的计数行表示0，
+读取从不写入；reconcile_counters()可全量校正。
+"""
+
+import logging
+import threading
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from db import DBSession
+from models import Book, Counter, User, UserBook
+
+BOOKS = 'books'
+USERS = 'users'
+USER_BOOKS_PREFIX = 'user_books:'
+# 版本号计数：数据变化时递增，用于生成ETag
+CATALOG_VERSION = 'catalog_version'
+SHELF_VERSION_PREFIX = 'shelf_version:'
+
+
+def user_books_key(user_id):
+    """用户书架书籍数的计数名称"""
+    return f'{USER_BOOKS_PREFIX}{user_id}'
+
+
+def shelf_version_key(user_id):
+    """用户书架版本号的计数名称"""
+    return f'{SHELF_VERSION_PREFIX}{user_id}'
+
+
+def _compute(session, name):
+    """从实际数据统计计数值"""
+    if name == BOOKS:
+        return session.query(func.count(Book.isbn)).scalar()
+    if name == USERS:
+        return session.query(func.count(User.user_id)).scalar()
+    if name.startswith(USER_BOOKS_PREFIX):
+        user_id = int(name[len(USER_BOOKS_PREFIX):])
+        return session.query(func.count(UserBook.isbn)).filter_by(user_id=user_id).scalar()
+    if name == CATALOG_VERSION or name.startswith(SHELF_VERSION_PREFIX):
+        return 0
+    raise ValueError(f'未知的计数: {name}')
+
+
+def get_count(name):
+    """读取计数(只读)，计数行不存在时为0"""
+    with DBSession() as session:
+        return session.query(Counter.value).filter_by(name=name).scalar() or 0
+
+
+def bump(session, name, delta=1):
+    """在调用方的事务中增减计数，计数行不存在时以delta创建"""
+    statement = insert(Counter).values(name=name, value=delta)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=[Counter.name],
+        set_={'value': Counter.value + statement.excluded.value}
+    ))
+
+
+def drop(session, name):
+    """删除计数(如用户被删除后的书架计数)"""
+    session.query(Counter).filter_by(name=name).delete()
+
+
+def reconcile_counters():
+    """按实际数据重新计算全部计数
+    Returns:
+        dict: 计数名称到校正后数值的映射
+    """
+    with DBSession() as session:
+        values = {
+            BOOKS: _compute(session, BOOKS),
+            USERS: _compute(session, USERS),
+        }
+        shelf_counts = session.query(UserBook.user_id, func.count(UserBook.isbn))\
+            .group_by(UserBook.user_id).all()
+        for user_id, count in shelf_counts:
+            values[user_books_key(user_id)] = count
+
+        session.query(Counter).filter(
+            (Counter.name == BOOKS) | (Counter.name == USERS) |
+            Counter.name.startswith(USER_BOOKS_PREFIX)
+        ).delete(synchronize_session=False)
+        session.add_all(Counter(name=name, value=value) for name, value in values.items())
+        return values
+
+
+def start_reconciler(interval):
+    """启动后台线程定期校正计数
+    Args:
+        interval: 校正间隔(秒)，小于等于0时不启动
+    Returns:
+        threading.Event: 设置后停止线程，未启动时返回None
+    """
+    if interval <= 0:
+        return None
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                reconcile_counters()
+            except Exception as e:
+                logging.error(f"校正计数失败: {e}")
+
+    threading.Thread(target=run, name='counter-reconciler', daemon=True).start()
+    return stop
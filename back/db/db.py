@@ -1,48 +1,380 @@
 # -*- coding: utf-8 -*-
 # back/db/db.py
 
+import json
+import logging
 import os
-from sqlalchemy import create_engine
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app, g, has_app_context
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
-from models import Base
+from sqlalchemy.pool import QueuePool
 
-def get_engine():
-    """获取数据库引擎"""
+
+class _TimedQueuePool(QueuePool):
+    """记录连接等待时间的连接池"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+
+# SQLite连接参数方案，通过DB_SQLITE_PROFILE选择，每个新连接建立时应用
+SQLITE_PROFILES = {
+    # WAL模式下读写互不阻塞，适合多进程多线程部署
+    'performance': {
+        'journal_mode': 'WAL',
+        'busy_timeout': 5000,
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+        'foreign_keys': 'ON',
+    },
+    # 回滚日志模式(SQLite默认行为)，仅启用外键约束
+    'compat': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'foreign_keys': 'ON',
+    },
+}
+DEFAULT_SQLITE_PROFILE = 'performance'
+
+
+def get_sqlite_profile(name=None):
+    """获取SQLite连接参数方案，未指定时读取DB_SQLITE_PROFILE"""
+    name = name or os.getenv('DB_SQLITE_PROFILE') or DEFAULT_SQLITE_PROFILE
+    if name not in SQLITE_PROFILES:
+        raise ValueError(f'Unknown DB_SQLITE_PROFILE: {name}')
+    return SQLITE_PROFILES[name]
+
+
+def apply_sqlite_profile(dbapi_connection, name=None):
+    """在原始sqlite3连接上执行方案中的PRAGMA设置"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in get_sqlite_profile(name).items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+    finally:
+        cursor.close()
+
+
+# 每个进程独享一个引擎和会话工厂，fork后在子进程中重建
+_engine_lock = threading.Lock()
+_engine_pid = None
+_engine = None
+_session_factory = None
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+    return int(value)
+
+
+def _is_memory_url(db_url):
+    return db_url.startswith('sqlite') and (':memory:' in db_url or db_url in ('sqlite://', 'sqlite:///'))
+
+
+def _build_engine():
+    """根据环境变量创建数据库引擎"""
     # 从环境变量获取数据库URL，必须配置
     db_url = os.getenv('DATABASE_URL')
     if not db_url:
         raise ValueError('DATABASE_URL must be configured in .env file')
-    return create_engine(
-        db_url,
-        echo=os.getenv('DB_ECHO', 'false').lower() == 'true',
-        connect_args={'check_same_thread': os.getenv('DB_CHECK_SAME_THREAD', 'false').lower() == 'true'},
-        isolation_level=os.getenv('DB_ISOLATION_LEVEL', 'SERIALIZABLE')
-    )
 
-def init_db():
-    """初始化数据库"""
-    engine = get_engine()
-    Base.metadata.create_all(engine)
+    kwargs = {
+        'echo': os.getenv('DB_ECHO', 'false').lower() == 'true',
+        'isolation_level': os.getenv('DB_ISOLATION_LEVEL', 'SERIALIZABLE'),
+    }
+    if db_url.startswith('sqlite'):
+        kwargs['connect_args'] = {
+            'check_same_thread': os.getenv('DB_CHECK_SAME_THREAD', 'false').lower() == 'true'
+        }
+    # 内存数据库使用SQLAlchemy默认的单线程池，其余使用可配置的连接池
+    if not _is_memory_url(db_url):
+        kwargs.update(
+            poolclass=_TimedQueuePool,
+            pool_size=_env_int('DB_POOL_SIZE', 5),
+            max_overflow=_env_int('DB_MAX_OVERFLOW', 10),
+            pool_timeout=_env_int('DB_POOL_TIMEOUT', 30),
+            pool_recycle=_env_int('DB_POOL_RECYCLE', 3600),
+            pool_pre_ping=os.getenv('DB_POOL_PRE_PING', 'false').lower() == 'true',
+        )
+    engine = create_engine(db_url, **kwargs)
+    if db_url.startswith('sqlite'):
+        profile = os.getenv('DB_SQLITE_PROFILE') or DEFAULT_SQLITE_PROFILE
+        get_sqlite_profile(profile)  # 配置错误时尽早失败
+
+        @event.listens_for(engine, 'connect')
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            apply_sqlite_profile(dbapi_connection, profile)
     return engine
 
+
+@contextmanager
+def begin_immediate(engine):
+    """开启立即获取写锁的事务(SQLite的BEGIN IMMEDIATE)
+    pysqlite默认只在DML前开启事务，建表建触发器等DDL和"先检查再写入"的读取都不在事务中；
+    启动时的结构初始化使用此事务，多个进程同时启动时依次执行，后执行的进程能看到先前的结果
+    """
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+        yield conn
+
+
+def get_engine():
+    """获取当前进程的数据库引擎(首次调用时创建)"""
+    global _engine_pid, _engine, _session_factory
+    pid = os.getpid()
+    if _engine is not None and _engine_pid == pid:
+        return _engine
+    with _engine_lock:
+        if _engine is not None and _engine_pid == pid:
+            return _engine
+        if _engine is not None:
+            # 从父进程继承的连接不能在子进程中使用，只丢弃不关闭
+            _engine.dispose(close=False)
+        _engine = _build_engine()
+        # 在此处导入: fts/facets/stats依赖本模块，migrations可作为模块直接运行
+        from db.migrations import migrate
+        from db.fts import init_fts
+        from db.facets import init_facets
+        from db.stats import init_stats
+        migrate(_engine)
+        init_fts(_engine)
+        init_facets(_engine)
+        init_stats(_engine)
+        _session_factory = sessionmaker(
+            bind=_engine,
+            autoflush=False,
+            autocommit=False,
+            expire_on_commit=False
+        )
+        _engine_pid = pid
+        return _engine
+
+
+def get_session_factory():
+    """获取当前进程的会话工厂"""
+    get_engine()
+    return _session_factory
+
+
+def dispose_engine():
+    """释放当前进程的引擎和连接池，下次使用时按最新配置重建"""
+    global _engine_pid, _engine, _session_factory
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose(close=_engine_pid == os.getpid())
+        _engine_pid = None
+        _engine = None
+        _session_factory = None
+
+
+def get_pool_stats():
+    """获取连接池统计信息
+    Returns:
+        dict: {
+            'pool': 连接池类型,
+            'size': 池大小,
+            'checked_out': 已借出连接数,
+            'overflow': 溢出连接数,
+            'checkouts': 从池中获取连接的次数,
+            'wait_total_ms': 累计等待时间(毫秒),
+            'wait_avg_ms': 平均等待时间(毫秒),
+            'wait_max_ms': 最长等待时间(毫秒)
+        }
+    """
+    pool = get_engine().pool
+    stats = {'pool': type(pool).__name__, 'pid': os.getpid()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, _TimedQueuePool):
+        with pool._stats_lock:
+            checkouts = pool.checkouts
+            wait_total = pool.wait_total
+            wait_max = pool.wait_max
+        stats.update(
+            checkouts=checkouts,
+            wait_total_ms=round(wait_total * 1000, 3),
+            wait_avg_ms=round(wait_total * 1000 / checkouts, 3) if checkouts else 0.0,
+            wait_max_ms=round(wait_max * 1000, 3),
+        )
+    return stats
+
+
+def init_db():
+    """初始化数据库(创建引擎时执行未应用的迁移)"""
+    return get_engine()
+
+
 def get_session():
-    """获取数据库会话"""
-    engine = get_engine()
-    Session = sessionmaker(
-        bind=engine,
-        autoflush=False,
-        autocommit=False,
-        expire_on_commit=False
-    )
-    return Session()
+    """获取一个独立的数据库会话(调用方负责提交和关闭)"""
+    return get_session_factory()()
+
+
+# 请求外嵌套调用时共享最外层DBSession打开的会话
+_scope_session = ContextVar('scope_session', default=None)
+
+
+def _request_session():
+    """获取请求级会话，首次使用时打开；不在已注册的Flask应用上下文中时返回None"""
+    if not has_app_context() or 'db_session' not in current_app.extensions:
+        return None
+    session = g.get('_db_session')
+    if session is None:
+        session = get_session()
+        g._db_session = session
+    return session
+
+
+def commit_request_session(response):
+    """返回响应前提交请求级会话(5xx响应回滚)，提交失败时把响应改为5xx错误，客户端不会误以为写入成功
+    流式响应在生成内容时打开的会话仍由teardown提交
+    """
+    session = g.pop('_db_session', None)
+    if session is None:
+        return response
+    try:
+        if response.status_code < 500:
+            session.commit()
+        else:
+            session.rollback()
+    except SQLAlchemyError as e:
+        logging.error(f"提交请求事务失败: {e}")
+        session.rollback()
+        # 就地修改响应，保留其他after_request已添加的CORS等响应头
+        response.set_data(json.dumps({
+            'success': False,
+            'message': '数据库繁忙，请稍后重试' if isinstance(e, OperationalError) else '保存数据失败'
+        }, ensure_ascii=False))
+        response.status_code = 503 if isinstance(e, OperationalError) else 500
+        response.mimetype = 'application/json'
+        for header in ('ETag', 'Last-Modified', 'Content-Disposition', 'Content-Encoding'):
+            response.headers.pop(header, None)
+    finally:
+        session.close()
+    return response
+
+
+def close_request_session(exc=None):
+    """请求结束时提交或回滚尚未由commit_request_session处理的请求级会话"""
+    session = g.pop('_db_session', None)
+    if session is None:
+        return
+    try:
+        if exc is None:
+            session.commit()
+        else:
+            session.rollback()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def init_app(app):
+    """为Flask应用启用请求级会话"""
+    app.extensions['db_session'] = True
+    app.after_request(commit_request_session)
+    app.teardown_appcontext(close_request_session)
+
+
+def _in_write_transaction(session):
+    """会话中是否有未提交的写入(pysqlite只在DML前开启事务，其他数据库按会话是否已开始事务判断)"""
+    connection = session.connection()
+    dbapi_connection = connection.connection.dbapi_connection
+    if connection.dialect.name == 'sqlite':
+        return dbapi_connection.in_transaction
+    return session.in_transaction()
+
+
+@contextmanager
+def savepoint(session):
+    """在保存点中执行: 块内出错时只回滚块内的修改，会话中之前的写入保留，异常继续抛出
+    没有进行中的事务时SQLite的SAVEPOINT会自行开启事务并在RELEASE时直接提交，
+    因此先显式开启(立即获取写锁的)事务，使保存点嵌套在会话的事务中
+    """
+    connection = session.connection()
+    if connection.dialect.name == 'sqlite' and not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+    with session.begin_nested():
+        yield session
+
 
 class DBSession:
-    """数据库会话上下文管理器"""
-    def __init__(self):
-        self.session = get_session()
+    """数据库会话上下文管理器
+    请求中复用请求级会话，返回响应前统一提交；请求外由最外层调用创建会话，
+    正常退出时提交，异常时回滚，嵌套调用共享同一会话。
+    嵌套调用出错时只撤销本层的修改: 会话中已有写入时本层在保存点中执行，出错回滚到保存点；
+    没有写入时回滚会话不会丢失之前的工作
+    Args:
+        independent: 不复用请求级会话和外层会话，使用独立会话并在退出时提交，
+            用于需要在返回响应前对其他线程和进程可见的写入；其中的嵌套调用共享这个独立会话。
+            SQLite只允许一个写事务，请求级会话已有写入时不要使用
+    """
+    def __init__(self, independent=False):
+        self.independent = independent
+        self.session = None
+        self.owned = False
+        self._token = None
+        self._nested = None
 
     def __enter__(self):
+        if not self.independent:
+            self.session = _scope_session.get() or _request_session()
+        if self.session is None:
+            self.session = get_session()
+            self.owned = True
+            self._token = _scope_session.set(self.session)
+        elif _in_write_transaction(self.session):
+            self._nested = self.session.begin_nested()
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.session.close()
+        if not self.owned:
+            # 共享会话：正常退出时只刷新让约束错误尽早暴露，由外层提交
+            if self._nested is not None:
+                if exc_type is not None:
+                    self._nested.rollback()
+                else:
+                    self._nested.commit()
+            elif exc_type is not None:
+                self.session.rollback()
+            else:
+                self.session.flush()
+            return
+        try:
+            if exc_type is None:
+                self.session.commit()
+            else:
+                self.session.rollback()
+        finally:
+            _scope_session.reset(self._token)
+            self.session.close()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# back/db/enrich_queue.py
+"""书籍信息补全任务队列
+
+从国家图书馆抓取一本书最长需要约20秒，在请求线程中同步获取时几个慢查询就能占满gunicorn的全部线程。
+启用异步补全(ENRICH_ASYNC=1，默认关闭，保持请求中同步获取的接口行为)后，本地不存在的ISBN立即以占位记录
+(书名为ISBN)入库并加入队列，由后台工作线程获取书籍信息后更新Book表；占位记录已被手动修改(书名不再是ISBN)时不覆盖。
+查无此书时删除不在任何书架上的占位记录；已加入书架的占位记录保留，由任务状态(not_found)标明。
+
+队列保存在EnrichJob表中，每个ISBN一条任务(重复加入时只重新激活已结束的任务，搜索时不重新激活查无此书或失败的任务):
+    - 工作线程用一条 UPDATE ... RETURNING 原子地领取到期任务，多个进程可同时工作
+    - 执行中的任务带租约(LEASE_SECONDS)，工作进程中途退出时租约到期后由其他工作线程重新领取
+    - 网络错误等临时故障按带随机抖动的指数退避重试，超过ENRICH_MAX_ATTEMPTS次后标记为failed
+    - 国家图书馆查无此书时标记为not_found，不再重试
+
+启用异步补全时工作线程随应用启动(每个进程ENRICH_WORKERS个)；未启用或设为0时可单独运行
+(如处理enqueue_enrichment加入的任务):
+    python -m db.enrich_queue work [--workers 2]
+    python -m db.enrich_queue status     各状态的任务数
+    python -m db.enrich_queue retry      重新执行失败的任务
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from db import DBSession, counters
+from models import Book, EnrichJob, UserBook
+from tools.bookdata import NlcUnavailable, lookup_book_info
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+JOB_STATUSES = (PENDING, RUNNING, DONE, NOT_FOUND, FAILED)
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_ATTEMPTS = 5
+# 第n次失败后等待 BACKOFF * 2^(n-1) 秒(±50%随机抖动)再重试
+DEFAULT_BACKOFF = 30
+# 执行中任务的租约(秒)，应大于一次查询的最长耗时
+LEASE_SECONDS = 120
+# 队列为空时的轮询间隔(秒)，本进程加入任务时立即唤醒
+POLL_INTERVAL = 1.0
+
+# 本进程加入任务时唤醒空闲的工作线程
+_wakeup = threading.Event()
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def async_enabled():
+    """是否在请求中只创建占位记录，由后台补全书籍信息"""
+    return os.getenv('ENRICH_ASYNC', '0').lower() not in ('0', 'false', 'no', '')
+
+
+def enqueue(session, isbns, retry_ended=True):
+    """在调用方的事务中加入补全任务，已在队列中(待执行或执行中)的ISBN不重复加入
+    Args:
+        isbns: 规范化后的ISBN列表
+        retry_ended: 是否重新激活查无此书(not_found)和失败(failed)的任务；
+            为False时只重新激活已完成(done，书籍之后被删除)的任务
+    Returns:
+        list: 本次新加入(或重新激活)的ISBN
+    """
+    if not isbns:
+        return []
+    now = time.time()
+    statement = insert(EnrichJob).values([
+        {'isbn': isbn, 'status': PENDING, 'attempts': 0, 'run_at': now, 'created_at': now, 'updated_at': now}
+        for isbn in dict.fromkeys(isbns)
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=[EnrichJob.isbn],
+        set_={'status': PENDING, 'attempts': 0, 'run_at': now, 'error': None, 'updated_at': now},
+        where=EnrichJob.status.in_([DONE, NOT_FOUND, FAILED] if retry_ended else [DONE])
+    ).returning(EnrichJob.isbn)
+    queued = [isbn for (isbn,) in session.execute(statement)]
+    if queued:
+        _wakeup.set()
+    return queued
+
+
+def enqueue_isbns(isbns, retry_ended=True):
+    """加入补全任务(不创建占位记录，查到后新建书籍)
+    Args:
+        retry_ended: 见enqueue
+    Returns:
+        list: 本次新加入的ISBN
+    """
+    with DBSession() as session:
+        return enqueue(session, isbns, retry_ended)
+
+
+def create_placeholder(session, isbn):
+    """在调用方的事务中创建占位书籍记录(书名为ISBN)并加入补全任务
+    Returns:
+        bool: 是否新建了占位记录(书籍已存在时为False)
+    """
+    created = session.execute(
+        insert(Book).values(isbn=isbn, title=isbn).on_conflict_do_nothing().returning(Book.isbn)
+    ).first() is not None
+    if created:
+        counters.bump(session, counters.BOOKS, 1)
+        enqueue(session, [isbn])
+    return created
+
+
+def _drop_placeholder(session, isbn):
+    """删除查无此书的占位记录，已被手动修改或已加入书架的记录保留"""
+    on_shelf = select(UserBook.isbn).where(UserBook.isbn == isbn).exists()
+    deleted = session.execute(
+        delete(Book).where(Book.isbn == isbn, Book.title == isbn, ~on_shelf)
+    ).rowcount
+    if deleted:
+        counters.bump(session, counters.BOOKS, -1)
+
+
+def _timestamp(value):
+    return datetime.fromtimestamp(value).isoformat(timespec='seconds') if value else None
+
+
+def _job_to_dict(job):
+    return {
+        'isbn': job.isbn,
+        'status': job.status,
+        'attempts': job.attempts,
+        'error': job.error,
+        # 待重试时为下次执行时间
+        'next_run_at': _timestamp(job.run_at) if job.status == PENDING else None,
+        'created_at': _timestamp(job.created_at),
+        'updated_at': _timestamp(job.updated_at)
+    }
+
+
+def get_job(isbn):
+    """查询补全任务状态
+    Returns:
+        dict: {'isbn', 'status', 'attempts', 'error', 'next_run_at', 'created_at', 'updated_at'}，无任务时为None
+    """
+    with DBSession() as session:
+        job = session.get(EnrichJob, isbn)
+        return _job_to_dict(job) if job else None
+
+
+def get_queue_stats():
+    """各状态的任务数
+    Returns:
+        dict: {状态: 任务数}，包含全部状态
+    """
+    with DBSession() as session:
+        counts = dict(session.execute(
+            select(EnrichJob.status, func.count()).group_by(EnrichJob.status)
+        ).all())
+    return {status: counts.get(status, 0) for status in JOB_STATUSES}
+
+
+def retry_failed():
+    """重新执行失败的任务
+    Returns:
+        int: 重新加入队列的任务数
+    """
+    now = time.time()
+    with DBSession() as session:
+        return session.execute(
+            update(EnrichJob).where(EnrichJob.status == FAILED)
+            .values(status=PENDING, attempts=0, run_at=now, error=None, updated_at=now)
+        ).rowcount
+
+
+def claim_job():
+    """领取一个到期的任务(含租约已过期的执行中任务)
+    Returns:
+        tuple: (ISBN, 第几次执行)，没有到期任务时为None
+    """
+    now = time.time()
+    due = select(EnrichJob.isbn).where(
+        EnrichJob.status.in_([PENDING, RUNNING]), EnrichJob.run_at <= now
+    ).order_by(EnrichJob.run_at).limit(1)
+    # 先只读查询是否有到期任务，队列空闲时轮询不获取写锁
+    with DBSession() as session:
+        if session.execute(due).first() is None:
+            return None
+    with DBSession() as session:
+        row = session.execute(
+            update(EnrichJob).where(EnrichJob.isbn == due.scalar_subquery())
+            .values(status=RUNNING, attempts=EnrichJob.attempts + 1, run_at=now + LEASE_SECONDS, updated_at=now)
+            .returning(EnrichJob.isbn, EnrichJob.attempts)
+        ).first()
+        return tuple(row) if row else None
+
+
+def _finish(session, isbn, status, error=None, run_at=None):
+    now = time.time()
+    session.execute(
+        update(EnrichJob).where(EnrichJob.isbn == isbn)
+        .values(status=status, error=error and error[:255], run_at=run_at or now, updated_at=now)
+    )
+
+
+def run_job(isbn, attempts):
+    """执行一个已领取的任务
+    Returns:
+        str: 任务的新状态
+    """
+    # 延迟导入: bulk_import依赖book_tools，book_tools依赖本模块
+    from db.bulk_import import convert_record, write_books
+    try:
+        raw_data = lookup_book_info(isbn)
+        book, reason = convert_record(raw_data) if raw_data else (None, None)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        if not isinstance(e, NlcUnavailable):
+            logging.error(f"补全书籍信息 {isbn} 出错: {error}")
+        with DBSession() as session:
+            if attempts >= _env_int('ENRICH_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS):
+                _finish(session, isbn, FAILED, error)
+                return FAILED
+            delay = _env_int('ENRICH_BACKOFF', DEFAULT_BACKOFF) * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+            _finish(session, isbn, PENDING, error, time.time() + delay)
+            return PENDING
+
+    with DBSession() as session:
+        if not raw_data:
+            _drop_placeholder(session, isbn)
+            _finish(session, isbn, NOT_FOUND)
+            return NOT_FOUND
+        if reason:
+            _finish(session, isbn, FAILED, reason)
+            return FAILED
+        title = session.query(Book.title).filter_by(isbn=isbn).scalar()
+        # 不存在时新建，仍是占位记录时补全；已被手动修改的记录不覆盖
+        if title is None or title == isbn:
+            write_books({isbn: book})
+        _finish(session, isbn, DONE)
+        return DONE
+
+
+def run_pending():
+    """在当前线程中执行所有到期任务，直到没有到期任务
+    Returns:
+        dict: {状态: 任务数}，本次执行后各任务的状态
+    """
+    report = {}
+    while True:
+        job = claim_job()
+        if job is None:
+            return report
+        status = run_job(*job)
+        report[status] = report.get(status, 0) + 1
+
+
+def start_workers(workers=None):
+    """启动后台工作线程
+    Args:
+        workers: 线程数，默认读取ENRICH_WORKERS，小于等于0时不启动
+    Returns:
+        threading.Event: 设置后线程在完成当前任务后退出，未启动时返回None
+    """
+    workers = _env_int('ENRICH_WORKERS', DEFAULT_WORKERS) if workers is None else workers
+    if workers <= 0:
+        return None
+    stop = threading.Event()
+
+    def run():
+        while not stop.is_set():
+            try:
+                job = claim_job()
+                if job is not None:
+                    run_job(*job)
+                    continue
+            except Exception as e:
+                logging.error(f"补全任务执行失败: {e}")
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+
+    for i in range(workers):
+        threading.Thread(target=run, name=f'book-enrich-{i}', daemon=True).start()
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description='书籍信息补全任务队列')
+    parser.add_argument('command', choices=['work', 'status', 'retry'])
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='工作线程数(work)')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        print(json.dumps(get_queue_stats(), ensure_ascii=False, indent=2))
+    elif args.command == 'retry':
+        print(f'已重新加入 {retry_failed()} 个失败的任务')
+    else:
+        start_workers(args.workers)
+        print(f'已启动 {args.workers} 个工作线程，Ctrl+C 退出')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# back/db/enrichment.py
+"""从国家图书馆批量补全书籍信息
+
+NlcBatchClient并发查询，查到的书籍经convert_record转换后攒批，
+每batch_size本在一个事务中写入Book表(同bulk_import.write_books)。
+
+用法: python -m db.enrichment isbns.txt [--workers 4] [--rate 2] [--batch-size 100]
+      (文件每行一个ISBN)
+"""
+
+import argparse
+import json
+import sys
+
+from db import DBSession
+from db.book_tools import BATCH_CHUNK_SIZE, normalize_isbn
+from db.bulk_import import convert_record, write_books
+from models import Book
+from tools.bookdata.nlc_batch import NlcBatchClient, RateLimiter
+from tools.bookdata.nlc_cache import get_cache
+from tools.bookdata.nlc_index import get_index
+
+DEFAULT_BATCH_SIZE = 100
+# 报告中最多列出的失败ISBN数
+MAX_FAILED_DETAILS = 1000
+
+
+def _existing_isbns(isbns):
+    existing = set()
+    with DBSession() as session:
+        for i in range(0, len(isbns), BATCH_CHUNK_SIZE):
+            chunk = isbns[i:i + BATCH_CHUNK_SIZE]
+            existing.update(isbn for (isbn,) in session.query(Book.isbn).filter(Book.isbn.in_(chunk)))
+    return existing
+
+
+def enrich_isbns(isbns, client=None, batch_size=DEFAULT_BATCH_SIZE, progress=None, skip_existing=True):
+    """批量从国家图书馆获取书籍信息并入库
+    Args:
+        isbns: ISBN列表
+        client: NlcBatchClient，默认按环境变量配置创建(使用查询缓存)
+        batch_size: 每个事务写入的书籍数
+        progress: 可选回调，每完成一本书的查询后以当前报告调用
+        skip_existing: 跳过本地已存在的书籍
+    Returns:
+        dict: {
+            'total': 去重后的ISBN数,
+            'skipped': 本地已存在而跳过的数量,
+            'written': 入库数,
+            'not_found': 国家图书馆查无此书的数量,
+            'failed': 查询或转换失败的数量,
+            'failed_details': [{'isbn': ISBN, 'reason': 原因}]
+        }
+    """
+    report = {'total': 0, 'skipped': 0, 'written': 0, 'not_found': 0, 'failed': 0, 'failed_details': []}
+
+    def fail(isbn, reason):
+        report['failed'] += 1
+        if len(report['failed_details']) < MAX_FAILED_DETAILS:
+            report['failed_details'].append({'isbn': isbn, 'reason': reason})
+
+    todo, seen = [], set()
+    for isbn in isbns:
+        clean_isbn = normalize_isbn(isbn)
+        if not clean_isbn:
+            fail(isbn, '无效的ISBN')
+        elif clean_isbn not in seen:
+            seen.add(clean_isbn)
+            todo.append(clean_isbn)
+    report['total'] = len(todo) + report['failed']
+    if skip_existing and todo:
+        existing = _existing_isbns(todo)
+        report['skipped'] = len(existing)
+        todo = [isbn for isbn in todo if isbn not in existing]
+
+    client = client or NlcBatchClient(cache=get_cache(), index=get_index())
+    batch = {}
+    for isbn, raw_data, error in client.fetch_many(todo):
+        if error:
+            fail(isbn, error)
+        elif not raw_data:
+            report['not_found'] += 1
+        else:
+            book, reason = convert_record(raw_data)
+            if reason:
+                fail(isbn, reason)
+            else:
+                batch[book['isbn']] = book
+        if len(batch) >= batch_size:
+            write_books(batch)
+            report['written'] += len(batch)
+            batch.clear()
+        if progress:
+            progress(report)
+    if batch:
+        write_books(batch)
+        report['written'] += len(batch)
+        if progress:
+            progress(report)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从国家图书馆批量补全书籍信息')
+    parser.add_argument('path', help='ISBN列表文件，每行一个')
+    parser.add_argument('--workers', type=int, help='并发查询数')
+    parser.add_argument('--rate', type=float, help='每秒最多请求数')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    with open(args.path, encoding='utf-8-sig') as fp:
+        isbns = [line.strip() for line in fp if line.strip()]
+    rate_limiter = RateLimiter(args.rate) if args.rate is not None else None
+    client = NlcBatchClient(workers=args.workers, rate_limiter=rate_limiter, cache=get_cache(),
+                            index=get_index())
+
+    def progress(report):
+        done = report['skipped'] + report['written'] + report['not_found'] + report['failed']
+        print(f"\r已完成 {done}/{report['total']}: 入库 {report['written']}, "
+              f"未找到 {report['not_found']}, 失败 {report['failed']}", end='', file=sys.stderr)
+
+    report = enrich_isbns(isbns, client=client, batch_size=args.batch_size, progress=progress)
+    print(file=sys.stderr)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# back/db/export.py
+"""书籍目录导出
+
+按ISBN顺序流式读取Book表(yield_per分批取行，不一次性载入全部结果)，逐块生成NDJSON或CSV字节流，
+可选gzip压缩，内存占用与目录大小无关。导出的CSV可直接用bulk_import重新导入。
+
+用法: python -m db.export books.ndjson [--format ndjson|csv] [--fields list] [--gzip]
+"""
+
+import argparse
+import csv
+import io
+import sys
+import zlib
+
+from sqlalchemy import select
+
+from db.db import get_engine
+from db.serialization import book_columns, parse_fields, row_to_dict
+from models import Book
+from tools.json_provider import dumps_bytes
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_MIME_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# 每次从数据库取出的行数
+EXPORT_BATCH_SIZE = 1000
+# 输出块大小，攒够后再交给响应，减少小块写入
+_CHUNK_BYTES = 64 * 1024
+
+
+def iter_book_rows(fields, batch_size=EXPORT_BATCH_SIZE):
+    """按ISBN顺序流式读取书籍行
+    使用独立连接，不依赖请求级会话(流式响应在请求上下文结束后才被消费)
+    """
+    statement = select(*book_columns(fields)).order_by(Book.isbn)
+    with get_engine().connect() as conn:
+        result = conn.execution_options(yield_per=batch_size).execute(statement)
+        for partition in result.partitions():
+            yield from partition
+
+
+def _ndjson_lines(fields, rows):
+    for row in rows:
+        yield dumps_bytes(row_to_dict(row, fields)) + b'\n'
+
+
+def _csv_lines(fields, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # 带BOM，Excel可正确识别UTF-8编码
+    yield '\ufeff'.encode('utf-8')
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow(row_to_dict(row, fields).values())
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _chunked(lines):
+    """将小段字节合并为约_CHUNK_BYTES大小的块"""
+    chunk, size = [], 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= _CHUNK_BYTES:
+            yield b''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def gzip_chunks(chunks):
+    """流式gzip压缩"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_books(fmt='ndjson', fields=None, gzip=False, batch_size=EXPORT_BATCH_SIZE):
+    """生成导出内容
+    Args:
+        fmt: 导出格式(ndjson/csv)
+        fields: 导出字段，为空时导出全部字段
+        gzip: 是否gzip压缩
+        batch_size: 每次从数据库取出的行数
+    Returns:
+        generator: 字节块生成器
+    Raises:
+        ValueError: 格式或字段无效(在开始读取数据前检查)
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'不支持的导出格式: {fmt}')
+    fields = parse_fields(fields)
+    rows = iter_book_rows(fields, batch_size)
+    lines = _ndjson_lines(fields, rows) if fmt == 'ndjson' else _csv_lines(fields, rows)
+    chunks = _chunked(lines)
+    return gzip_chunks(chunks) if gzip else chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='导出书籍目录(NDJSON/CSV)')
+    parser.add_argument('path', help='输出文件，-表示标准输出')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+    parser.add_argument('--fields', help='逗号分隔的字段或预设(list/all)')
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+
+    chunks = export_books(args.format, args.fields, args.gzip)
+    out = sys.stdout.buffer if args.path == '-' else open(args.path, 'wb')
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
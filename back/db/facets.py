@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# back/db/facets.py
+"""书籍分面计数
+
+BookFacet表保存每个分面维度下各取值的书籍数，由Book表上的触发器在写入书籍的同一事务中增量维护
+(插入+1、删除-1、修改时旧值-1新值+1)，接口读取分面计数时只需按(dimension, count)索引取前N项，
+不必每次对Book执行GROUP BY。中图分类号按大类(首字母)计数。
+page_range(页数分段)只用于统计(见db/stats.py)，不作为筛选分面。
+触发器定义变化时启动时自动重建触发器和计数。
+非SQLite数据库不创建触发器，facets_available()返回False，读取时回退到GROUP BY查询。
+全量重建: python -m db.facets rebuild
+"""
+
+import logging
+import sys
+
+from sqlalchemy import Integer, cast, func, select, text
+from sqlalchemy.exc import OperationalError
+
+from db import DBSession
+from db.db import begin_immediate
+from models import Book, BookFacet
+
+FACET_TABLE = 'BookFacet'
+FACET_DIMENSIONS = ('genre', 'country', 'era', 'publisher', 'publish_year', 'opac_nlc_class')
+# 只用于统计的维度
+STAT_DIMENSIONS = ('page_range',)
+DEFAULT_FACET_LIMIT = 20
+MAX_FACET_LIMIT = 200
+# 页数分段宽度，最后一段包含PAGE_RANGE_MAX及以上
+PAGE_RANGE_WIDTH = 100
+PAGE_RANGE_MAX = 1000
+
+# 各维度对应的Book列和取值表达式，{row}替换为new/old/Book
+_EXPRESSIONS = {
+    'genre': ('genre', '{row}.genre'),
+    'country': ('country', '{row}.country'),
+    'era': ('era', '{row}.era'),
+    'publisher': ('publisher', '{row}.publisher'),
+    'publish_year': ('publish_year', 'CAST({row}.publish_year AS TEXT)'),
+    'opac_nlc_class': ('opac_nlc_class', 'upper(substr({row}.opac_nlc_class, 1, 1))'),
+    'page_range': ('page', 'CASE WHEN {row}.page > 0 THEN CAST(min({row}.page / %d, %d) * %d AS TEXT) END'
+                   % (PAGE_RANGE_WIDTH, PAGE_RANGE_MAX // PAGE_RANGE_WIDTH, PAGE_RANGE_WIDTH)),
+}
+_DIMENSIONS = FACET_DIMENSIONS + STAT_DIMENSIONS
+
+
+def _value(dimension, row):
+    return _EXPRESSIONS[dimension][1].format(row=row)
+
+
+def _increment(dimension, row):
+    value = _value(dimension, row)
+    # INSERT ... SELECT带ON CONFLICT时SELECT必须有WHERE子句
+    return (f"INSERT INTO {FACET_TABLE}(dimension, value, count) "
+            f"SELECT '{dimension}', {value}, 1 WHERE coalesce({value}, '') != '' "
+            f"ON CONFLICT(dimension, value) DO UPDATE SET count = count + 1;")
+
+
+def _decrement(dimension, row):
+    return (f"UPDATE {FACET_TABLE} SET count = count - 1 "
+            f"WHERE dimension = '{dimension}' AND value = {_value(dimension, row)};")
+
+
+def _update_trigger(dimension):
+    # 每个维度单独的更新触发器，只在该列实际变化时调整计数
+    column = _EXPRESSIONS[dimension][0]
+    return (f"CREATE TRIGGER book_facet_au_{dimension} AFTER UPDATE OF {column} ON Book "
+            f"WHEN old.{column} IS NOT new.{column} BEGIN\n"
+            f"{_decrement(dimension, 'old')}\n{_increment(dimension, 'new')}\nEND")
+
+
+# 触发器名称 -> 定义(与sqlite_master中保存的文本一致，用于判断定义是否变化)
+FACET_TRIGGERS = {
+    'book_facet_ai': "CREATE TRIGGER book_facet_ai AFTER INSERT ON Book BEGIN\n"
+                     + '\n'.join(_increment(d, 'new') for d in _DIMENSIONS) + "\nEND",
+    'book_facet_ad': "CREATE TRIGGER book_facet_ad AFTER DELETE ON Book BEGIN\n"
+                     + '\n'.join(_decrement(d, 'old') for d in _DIMENSIONS) + "\nEND",
+    **{f'book_facet_au_{d}': _update_trigger(d) for d in _DIMENSIONS},
+}
+
+_available = False
+
+
+def init_facets(engine):
+    """创建分面计数触发器，新建或定义变化时重建触发器并从Book表重建计数
+    Returns:
+        bool: 分面计数表是否可用
+    """
+    global _available
+    if engine.dialect.name != 'sqlite':
+        _available = False
+        return _available
+    try:
+        with begin_immediate(engine) as conn:
+            existing = dict(conn.execute(text(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'book_facet_%'"
+            )).all())
+            if existing != FACET_TRIGGERS:
+                for name in existing:
+                    conn.execute(text(f'DROP TRIGGER "{name}"'))
+                for ddl in FACET_TRIGGERS.values():
+                    conn.execute(text(ddl))
+                _rebuild(conn)
+        _available = True
+    except OperationalError as e:
+        logging.warning(f"分面计数不可用，将使用GROUP BY查询: {e}")
+        _available = False
+    return _available
+
+
+def facets_available():
+    """当前进程的分面计数表是否可用"""
+    return _available
+
+
+def _rebuild(conn):
+    conn.execute(text(f"DELETE FROM {FACET_TABLE}"))
+    for dimension in _DIMENSIONS:
+        value = _value(dimension, 'Book')
+        conn.execute(text(
+            f"INSERT INTO {FACET_TABLE}(dimension, value, count) "
+            f"SELECT '{dimension}', {value}, count(*) FROM Book "
+            f"WHERE coalesce({value}, '') != '' GROUP BY {value}"
+        ))
+
+
+def rebuild_facets(engine=None, conn=None):
+    """从Book表重建分面计数
+    Args:
+        engine: 在新事务中重建
+        conn: 在调用方的连接(事务)中重建
+    """
+    if conn is not None:
+        _rebuild(conn)
+        return
+    with engine.begin() as conn:
+        _rebuild(conn)
+
+
+def _typed(dimension, value):
+    return int(value) if dimension in ('publish_year', 'page_range') else value
+
+
+def read_counts(session, dimension, limit=None, by_value=False):
+    """从分面计数表读取一个维度的计数(含统计维度)
+    Args:
+        limit: 最多返回的取值数，为空时返回全部
+        by_value: 按取值排序(年份、页数分段)，否则按书籍数从多到少
+    Returns:
+        list: [(取值, 书籍数)]，年份和页数分段的取值为整数
+    """
+    statement = select(BookFacet.value, BookFacet.count)\
+        .where(BookFacet.dimension == dimension, BookFacet.count > 0)
+    if by_value:
+        order = cast(BookFacet.value, Integer) if dimension in ('publish_year', 'page_range') \
+            else BookFacet.value
+        statement = statement.order_by(order)
+    else:
+        statement = statement.order_by(BookFacet.count.desc(), BookFacet.value)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return [(_typed(dimension, value), count) for value, count in session.execute(statement)]
+
+
+def _grouped_counts(session, dimension, limit):
+    """不使用计数表时按维度GROUP BY统计"""
+    column = getattr(Book, dimension)
+    if dimension == 'opac_nlc_class':
+        column = func.upper(func.substr(column, 1, 1))
+    count = func.count()
+    return session.execute(
+        select(column, count).where(column.isnot(None), column != '')
+        .group_by(column).order_by(count.desc(), column).limit(limit)
+    ).all()
+
+
+def get_facets(dimensions=None, limit=DEFAULT_FACET_LIMIT):
+    """读取分面计数(全库)
+    Args:
+        dimensions: 维度列表，为空时返回全部维度
+        limit: 每个维度最多返回的取值数(按书籍数从多到少)
+    Returns:
+        dict: {维度: [{'value': 取值, 'count': 书籍数}]}
+    Raises:
+        ValueError: 维度或数量无效
+    """
+    dimensions = list(dimensions or FACET_DIMENSIONS)
+    invalid = [d for d in dimensions if d not in FACET_DIMENSIONS]
+    if invalid:
+        raise ValueError(f'不支持的分面: {", ".join(invalid)}')
+    if not 1 <= limit <= MAX_FACET_LIMIT:
+        raise ValueError(f'limit必须在1到{MAX_FACET_LIMIT}之间')
+
+    result = {}
+    with DBSession() as session:
+        for dimension in dimensions:
+            if _available:
+                rows = read_counts(session, dimension, limit)
+            else:
+                rows = [(_typed(dimension, value), count)
+                        for value, count in _grouped_counts(session, dimension, limit)]
+            result[dimension] = [{'value': value, 'count': count} for value, count in rows]
+    return result
+
+
+def get_facet_count(dimension, value):
+    """某个维度取值的书籍数，计数表不可用时返回None"""
+    if not _available:
+        return None
+    with DBSession() as session:
+        count = session.query(BookFacet.count).filter_by(
+            dimension=dimension, value=str(value)
+        ).scalar()
+        return count or 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['rebuild']:
+        print('用法: python -m db.facets rebuild')
+        sys.exit(1)
+    from db.db import get_engine
+    rebuild_facets(get_engine())
+    print('已重建分面计数')
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# back/db/fts.py
+"""Book全文索引(SQLite FTS5)
+
+BookFts是以Book为外部内容表的FTS5虚拟表，由触发器与Book保持同步。
+使用trigram分词器，中文等不以空格分词的文本也能按子串匹配(至少3个字符)。
+SQLite未编译FTS5或不支持trigram时fts_available()返回False，调用方回退到LIKE查询。
+注意: VACUUM可能改变Book的rowid，执行VACUUM后需调用rebuild_fts()。
+"""
+
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from db.db import begin_immediate
+
+FTS_TABLE = 'BookFts'
+FTS_COLUMNS = ('title', 'author', 'translator', 'publisher', 'description')
+# 最短可检索长度(trigram分词)
+FTS_MIN_QUERY_LENGTH = 3
+
+_columns = ', '.join(FTS_COLUMNS)
+_new_values = ', '.join(f'new.{c}' for c in FTS_COLUMNS)
+_old_values = ', '.join(f'old.{c}' for c in FTS_COLUMNS)
+
+FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        {_columns}, content='Book', content_rowid='rowid', tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_fts_ai AFTER INSERT ON Book BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, {_columns}) VALUES (new.rowid, {_new_values});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_fts_ad AFTER DELETE ON Book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns}) VALUES ('delete', old.rowid, {_old_values});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_fts_au AFTER UPDATE ON Book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns}) VALUES ('delete', old.rowid, {_old_values});
+        INSERT INTO {FTS_TABLE}(rowid, {_columns}) VALUES (new.rowid, {_new_values});
+    END""",
+]
+
+_available = False
+
+
+def init_fts(engine):
+    """创建全文索引表和同步触发器，新建时从Book表重建索引
+    Returns:
+        bool: 全文索引是否可用
+    """
+    global _available
+    if engine.dialect.name != 'sqlite':
+        _available = False
+        return _available
+    try:
+        with begin_immediate(engine) as conn:
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': FTS_TABLE}
+            ).first()
+            for ddl in FTS_DDL:
+                conn.execute(text(ddl))
+            if not exists:
+                conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        _available = True
+    except OperationalError as e:
+        logging.warning(f"全文索引不可用，搜索将使用LIKE查询: {e}")
+        _available = False
+    return _available
+
+
+def fts_available():
+    """当前进程的全文索引是否可用"""
+    return _available
+
+
+def rebuild_fts(engine):
+    """从Book表重建全文索引"""
+    with engine.begin() as conn:
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+
+def build_match_query(columns, value):
+    """构造限定列的FTS5短语查询，值中的双引号按FTS5语法转义"""
+    phrase = '"' + value.replace('"', '""') + '"'
+    return '{' + ' '.join(columns) + '} : ' + phrase
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+# back/db/migrations.py
+"""数据库结构迁移
+
+数据库结构由这里按版本号顺序排列的迁移定义，已应用的版本记录在SchemaMigration表中。
+get_engine()首次创建引擎时(以及init_database)执行未应用的迁移:
+    - 每个迁移在单独的BEGIN IMMEDIATE事务中执行，多个进程同时启动时只有一个进程执行，
+      其余进程拿到写锁后发现版本已记录即跳过
+    - 应用了新迁移后执行ANALYZE，为查询优化器更新统计信息
+已发布的迁移不能修改，结构变化时在末尾追加新版本，并同步修改models.py中的模型定义。
+全文索引(db/fts.py)和分面计数(db/facets.py)的触发器由各自模块按定义自动重建，不在此处管理。
+只支持SQLite，其他数据库在创建引擎时报错。
+
+用法:
+    python -m db.migrations [migrate]   执行未应用的迁移
+    python -m db.migrations status      查看已应用的版本
+    python -m db.migrations analyze     重新收集统计信息
+    python -m db.migrations check       用EXPLAIN QUERY PLAN检查热点查询是否使用索引
+"""
+
+import re
+import sys
+
+SCHEMA_TABLE = 'SchemaMigration'
+
+# (版本号, 名称, SQL语句列表)
+MIGRATIONS = [
+    (1, 'baseline', [
+        # 引入迁移前由init_db/create_all按models.py创建的全部结构: 原有的User/Book/UserBook表，
+        # 以及此前已随代码发布的计数、分面、书架统计、检索索引表和筛选索引；
+        # 均为IF NOT EXISTS，已有数据库上只补建缺少的表和索引，不修改已有结构
+        '''CREATE TABLE IF NOT EXISTS User (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,  -- 用户ID，主键
+            username TEXT NOT NULL UNIQUE              -- 用户名，不能为空且唯一
+                CHECK(length(username) BETWEEN 4 AND 20),  -- 用户名长度4-20字符
+            password TEXT NOT NULL                     -- 密码，存储加密后的值
+                CHECK(length(password) = 64),          -- sha256哈希固定64字符
+            role TEXT NOT NULL DEFAULT 'user'          -- 角色，默认为user
+                CHECK(role IN ('admin', 'user'))       -- 角色只能是admin或user
+        )''',
+        '''CREATE TABLE IF NOT EXISTS Book (
+            isbn TEXT PRIMARY KEY                     -- ISBN号，主键
+                CHECK(length(isbn) BETWEEN 10 AND 13),  -- ISBN标准长度10或13位
+            title TEXT NOT NULL                       -- 书名，不能为空
+                CHECK(length(title) <= 100),          -- 书名最大100字符
+            author TEXT                               -- 作者
+                CHECK(length(author) <= 255),         -- 作者名最大255字符
+            translator TEXT                           -- 译者
+                CHECK(length(translator) <= 255),      -- 译者名最大255字符
+            genre TEXT                                -- 小说类型
+                CHECK(length(genre) <= 30),           -- 类型最大30字符
+            country TEXT                              -- 国家
+                CHECK(length(country) <= 30),         -- 国家名最大30字符
+            era TEXT                                  -- 时代
+                CHECK(length(era) <= 20),             -- 时代描述最大20字符
+            opac_nlc_class TEXT                       -- 中国国家图书馆分类号
+                CHECK(length(opac_nlc_class) <= 20), -- 分类号最大20字符
+            publisher TEXT                            -- 出版社
+                CHECK(length(publisher) <= 100),      -- 出版社名最大100字符
+            publish_year INTEGER                      -- 出版年
+                CHECK(publish_year BETWEEN 1800 AND 2100),  -- 出版年范围限制
+            page INTEGER                        -- 页数
+                CHECK(page > 0),                -- 页数必须为正数
+            cover_url TEXT                            -- 封面图片URL
+                CHECK(length(cover_url) <= 255),      -- URL最大255字符
+            description TEXT                          -- 简介
+                CHECK(length(description) <= 1000)    -- 简介最大1000字符
+        )''',
+        '''CREATE TABLE IF NOT EXISTS UserBook (
+            user_id INTEGER,                           -- 用户ID，外键
+            isbn TEXT,                                 -- 书籍ISBN，外键
+            nums INTEGER DEFAULT 1                     -- 数量，默认为1
+                CHECK(nums > 0),                       -- 数量必须为正数
+            PRIMARY KEY (user_id, isbn),               -- 复合主键
+            FOREIGN KEY (user_id) REFERENCES User(user_id) ON DELETE CASCADE,  -- 级联删除
+            FOREIGN KEY (isbn) REFERENCES Book(isbn) ON DELETE CASCADE         -- 级联删除
+        )''',
+        '''CREATE TABLE IF NOT EXISTS Counter (
+            name TEXT PRIMARY KEY,                     -- 计数名称
+            value INTEGER NOT NULL DEFAULT 0           -- 计数值
+        )''',
+        '''CREATE TABLE IF NOT EXISTS BookFacet (
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, value)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS ShelfStat (
+            user_id INTEGER PRIMARY KEY,
+            books INTEGER NOT NULL DEFAULT 0,
+            copies INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES User(user_id) ON DELETE CASCADE
+        )''',
+        '''CREATE TABLE IF NOT EXISTS BookGram (
+            field TEXT NOT NULL,
+            gram TEXT NOT NULL,
+            isbn TEXT NOT NULL,
+            PRIMARY KEY (field, gram, isbn),
+            FOREIGN KEY (isbn) REFERENCES Book(isbn) ON DELETE CASCADE
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS BookPinyin (
+            field TEXT NOT NULL,
+            "key" TEXT NOT NULL,
+            isbn TEXT NOT NULL,
+            PRIMARY KEY (field, "key", isbn),
+            FOREIGN KEY (isbn) REFERENCES Book(isbn) ON DELETE CASCADE
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS ix_book_title_isbn ON Book (title, isbn)',
+        'CREATE INDEX IF NOT EXISTS ix_book_genre_isbn ON Book (genre, isbn)',
+        'CREATE INDEX IF NOT EXISTS ix_book_country_isbn ON Book (country, isbn)',
+        'CREATE INDEX IF NOT EXISTS ix_book_era_isbn ON Book (era, isbn)',
+        'CREATE INDEX IF NOT EXISTS ix_book_publisher_isbn ON Book (publisher, isbn)',
+        'CREATE INDEX IF NOT EXISTS ix_book_publish_year_isbn ON Book (publish_year, isbn)',
+        'CREATE INDEX IF NOT EXISTS ix_book_opac_nlc_class_isbn ON Book (opac_nlc_class, isbn)',
+        'CREATE INDEX IF NOT EXISTS ix_bookfacet_dimension_count ON BookFacet (dimension, count)',
+        'CREATE INDEX IF NOT EXISTS ix_shelfstat_copies ON ShelfStat (copies)',
+        'CREATE INDEX IF NOT EXISTS ix_bookgram_isbn ON BookGram (isbn)',
+        'CREATE INDEX IF NOT EXISTS ix_bookpinyin_isbn ON BookPinyin (isbn)',
+    ]),
+    (2, 'secondary_indexes', [
+        # 删除书籍时按isbn查找书架记录(及外键级联)，覆盖user_id和nums无需回表
+        'CREATE INDEX IF NOT EXISTS ix_userbook_isbn ON UserBook (isbn, user_id, nums)',
+        # 按作者等值筛选/排序
+        'CREATE INDEX IF NOT EXISTS ix_book_author_isbn ON Book (author, isbn)',
+        # 按角色查找管理员
+        'CREATE INDEX IF NOT EXISTS ix_user_role ON User (role)',
+    ]),
+    (3, 'enrich_jobs', [
+        # 书籍信息补全任务队列(db/enrich_queue.py)，每个ISBN一条
+        '''CREATE TABLE IF NOT EXISTS EnrichJob (
+            isbn TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending'
+                CHECK(status IN ('pending', 'running', 'done', 'not_found', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,                      -- 下次执行时间，执行中为租约到期时间
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        # 按状态和执行时间领取任务
+        'CREATE INDEX IF NOT EXISTS ix_enrichjob_status_run_at ON EnrichJob (status, run_at)',
+    ]),
+    (4, 'seed_counters', [
+        # 按实际数据写入全部计数(db/counters.py)，此后只由写操作的UPSERT增减，读取时不再补写
+        """INSERT INTO Counter (name, value) SELECT 'books', count(*) FROM Book WHERE true
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value""",
+        """INSERT INTO Counter (name, value) SELECT 'users', count(*) FROM User WHERE true
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value""",
+        """INSERT INTO Counter (name, value)
+            SELECT 'user_books:' || user_id, count(*) FROM UserBook GROUP BY user_id
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value""",
+        "INSERT OR IGNORE INTO Counter (name, value) VALUES ('catalog_version', 0)",
+    ]),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _applied_versions(conn):
+    return {version for (version,) in conn.execute(f'SELECT version FROM {SCHEMA_TABLE}')}
+
+
+def apply_migrations(conn, analyze=True):
+    """在sqlite3连接上执行未应用的迁移
+    Args:
+        conn: sqlite3连接
+        analyze: 应用了新迁移后是否执行ANALYZE
+    Returns:
+        list: 本次应用的版本号
+    """
+    isolation_level = conn.isolation_level
+    # 由本函数显式控制事务，使建表建索引等DDL也在事务中执行
+    conn.isolation_level = None
+    applied = []
+    try:
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )''')
+        # 已是最新版本时不获取写锁
+        if _applied_versions(conn) >= {version for version, _, _ in MIGRATIONS}:
+            return applied
+        for version, name, statements in MIGRATIONS:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if version in _applied_versions(conn):
+                    conn.execute('ROLLBACK')
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'INSERT INTO {SCHEMA_TABLE} (version, name) VALUES (?, ?)', (version, name))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(version)
+        if applied and analyze:
+            conn.execute('ANALYZE')
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+
+def migrate(engine):
+    """对引擎对应的数据库执行未应用的迁移
+    Returns:
+        list: 本次应用的版本号
+    Raises:
+        RuntimeError: 不是SQLite数据库
+    """
+    if engine.dialect.name != 'sqlite':
+        raise RuntimeError(f'不支持的数据库: {engine.dialect.name}，'
+                           f'数据库结构迁移只支持SQLite(DATABASE_URL=sqlite:///path)')
+    raw = engine.raw_connection()
+    try:
+        return apply_migrations(raw.driver_connection)
+    finally:
+        raw.close()
+
+
+def get_status(conn):
+    """已应用的迁移
+    Returns:
+        list: [(版本号, 名称, 应用时间)]
+    """
+    return conn.execute(
+        f'SELECT version, name, applied_at FROM {SCHEMA_TABLE} ORDER BY version'
+    ).fetchall()
+
+
+# book_tools/user_tools中热点查询的结构，用于检查查询计划
+HOT_QUERIES = [
+    ('book_by_isbn', 'SELECT isbn, title FROM Book WHERE isbn = ?', ('9787020002207',)),
+    ('books_by_isbns', 'SELECT isbn, title FROM Book WHERE isbn IN (?, ?)', ('9787020002207', '9787544253994')),
+    ('books_page', 'SELECT isbn, title FROM Book ORDER BY isbn LIMIT 20 OFFSET 0', ()),
+    ('books_by_title_cursor',
+     'SELECT isbn, title FROM Book WHERE (title, isbn) > (?, ?) ORDER BY title, isbn LIMIT 21', ('a', '0')),
+    ('books_by_isbn_prefix',
+     'SELECT isbn, title FROM Book WHERE isbn >= ? AND isbn < ? ORDER BY isbn LIMIT 20', ('978702', '978703')),
+    ('books_by_author', 'SELECT isbn, title FROM Book WHERE author = ? ORDER BY isbn LIMIT 20', ('鲁迅',)),
+    ('books_by_genre', 'SELECT isbn, title FROM Book WHERE genre = ? ORDER BY isbn LIMIT 20', ('小说',)),
+    ('books_by_publisher',
+     'SELECT isbn, title FROM Book WHERE publisher IN (?, ?) ORDER BY isbn LIMIT 20', ('中华书局', '人民文学出版社')),
+    ('books_by_year',
+     'SELECT isbn, title FROM Book WHERE publish_year >= ? AND publish_year <= ? LIMIT 20', (2000, 2005)),
+    ('books_by_class',
+     'SELECT isbn, title FROM Book WHERE opac_nlc_class >= ? AND opac_nlc_class < ? LIMIT 20', ('I2', 'I3')),
+    ('shelves_by_isbn', 'SELECT user_id, nums FROM UserBook WHERE isbn = ?', ('9787020002207',)),
+    ('shelf_page',
+     'SELECT UserBook.nums, Book.isbn, Book.title FROM UserBook JOIN Book ON Book.isbn = UserBook.isbn '
+     'WHERE UserBook.user_id = ? ORDER BY Book.title, Book.isbn LIMIT 20', (1,)),
+    ('shelf_item', 'SELECT nums FROM UserBook WHERE user_id = ? AND isbn = ?', (1, '9787020002207')),
+    ('user_by_id', 'SELECT * FROM User WHERE user_id = ?', (1,)),
+    ('user_by_username', 'SELECT * FROM User WHERE username = ?', ('admin',)),
+    ('users_by_role', "SELECT * FROM User WHERE role = ?", ('admin',)),
+    ('counter', 'SELECT value FROM Counter WHERE name = ?', ('books',)),
+    ('facet_counts',
+     'SELECT value, count FROM BookFacet WHERE dimension = ? AND count > 0 ORDER BY count DESC LIMIT 20', ('genre',)),
+    ('top_shelves', 'SELECT user_id, copies FROM ShelfStat WHERE books > 0 ORDER BY copies DESC LIMIT 20', ()),
+    ('enrich_claim',
+     "SELECT isbn FROM EnrichJob WHERE status IN ('pending', 'running') AND run_at <= ? ORDER BY run_at LIMIT 1",
+     (0,)),
+]
+
+# 不使用任何索引的全表扫描；"SCAN t USING INDEX ..."为按索引顺序扫描，不在此列
+_FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+# 行数少于此值的表，ANALYZE后优化器会有意选择全表扫描，不视为问题
+SMALL_TABLE_ROWS = 1000
+
+
+def explain(conn, sql, params=()):
+    """返回查询计划的各行描述"""
+    return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+
+def full_scans(plan):
+    """查询计划中全表扫描的表名"""
+    return [match.group(1) for match in map(_FULL_SCAN.match, plan) if match]
+
+
+def _is_small(conn, table, min_rows):
+    if min_rows <= 0:
+        return False
+    return conn.execute(f'SELECT count(*) FROM (SELECT 1 FROM "{table}" LIMIT ?)', (min_rows,)).fetchone()[0] < min_rows
+
+
+def check_query_plans(conn, queries=HOT_QUERIES, min_rows=SMALL_TABLE_ROWS):
+    """检查查询是否都使用了索引
+    Args:
+        queries: [(名称, SQL, 参数)]
+        min_rows: 忽略行数少于此值的表上的全表扫描，0表示不忽略
+    Returns:
+        list: [(查询名称, 查询计划)]，只包含存在全表扫描的查询
+    """
+    problems = []
+    for name, sql, params in queries:
+        plan = explain(conn, sql, params)
+        if any(not _is_small(conn, table, min_rows) for table in full_scans(plan)):
+            problems.append((name, plan))
+    return problems
+
+
+def main():
+    from db.db import get_engine
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    if command not in ('migrate', 'status', 'analyze', 'check'):
+        print('用法: python -m db.migrations [migrate|status|analyze|check]')
+        sys.exit(1)
+    # 创建引擎时已执行未应用的迁移
+    raw = get_engine().raw_connection()
+    conn = raw.driver_connection
+    try:
+        if command == 'migrate':
+            print(f'当前版本 {max(_applied_versions(conn))}')
+        elif command == 'status':
+            for version, name, applied_at in get_status(conn):
+                print(f'{version:>4}  {name:<24} {applied_at}')
+        elif command == 'analyze':
+            conn.execute('ANALYZE')
+            conn.commit()
+            print('已更新统计信息')
+        else:
+            problems = check_query_plans(conn)
+            for name, plan in problems:
+                print(f'{name}: {" | ".join(plan)}')
+            print(f'{len(HOT_QUERIES) - len(problems)}/{len(HOT_QUERIES)} 个查询使用索引')
+            sys.exit(1 if problems else 0)
+    finally:
+        raw.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# back/db/search_index.py
+"""书名/作者中文检索索引
+
+中文不以空格分词，用户还常输入拼音或首字母(如"bc"检索"边城")，因此为Book.title和
+Book.author维护两张索引表：
+    BookGram: 字符二元组倒排表，每段文字末尾补一个结束符，单字查询也能按前缀命中
+    BookPinyin: 全拼和首字母键，按前缀范围查询
+索引保存在数据库中，各工作进程无需在启动时重建；书籍写操作在同一事务中增量更新，
+全量重建: python -m db.search_index rebuild
+"""
+
+import re
+import sys
+from functools import lru_cache
+
+from sqlalchemy import and_, delete, func, insert
+
+from db import DBSession
+from models import Book, BookGram, BookPinyin
+
+try:
+    from pypinyin import lazy_pinyin
+    from pypinyin.constants import PHRASES_DICT
+    from pypinyin.pinyin_dict import pinyin_dict
+except ImportError:  # 未安装pypinyin时只提供二元组检索
+    lazy_pinyin = None
+
+INDEXED_FIELDS = ('title', 'author')
+# 估计二元组命中数时最多数到的索引行数，用于选出命中最少的条件
+GRAM_PROBE_LIMIT = 1000
+# 段落结束符，保证每个字符都是某个二元组的首字符
+_END = ' '
+_SEGMENT_RE = re.compile(r'[^\W_]+')
+_ASCII_WORD_RE = re.compile(r'[a-z0-9]+')
+_PINYIN_QUERY_RE = re.compile(r'^[a-z]+$')
+_CJK_RE = re.compile(r'[㐀-鿿]')
+_KEY_MAX_LENGTH = 255
+# 词组库中最长词组的长度
+_PHRASE_MAX_LENGTH = 10
+
+
+def _segments(value):
+    """将文本规范化为小写的连续字母/数字/汉字片段"""
+    return _SEGMENT_RE.findall((value or '').lower())
+
+
+def text_grams(value):
+    """索引用的二元组集合(每段末尾补结束符)"""
+    grams = set()
+    for segment in _segments(value):
+        padded = segment + _END
+        grams.update(padded[i:i + 2] for i in range(len(segment)))
+    return grams
+
+
+@lru_cache(maxsize=None)
+def _char_syllable(char):
+    return lazy_pinyin(char)[0]
+
+
+def _in_phrase(value):
+    """文本中是否有包含多音字的词组，此时逐字转换可能读音错误"""
+    for i, char in enumerate(value):
+        if ',' not in pinyin_dict.get(ord(char), ''):
+            continue
+        for start in range(max(0, i - _PHRASE_MAX_LENGTH + 1), i + 1):
+            for end in range(max(i + 1, start + 2), min(len(value), start + _PHRASE_MAX_LENGTH) + 1):
+                if value[start:end] in PHRASES_DICT:
+                    return True
+    return False
+
+
+def _pinyin_parts(value):
+    """文本转拼音片段
+    含多音字词组时整体转换以取得正确读音，否则逐字查表(带缓存，批量索引时快得多)
+    """
+    if _in_phrase(value):
+        return lazy_pinyin(value)
+    parts, other = [], ''
+    for char in value:
+        if _CJK_RE.match(char):
+            if other:
+                parts.append(other)
+                other = ''
+            parts.append(_char_syllable(char))
+        else:
+            other += char
+    if other:
+        parts.append(other)
+    return parts
+
+
+@lru_cache(maxsize=65536)
+def _syllables(value):
+    """汉字转为拼音音节，字母数字保留为单词，其余字符丢弃"""
+    syllables = []
+    for part in _pinyin_parts(value.lower()):
+        if _CJK_RE.search(part):
+            continue
+        syllables.extend(_ASCII_WORD_RE.findall(part))
+    return tuple(syllables)
+
+
+def pinyin_keys(value, field):
+    """全拼和首字母键；作者字段按"；"拆分，每位作者单独生成键"""
+    if lazy_pinyin is None or not value:
+        return set()
+    parts = re.split(r'[；;]', value) if field == 'author' else [value]
+    keys = set()
+    for part in parts:
+        syllables = _syllables(part)
+        if not syllables:
+            continue
+        keys.add(''.join(syllables)[:_KEY_MAX_LENGTH])
+        keys.add(''.join(s[0] for s in syllables)[:_KEY_MAX_LENGTH])
+    return keys
+
+
+def _index_rows(isbn, title, author):
+    grams, keys = [], []
+    for field, value in (('title', title), ('author', author)):
+        grams.extend({'field': field, 'gram': g, 'isbn': isbn} for g in text_grams(value))
+        keys.extend({'field': field, 'key': k, 'isbn': isbn} for k in pinyin_keys(value, field))
+    return grams, keys
+
+
+def index_book(session, isbn, title, author):
+    """在调用方的事务中(重新)索引一本书"""
+    unindex_book(session, isbn)
+    grams, keys = _index_rows(isbn, title, author)
+    _flush_rows(session, grams, keys)
+
+
+def index_books(session, books):
+    """在调用方的事务中批量(重新)索引书籍
+    Args:
+        books: 包含isbn、title、author的字典列表
+    """
+    isbns = [book['isbn'] for book in books]
+    session.execute(delete(BookGram).where(BookGram.isbn.in_(isbns)))
+    session.execute(delete(BookPinyin).where(BookPinyin.isbn.in_(isbns)))
+    grams, keys = [], []
+    for book in books:
+        book_grams, book_keys = _index_rows(book['isbn'], book.get('title'), book.get('author'))
+        grams.extend(book_grams)
+        keys.extend(book_keys)
+    _flush_rows(session, grams, keys)
+
+
+def unindex_book(session, isbn):
+    """在调用方的事务中删除一本书的索引"""
+    session.execute(delete(BookGram).where(BookGram.isbn == isbn))
+    session.execute(delete(BookPinyin).where(BookPinyin.isbn == isbn))
+
+
+def rebuild_search_index(batch_size=1000):
+    """从Book表全量重建检索索引
+    Returns:
+        int: 已索引的书籍数
+    """
+    count = 0
+    with DBSession() as session:
+        session.execute(delete(BookGram))
+        session.execute(delete(BookPinyin))
+        rows = session.query(Book.isbn, Book.title, Book.author)\
+            .order_by(Book.isbn).yield_per(batch_size)
+        grams, keys = [], []
+        for isbn, title, author in rows:
+            book_grams, book_keys = _index_rows(isbn, title, author)
+            grams.extend(book_grams)
+            keys.extend(book_keys)
+            count += 1
+            if count % batch_size == 0:
+                _flush_rows(session, grams, keys)
+                grams, keys = [], []
+        _flush_rows(session, grams, keys)
+    return count
+
+
+def _flush_rows(session, grams, keys):
+    # 使用Core批量插入，避免ORM逐行处理的开销
+    connection = session.connection()
+    if grams:
+        connection.execute(insert(BookGram.__table__), grams)
+    if keys:
+        connection.execute(insert(BookPinyin.__table__), keys)
+
+
+def is_pinyin_query(value):
+    """查询是否为拼音或首字母(纯字母)"""
+    return lazy_pinyin is not None and bool(_PINYIN_QUERY_RE.match(value.lower()))
+
+
+def _prefix_upper_bound(prefix):
+    """前缀范围查询的上界: prefix <= key < upper"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def match_pinyin(session, field, value, conditions=()):
+    """按拼音/首字母前缀检索
+    Args:
+        conditions: Book表上的附加筛选条件
+    Returns:
+        Query: 按相关度排序的ISBN查询，完全匹配优先，键越短越靠前
+    """
+    prefix = value.lower()
+    # 前缀范围内的键都不短于查询，最短键与查询等长即为完全匹配
+    return session.query(Book.isbn)\
+        .join(BookPinyin, BookPinyin.isbn == Book.isbn)\
+        .filter(BookPinyin.field == field,
+                BookPinyin.key >= prefix,
+                BookPinyin.key < _prefix_upper_bound(prefix),
+                *conditions)\
+        .group_by(Book.isbn)\
+        .order_by(func.min(func.length(BookPinyin.key)), Book.isbn)
+
+
+def _gram_term(field, gram=None, char=None):
+    """二元组条件: 等于gram，或(单字)以char开头"""
+    if gram is not None:
+        return and_(BookGram.field == field, BookGram.gram == gram)
+    return and_(BookGram.field == field,
+                BookGram.gram >= char,
+                BookGram.gram < _prefix_upper_bound(char))
+
+
+def _term_size(session, term):
+    """条件命中的索引行数，最多数到GRAM_PROBE_LIMIT"""
+    probe = session.query(BookGram.isbn).filter(term).limit(GRAM_PROBE_LIMIT).subquery()
+    return session.query(func.count()).select_from(probe).scalar()
+
+
+def match_grams(session, field, value, conditions=()):
+    """按二元组检索，要求命中查询中的全部二元组
+    从命中最少的条件取候选，其余二元组按主键逐一确认
+    Args:
+        conditions: Book表上的附加筛选条件
+    Returns:
+        Query: 按相关度排序的ISBN查询，连续包含查询文本的优先，包含位置越靠前、文本越短越靠前；
+            查询中没有可检索的文字时为None
+    """
+    grams = set()
+    single_chars = []
+    for segment in _segments(value):
+        if len(segment) == 1:
+            single_chars.append(segment)
+        else:
+            grams.update(segment[i:i + 2] for i in range(len(segment) - 1))
+    # 单字按前缀命中以该字开头的任意二元组
+    terms = [_gram_term(field, gram=gram) for gram in sorted(grams)]
+    terms += [_gram_term(field, char=char) for char in dict.fromkeys(single_chars)]
+    if not terms:
+        return None
+    if len(terms) > 1:
+        terms.sort(key=lambda term: _term_size(session, term))
+
+    filters = [Book.isbn.in_(session.query(BookGram.isbn).filter(terms[0]).scalar_subquery())]
+    filters += [session.query(BookGram.isbn).filter(BookGram.isbn == Book.isbn, term).exists()
+                for term in terms[1:]]
+    column = Book.title if field == 'title' else Book.author
+    position = func.instr(func.lower(column), ' '.join(_segments(value)))
+    return session.query(Book.isbn)\
+        .filter(*filters, *conditions)\
+        .order_by(position == 0, position, func.length(column), Book.isbn)
+
+
+def index_built(session):
+    """索引是否已建立(已有数据库升级后需全量重建一次)"""
+    return session.query(BookGram.isbn).limit(1).first() is not None
+
+
+def search(session, field, value, limit, offset=0, conditions=()):
+    """检索书名/作者并按相关度排序
+    纯字母查询按拼音/首字母匹配，没有匹配时按二元组匹配；
+    筛选、排序和分页都在数据库中完成，不截断候选
+    conditions: Book表上的附加筛选条件
+    Returns:
+        list: 当前页的ISBN列表，无结果或翻过最后一页时为空列表；
+            索引不能处理该查询(字段未建索引、没有可检索的文字或索引尚未建立)时为None
+    """
+    if field not in INDEXED_FIELDS or not value.strip():
+        return None
+    if is_pinyin_query(value):
+        query = match_pinyin(session, field, value, conditions)
+        isbns = [isbn for (isbn,) in query.offset(offset).limit(limit)]
+        # 拼音有匹配时只是翻过了最后一页，不改用二元组检索
+        if isbns or (offset and session.query(query.exists()).scalar()):
+            return isbns
+
+    query = match_grams(session, field, value, conditions)
+    if query is None:
+        return None
+    isbns = [isbn for (isbn,) in query.offset(offset).limit(limit)]
+    # 只在没有结果时检查，有结果的查询不多一次读取
+    if not isbns and not index_built(session):
+        return None
+    return isbns
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['rebuild']:
+        print('用法: python -m db.search_index rebuild')
+        sys.exit(1)
+    print(f'已索引 {rebuild_search_index()} 本书籍')
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# back/db/serialization.py
+"""书籍序列化
+
+书籍查询使用Core select只取需要的列，返回的行直接转换为字典，不创建ORM对象。
+接口的fields参数指定返回字段(逗号分隔)，也可使用预设:
+    list: 列表页所需的 isbn,title,author,cover_url
+    all: 全部字段(默认)
+"""
+
+from models import Book
+
+BOOK_FIELDS = (
+    'isbn', 'title', 'author', 'translator', 'genre', 'country', 'era',
+    'opac_nlc_class', 'publisher', 'publish_year', 'page', 'cover_url', 'description'
+)
+LIST_FIELDS = ('isbn', 'title', 'author', 'cover_url')
+FIELD_PRESETS = {
+    'list': LIST_FIELDS,
+    'all': BOOK_FIELDS,
+}
+# 为空时返回空字符串的字段(保持接口原有结构)
+_BLANK_FIELDS = frozenset((
+    'translator', 'genre', 'country', 'era', 'opac_nlc_class', 'cover_url', 'description'
+))
+
+
+def parse_fields(fields):
+    """解析返回字段
+    Args:
+        fields: 逗号分隔的字符串、字段列表、预设名称，为空时返回全部字段
+    Returns:
+        tuple: 字段元组，isbn总是位于第一个
+    Raises:
+        ValueError: 含有不支持的字段
+    """
+    if not fields:
+        return BOOK_FIELDS
+    if isinstance(fields, str):
+        if fields in FIELD_PRESETS:
+            return FIELD_PRESETS[fields]
+        fields = fields.split(',')
+    fields = [field.strip() for field in fields if field and field.strip()]
+    invalid = [field for field in fields if field not in BOOK_FIELDS]
+    if invalid:
+        raise ValueError(f'不支持的字段: {", ".join(invalid)}')
+    # 去重并保持顺序
+    fields = [field for field in dict.fromkeys(fields) if field != 'isbn']
+    return ('isbn', *fields)
+
+
+def book_columns(fields):
+    """字段对应的Book表列"""
+    return [Book.__table__.c[field] for field in fields]
+
+
+def row_to_dict(row, fields):
+    """将按fields顺序选取的一行转换为接口返回的字典"""
+    book = dict(zip(fields, row))
+    for field in _BLANK_FIELDS.intersection(book):
+        if book[field] is None:
+            book[field] = ''
+    return book
+
+
+def book_to_dict(book, fields=BOOK_FIELDS):
+    """将Book对象转换为接口返回的字典"""
+    return row_to_dict([getattr(book, field) for field in fields], fields)
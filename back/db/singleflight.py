@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# back/db/singleflight.py
+"""合并同一键的并发调用(singleflight)
+
+多人同时扫码同一本新书时，每个请求都会查询国家图书馆并尝试入库，除一个外都因主键冲突失败。
+SingleFlight按键合并并发调用: 同一进程内第一个调用者(leader)执行函数，其余线程等待同一Future并共享结果或异常；
+跨gunicorn工作进程由文件锁(fcntl.flock)串行化同一键，后拿到锁的进程执行函数时应先检查结果是否已由
+其他进程产生(如书籍已入库、查询缓存已命中)。文件锁按键的哈希分片(LOCK_STRIPES个锁文件)，进程退出时自动释放；
+等待超过lock_timeout后不再等待，直接执行。不支持fcntl的平台只在进程内合并。
+
+配置(环境变量):
+    SINGLEFLIGHT_LOCK_DIR: 锁文件目录(默认为系统临时目录下的book_manage_locks)，设为off只在进程内合并
+    SINGLEFLIGHT_LOCK_TIMEOUT: 等待其他进程的最长秒数(默认30)
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOCK_STRIPES = 256
+DEFAULT_LOCK_TIMEOUT = 30
+# 等待文件锁时的轮询间隔(秒)
+LOCK_POLL_INTERVAL = 0.02
+
+
+class SingleFlight:
+    """按键合并并发调用，线程安全
+    Args:
+        lock_dir: 跨进程文件锁目录，为空时只在进程内合并
+        lock_timeout: 等待文件锁的最长秒数
+    """
+
+    def __init__(self, lock_dir=None, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.lock_timeout = lock_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'shared': 0, 'lock_waits': 0, 'lock_timeouts': 0}
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def do(self, key, fn, *args, **kwargs):
+        """执行fn(*args, **kwargs)，同一键已有调用在执行时等待并返回其结果
+        Raises:
+            与fn相同: leader的异常同样抛给所有等待者
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self._stats['shared'] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            with self._process_lock(key):
+                result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    @contextmanager
+    def _process_lock(self, key):
+        if not self.lock_dir:
+            yield
+            return
+        path = os.path.join(self.lock_dir, f'{zlib.crc32(key.encode("utf-8")) % LOCK_STRIPES:03d}.lock')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        locked = False
+        try:
+            deadline = time.monotonic() + self.lock_timeout
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        logging.warning(f"等待 {key} 的跨进程锁超时，不再等待")
+                        self._count('lock_timeouts')
+                        break
+                    waited = True
+                    time.sleep(LOCK_POLL_INTERVAL)
+            if waited:
+                self._count('lock_waits')
+            yield
+        finally:
+            if locked:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """进程内累计的调用数、共享结果数、等待其他进程的次数和等待超时次数"""
+        with self._lock:
+            return dict(self._stats)
+
+
+def _lock_dir():
+    lock_dir = os.getenv('SINGLEFLIGHT_LOCK_DIR') or os.path.join(tempfile.gettempdir(), 'book_manage_locks')
+    return None if lock_dir.lower() == 'off' else lock_dir
+
+
+# 进程共享的实例，书籍获取与入库共用
+flights = SingleFlight(_lock_dir(), float(os.getenv('SINGLEFLIGHT_LOCK_TIMEOUT') or DEFAULT_LOCK_TIMEOUT))
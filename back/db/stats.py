@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# back/db/stats.py
+"""数据统计
+
+统计接口的数据全部读取汇总表，耗时与书籍数、书架记录数无关:
+    - 按类型/国家/时代/出版社/出版年/页数分段的书籍数: BookFacet(由Book表上的触发器维护，见db/facets.py)
+    - 各用户书架的书籍种数和册数: ShelfStat(由book_tools的书架写操作在同一事务中调用bump_shelf维护)
+    - 书籍总数: Counter
+汇总表偏离实际数据时(如直接修改了数据库)一次性重建: python -m db.stats rebuild
+"""
+
+import sys
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from db import DBSession, counters, facets
+from db.db import begin_immediate
+from models import ShelfStat, User, UserBook
+
+# 按类型/国家/时代统计时最多返回的取值数
+CATEGORY_LIMIT = 50
+TOP_PUBLISHERS = 10
+TOP_SHELVES = 20
+
+
+def bump_shelf(session, user_id, books=0, copies=0):
+    """在调用方的事务中增减用户书架汇总
+    Args:
+        books: 书架记录(书籍种数)的变化量
+        copies: 册数的变化量
+    """
+    statement = insert(ShelfStat).values(user_id=user_id, books=books, copies=copies)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=[ShelfStat.user_id],
+        set_={
+            'books': ShelfStat.books + statement.excluded.books,
+            'copies': ShelfStat.copies + statement.excluded.copies
+        }
+    ))
+
+
+def _insert_shelves():
+    """从UserBook按用户汇总写入ShelfStat的语句"""
+    return insert(ShelfStat).from_select(
+        ['user_id', 'books', 'copies'],
+        select(UserBook.user_id, func.count(UserBook.isbn), func.sum(UserBook.nums))
+        .group_by(UserBook.user_id)
+    )
+
+
+def _rebuild_shelves(session):
+    session.query(ShelfStat).delete(synchronize_session=False)
+    session.execute(_insert_shelves())
+
+
+def init_stats(engine):
+    """书架汇总表为空而书架已有数据时(汇总表新建)从UserBook重建"""
+    with begin_immediate(engine) as conn:
+        if conn.execute(select(ShelfStat.user_id).limit(1)).first() is None \
+                and conn.execute(select(UserBook.user_id).limit(1)).first() is not None:
+            conn.execute(_insert_shelves())
+
+
+def rebuild_stats():
+    """在一个事务中重建全部汇总表(分面计数、书架汇总)，并校正计数缓存
+    Returns:
+        dict: 重建后的书籍总数和有书架数据的用户数
+    """
+    with DBSession() as session:
+        facets.rebuild_facets(conn=session.connection())
+        _rebuild_shelves(session)
+        users = session.query(func.count(ShelfStat.user_id)).scalar()
+    values = counters.reconcile_counters()
+    return {'books': values[counters.BOOKS], 'shelf_users': users}
+
+
+def _counts(rows, key='value'):
+    return [{key: value, 'count': count} for value, count in rows]
+
+
+def _page_ranges(rows):
+    width = facets.PAGE_RANGE_WIDTH
+    return [{
+        'min': start,
+        'max': None if start >= facets.PAGE_RANGE_MAX else start + width - 1,
+        'count': count
+    } for start, count in rows]
+
+
+def get_stats():
+    """读取统计数据
+    Returns:
+        dict: {
+            'books': {
+                'total': 书籍总数,
+                'genre'/'country'/'era': [{'value', 'count'}](按书籍数从多到少),
+                'publish_year': [{'year', 'count'}](按年份),
+                'pages': [{'min', 'max', 'count'}](页数分段，最后一段max为None),
+                'top_publishers': [{'value', 'count'}]
+            },
+            'shelves': {
+                'users': 书架非空的用户数,
+                'books': 书架记录总数,
+                'copies': 总册数,
+                'top': [{'user_id', 'username', 'books', 'copies'}](按册数从多到少)
+            }
+        }
+    """
+    with DBSession() as session:
+        books = {'total': counters.get_count(counters.BOOKS)}
+        for dimension in ('genre', 'country', 'era'):
+            books[dimension] = _counts(facets.read_counts(session, dimension, CATEGORY_LIMIT))
+        books['publish_year'] = _counts(
+            facets.read_counts(session, 'publish_year', by_value=True), key='year'
+        )
+        books['pages'] = _page_ranges(facets.read_counts(session, 'page_range', by_value=True))
+        books['top_publishers'] = _counts(facets.read_counts(session, 'publisher', TOP_PUBLISHERS))
+
+        users, shelf_books, copies = session.execute(
+            select(func.count(ShelfStat.user_id),
+                   func.coalesce(func.sum(ShelfStat.books), 0),
+                   func.coalesce(func.sum(ShelfStat.copies), 0))
+            .where(ShelfStat.books > 0)
+        ).one()
+        top = session.execute(
+            select(ShelfStat.user_id, User.username, ShelfStat.books, ShelfStat.copies)
+            .join(User, User.user_id == ShelfStat.user_id)
+            .where(ShelfStat.books > 0)
+            .order_by(ShelfStat.copies.desc(), ShelfStat.user_id)
+            .limit(TOP_SHELVES)
+        ).all()
+        return {
+            'books': books,
+            'shelves': {
+                'users': users,
+                'books': shelf_books,
+                'copies': copies,
+                'top': [row._asdict() for row in top]
+            }
+        }
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['rebuild']:
+        print('用法: python -m db.stats rebuild')
+        sys.exit(1)
+    result = rebuild_stats()
+    print(f"已重建统计汇总: {result['books']} 本书籍，{result['shelf_users']} 个用户书架")
@@ -8,15 +8,38 @@ project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
 import unittest
+import tempfile
+import threading
 import bcrypt
 from db.book_tools import (
     fetch_book_auto,
     get_book_by_isbn,
     create_book,
     update_book,
-    delete_book
+    delete_book,
+    add_book_to_user,
+    add_books_to_user,
+    remove_book_from_user,
+    get_user_books_count
 )
+from db import DBSession, dispose_engine
+from models import Book, User
 from db.user_tools import authenticate_user, get_user_by_username, delete_user, register_user
+from tools.bookdata import nlc_cache
+
+
+def setUpModule():
+    """国家图书馆查询缓存和本地索引写入临时目录，测试不在项目中留下数据文件"""
+    tmpdir = tempfile.TemporaryDirectory()
+    unittest.addModuleCleanup(tmpdir.cleanup)
+    for name, file in (('NLC_CACHE_PATH', 'nlc_cache.db'), ('NLC_INDEX_PATH', 'nlc_index.db')):
+        old = os.environ.get(name)
+        unittest.addModuleCleanup(lambda name=name, old=old: os.environ.pop(name, None) if old is None
+                                  else os.environ.__setitem__(name, old))
+        os.environ[name] = os.path.join(tmpdir.name, file)
+    # 删除临时目录前合并缓存计数，退出时不再写入
+    unittest.addModuleCleanup(nlc_cache._flush_default)
+
 
 class TestBookTools(unittest.TestCase):
     def setUp(self):
@@ -144,5 +167,468 @@ class TestUserTools(unittest.TestCase):
         with self.assertRaises(ValueError):
             register_user("test_invalid", "plaintext_password")
 
+class TempDatabaseTestCase(unittest.TestCase):
+    """使用临时SQLite数据库的测试(不访问网络): 每个测试前切换DATABASE_URL并重建引擎，结束后恢复并删除数据库"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        old_url = os.environ.get('DATABASE_URL')
+        self.addCleanup(lambda: os.environ.pop('DATABASE_URL', None) if old_url is None
+                        else os.environ.__setitem__('DATABASE_URL', old_url))
+        # 清理按注册的逆序执行: 先释放引擎，再恢复环境变量、删除目录
+        os.environ['DATABASE_URL'] = f'sqlite:///{self.tmpdir.name}/test.db'
+        dispose_engine()
+        self.addCleanup(dispose_engine)
+
+class TestEngine(TempDatabaseTestCase):
+    """连接参数方案和连接池统计"""
+
+    def set_env(self, **env):
+        """设置环境变量并重建引擎，测试结束后恢复"""
+        for name, value in env.items():
+            old = os.environ.get(name)
+            self.addCleanup(lambda name=name, old=old: os.environ.pop(name, None) if old is None
+                            else os.environ.__setitem__(name, old))
+            os.environ[name] = value
+        dispose_engine()
+
+    def test_sqlite_profiles(self):
+        """每个方案的PRAGMA在新建的连接上生效"""
+        from db.db import SQLITE_PROFILES, get_engine
+        expected = {
+            'performance': {'journal_mode': 'wal', 'busy_timeout': 5000, 'synchronous': 1, 'foreign_keys': 1},
+            'compat': {'journal_mode': 'delete', 'synchronous': 2, 'foreign_keys': 1},
+        }
+        self.assertEqual(set(expected), set(SQLITE_PROFILES))
+        for profile, pragmas in expected.items():
+            with self.subTest(profile=profile):
+                self.set_env(DB_SQLITE_PROFILE=profile,
+                             DATABASE_URL=f'sqlite:///{self.tmpdir.name}/{profile}.db')
+                with get_engine().connect() as conn:
+                    for pragma, value in pragmas.items():
+                        self.assertEqual(conn.exec_driver_sql(f'PRAGMA {pragma}').scalar(), value, pragma)
+
+    def test_pool_wait(self):
+        """连接池耗尽时记录等待时间"""
+        from db.db import get_engine, get_pool_stats
+        self.set_env(DB_POOL_SIZE='1', DB_MAX_OVERFLOW='0')
+        engine = get_engine()
+        conn = engine.connect()
+        timer = threading.Timer(0.2, conn.close)
+        timer.start()
+        with engine.connect():
+            pass
+        timer.join()
+        stats = get_pool_stats()
+        self.assertEqual((stats['pool'], stats['size']), ('_TimedQueuePool', 1))
+        self.assertGreaterEqual(stats['checkouts'], 2)
+        self.assertGreaterEqual(stats['wait_max_ms'], 150)
+        self.assertGreaterEqual(stats['wait_total_ms'], stats['wait_max_ms'])
+
+class TestBookshelfConcurrency(TempDatabaseTestCase):
+    """书架并发写入(使用临时数据库，不访问网络)"""
+    isbns = ['9787512666931', '9787519430238']
+
+    def setUp(self):
+        super().setUp()
+        with DBSession() as session:
+            session.add(User(username='shelf_test', password='0' * 64))
+            session.add_all(Book(isbn=isbn, title=f'测试书籍{isbn}') for isbn in self.isbns)
+            session.flush()
+            self.user_id = session.query(User.user_id).filter_by(username='shelf_test').scalar()
+
+    def test_concurrent_add(self):
+        """多线程同时添加同一本书，数量不丢失"""
+        threads, per_thread = 8, 25
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(per_thread):
+                    add_book_to_user(self.isbns[0], self.user_id, 1)
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        self.assertEqual(errors, [])
+        result = add_book_to_user(self.isbns[0], self.user_id, 1)
+        self.assertEqual(result['current_count'], threads * per_thread + 1)
+        self.assertEqual(get_user_books_count(self.user_id), 1)
+
+    def test_bulk_add_and_remove(self):
+        """批量添加、减少数量和移除"""
+        add_book_to_user(self.isbns[0], self.user_id, 2)
+        result = add_books_to_user(self.user_id, [(self.isbns[0], 1), (self.isbns[1], 3), (self.isbns[1], 1)])
+        self.assertEqual(result['counts'], {self.isbns[0]: 3, self.isbns[1]: 4})
+        self.assertEqual(get_user_books_count(self.user_id), 2)
+        with self.assertRaises(ValueError):
+            add_books_to_user(self.user_id, [('9787020002207', 1)])
+
+        self.assertEqual(remove_book_from_user(self.isbns[1], self.user_id, 3)['current_count'], 1)
+        self.assertEqual(remove_book_from_user(self.isbns[1], self.user_id, 5)['current_count'], 0)
+        self.assertEqual(get_user_books_count(self.user_id), 1)
+        remove_book_from_user(self.isbns[0], self.user_id)
+        with self.assertRaises(ValueError):
+            remove_book_from_user(self.isbns[0], self.user_id)
+        self.assertEqual(get_user_books_count(self.user_id), 0)
+
+class TestRequestSession(TempDatabaseTestCase):
+    """请求级会话的保存点与提交(使用临时数据库，不访问网络)"""
+
+    def setUp(self):
+        from flask import Flask, jsonify
+        from db import init_app
+        super().setUp()
+        app = Flask(__name__)
+        init_app(app)
+
+        @app.route('/partial')
+        def partial():
+            create_book({'isbn': '9787512666931', 'title': '边城'})
+            failed = update_book('9787512666931', {'title': None})
+            try:
+                add_book_to_user('9787512666931', 12345, 1)
+            except Exception as e:
+                return jsonify({'success': True, 'update': failed['success'], 'error': type(e).__name__})
+            return jsonify({'success': True})
+
+        self.client = app.test_client()
+
+    def test_nested_failure_keeps_earlier_writes(self):
+        """嵌套调用失败只撤销本层修改，请求中之前的写入在返回响应前提交"""
+        response = self.client.get('/partial')
+        self.assertEqual(response.get_json(), {'success': True, 'update': False, 'error': 'IntegrityError'})
+        self.assertEqual(get_book_by_isbn('9787512666931')['title'], '边城')
+        self.assertEqual(get_user_books_count(12345), 0)
+
+    def test_commit_failure(self):
+        """提交失败时返回5xx，写入不生效"""
+        from unittest import mock
+        from sqlalchemy.exc import OperationalError
+        from sqlalchemy.orm import Session
+        error = OperationalError('COMMIT', {}, Exception('database is locked'))
+        with mock.patch.object(Session, 'commit', side_effect=error):
+            response = self.client.get('/partial')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.get_json()['success'])
+        self.assertIsNone(get_book_by_isbn('9787512666931'))
+
+class TestMigrations(TempDatabaseTestCase):
+    """数据库迁移与查询计划(使用临时数据库，不访问网络)"""
+    # 有意的全表扫描: 用户列表按主键顺序分页；统计接口汇总各用户的书架汇总行
+    allowed_scans = {
+        ('User', 'FROM "User" ORDER BY "User".user_id'),
+        ('ShelfStat', 'FROM "ShelfStat" WHERE "ShelfStat".books >'),
+    }
+
+    def test_schema_matches_models(self):
+        """迁移创建的表和索引与模型定义一致，重复执行不再应用"""
+        from db.db import get_engine
+        from db.migrations import LATEST_VERSION, get_status, migrate
+        from models import Base
+        engine = get_engine()
+        self.assertEqual(migrate(engine), [])
+        raw = engine.raw_connection()
+        try:
+            conn = raw.driver_connection
+            self.assertEqual(get_status(conn)[-1][0], LATEST_VERSION)
+            names = {name for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")}
+        finally:
+            raw.close()
+        for table in Base.metadata.sorted_tables:
+            self.assertIn(table.name, names)
+            for index in table.indexes:
+                self.assertIn(index.name, names)
+
+    def test_unsupported_dialect(self):
+        """非SQLite数据库明确报错，不按模型定义建表"""
+        from types import SimpleNamespace
+        from db.migrations import migrate
+        with self.assertRaisesRegex(RuntimeError, '只支持SQLite'):
+            migrate(SimpleNamespace(dialect=SimpleNamespace(name='mysql')))
+
+    def test_query_plans(self):
+        """book_tools/user_tools执行的查询都使用索引"""
+        from sqlalchemy import event
+        from db import book_tools, user_tools, stats
+        from db.db import get_engine
+        from db.migrations import explain, full_scans
+        engine = get_engine()
+        captured = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+                captured.append((statement, parameters))
+
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            isbns = ['9787512666931', '9787519430238', '9787020002207']
+            for i, isbn in enumerate(isbns):
+                create_book({'isbn': isbn, 'title': f'测试书籍{i}', 'author': '作者', 'genre': '小说',
+                             'publisher': '出版社', 'publish_year': 2000 + i, 'opac_nlc_class': 'I247'})
+            register_user('plan_test', '0' * 64)
+            user_id = get_user_by_username('plan_test').user_id
+            authenticate_user('plan_test', '0' * 64)
+            user_tools.get_all_users(1, 10)
+            book_tools.get_books_by_isbns(isbns)
+            filters = book_tools.parse_filters({'genre': '小说', 'year_min': '2000', 'opac_nlc_class': 'I2'})
+            book_tools.get_all_books(1, 20, filters=filters)
+            book_tools.get_books_count(filters)
+            _, cursor = book_tools.get_books_after(None, 1, 'title')
+            book_tools.get_books_after(cursor, 1)
+            book_tools.search_books('isbn', '978751')
+            book_tools.search_books('title', '测试')
+            update_book(isbns[0], {'title': '新书名', 'genre': '散文'})
+            add_book_to_user(isbns[0], user_id, 2)
+            add_books_to_user(user_id, [(isbns[1], 1)])
+            book_tools.get_user_bookshelf(user_id)
+            remove_book_from_user(isbns[0], user_id, 1)
+            delete_book(isbns[1])
+            remove_book_from_user(isbns[0], user_id)
+            stats.get_stats()
+            delete_user('plan_test')
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+
+        raw = engine.raw_connection()
+        try:
+            for statement, parameters in dict(captured).items():
+                sql = ' '.join(statement.split())
+                for table in full_scans(explain(raw.driver_connection, statement, parameters)):
+                    if not any(table == t and fragment in sql for t, fragment in self.allowed_scans):
+                        self.fail(f'全表扫描 {table}: {sql}')
+        finally:
+            raw.close()
+
+    def test_seed_counters(self):
+        """迁移按已有数据初始化计数，读取不写入，bump在计数行不存在时创建"""
+        from db import counters
+        from db.db import get_engine
+        from db.migrations import apply_migrations
+        from models import Counter
+        create_book({'isbn': '9787512666931', 'title': '测试书籍'})
+        register_user('seed_test', '0' * 64)
+        user_id = get_user_by_username('seed_test').user_id
+        add_book_to_user('9787512666931', user_id, 1)
+        raw = get_engine().raw_connection()
+        try:
+            conn = raw.driver_connection
+            conn.execute('DELETE FROM Counter')
+            conn.execute('DELETE FROM SchemaMigration WHERE version = 4')
+            conn.commit()
+            self.assertEqual(apply_migrations(conn, analyze=False), [4])
+        finally:
+            raw.close()
+        self.assertEqual(counters.get_count(counters.BOOKS), 1)
+        self.assertEqual(counters.get_count(counters.USERS), 1)
+        self.assertEqual(counters.get_count(counters.user_books_key(user_id)), 1)
+        self.assertEqual(counters.get_count(counters.user_books_key(user_id + 1)), 0)
+        with DBSession() as session:
+            self.assertIsNone(session.get(Counter, counters.user_books_key(user_id + 1)))
+            counters.bump(session, counters.user_books_key(user_id + 1), 2)
+        self.assertEqual(counters.get_count(counters.user_books_key(user_id + 1)), 2)
+
+    def test_search_candidates(self):
+        """检索在排序和筛选后才分页，不截断候选"""
+        from db import search_index
+        from db.book_tools import parse_filters, search_books
+        from models import Book
+        books = [{'isbn': f'978{i:010d}', 'title': f'中国故事第{i}卷', 'author': '作者',
+                  'genre': '小说' if i % 600 else '历史'} for i in range(1500)]
+        books.append({'isbn': '9799999999999', 'title': '中国', 'author': '作者', 'genre': '小说'})
+        with DBSession() as session:
+            session.bulk_insert_mappings(Book, books)
+            search_index.index_books(session, books)
+        self.assertEqual(search_books('title', '中国', per_page=1)[0]['isbn'], '9799999999999')
+        history = search_books('title', '中国', filters=parse_filters({'genre': '历史'}))
+        self.assertEqual([book['isbn'] for book in history], ['9780000000000', '9780000000600', '9780000001200'])
+        self.assertEqual(len(search_books('title', '中国', page=15, per_page=100)), 100)
+        self.assertEqual(len(search_books('title', 'zgg', page=15, per_page=100)), 100)
+
+    def test_search_pagination(self):
+        """翻过最后一页时直接返回索引的空结果，不改用全文索引或LIKE；索引尚未建立时才改用"""
+        from sqlalchemy import event
+        from db import search_index
+        from db.book_tools import search_books
+        from db.db import get_engine
+        from models import BookGram, BookPinyin
+        books = [{'isbn': f'978{i:010d}', 'title': f'中国故事第{i}卷', 'author': '作者'} for i in range(5)]
+        with DBSession() as session:
+            session.bulk_insert_mappings(Book, books)
+            search_index.index_books(session, books)
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(get_engine(), 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, get_engine(), 'before_cursor_execute', listener)
+
+        pages = [search_books('title', '中国故事', page=page, per_page=2) for page in (1, 2, 3)]
+        self.assertEqual([book['isbn'] for page in pages for book in page], [book['isbn'] for book in books])
+        with self.assertRaises(Exception):
+            search_books('title', '中国故事', page=4, per_page=2)
+        self.assertFalse([sql for sql in statements if ' LIKE ' in sql or ' MATCH ' in sql])
+
+        with DBSession() as session:
+            session.query(BookGram).delete()
+            session.query(BookPinyin).delete()
+        self.assertEqual(len(search_books('title', '中国故事', per_page=10)), 5)
+
+class TestCounters(TempDatabaseTestCase):
+    """计数随写操作增减，校正后与实际数据一致"""
+    isbns = ['9787512666931', '9787519430238']
+
+    def setUp(self):
+        super().setUp()
+        register_user('counter_test', '0' * 64)
+        self.user_id = get_user_by_username('counter_test').user_id
+        for isbn in self.isbns:
+            create_book({'isbn': isbn, 'title': f'测试书籍{isbn}'})
+
+    def counts(self):
+        from db import counters
+        return (counters.get_count(counters.BOOKS), counters.get_count(counters.USERS),
+                get_user_books_count(self.user_id))
+
+    def drift(self):
+        """直接改写计数行，模拟与实际数据不一致"""
+        from models import Counter
+        with DBSession() as session:
+            session.query(Counter).filter_by(name='books').update({'value': 99})
+            session.query(Counter).filter_by(name='users').delete()
+            session.merge(Counter(name=f'user_books:{self.user_id}', value=-3))
+
+    def test_counts(self):
+        """添加、移除书架书籍和删除书籍后计数准确"""
+        self.assertEqual(self.counts(), (2, 1, 0))
+        add_book_to_user(self.isbns[0], self.user_id, 2)
+        add_book_to_user(self.isbns[1], self.user_id, 1)
+        add_book_to_user(self.isbns[0], self.user_id, 1)
+        self.assertEqual(self.counts(), (2, 1, 2))
+        remove_book_from_user(self.isbns[0], self.user_id, 1)
+        self.assertEqual(self.counts(), (2, 1, 2))
+        remove_book_from_user(self.isbns[0], self.user_id)
+        self.assertEqual(self.counts(), (2, 1, 1))
+        delete_book(self.isbns[1])
+        self.assertEqual(self.counts(), (1, 1, 0))
+
+    def test_reconcile(self):
+        """reconcile_counters和后台校正线程修正偏差"""
+        import time
+        from db.counters import reconcile_counters, start_reconciler
+        add_book_to_user(self.isbns[0], self.user_id, 3)
+        self.drift()
+        self.assertEqual(self.counts(), (99, 0, -3))
+        reconcile_counters()
+        self.assertEqual(self.counts(), (2, 1, 1))
+
+        self.drift()
+        stop = start_reconciler(0.05)
+        self.addCleanup(stop.set)
+        deadline = time.monotonic() + 5
+        while self.counts() != (2, 1, 1) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.counts(), (2, 1, 1))
+
+class TestFts(TempDatabaseTestCase):
+    """全文索引随Book的增删改同步"""
+    isbn = '9787512666931'
+
+    def setUp(self):
+        super().setUp()
+        from db.db import get_engine
+        from db.fts import fts_available
+        get_engine()
+        if not fts_available():
+            self.skipTest('SQLite不支持FTS5 trigram')
+
+    def match(self, value):
+        from sqlalchemy import text
+        from db.fts import FTS_TABLE, build_match_query
+        with DBSession() as session:
+            return [isbn for (isbn,) in session.execute(
+                text(f'SELECT Book.isbn FROM {FTS_TABLE} JOIN Book ON Book.rowid = {FTS_TABLE}.rowid '
+                     f'WHERE {FTS_TABLE} MATCH :query'),
+                {'query': build_match_query(('title', 'author'), value)}
+            )]
+
+    def test_triggers(self):
+        """新增、改名、删除后MATCH的结果随之变化"""
+        create_book({'isbn': self.isbn, 'title': '边城集', 'author': '沈从文'})
+        self.assertEqual(self.match('边城集'), [self.isbn])
+        self.assertEqual(self.match('沈从文'), [self.isbn])
+        update_book(self.isbn, {'title': '湘行散记'})
+        self.assertEqual(self.match('边城集'), [])
+        self.assertEqual(self.match('湘行散'), [self.isbn])
+        self.assertEqual(self.match('沈从文'), [self.isbn])
+        delete_book(self.isbn)
+        self.assertEqual(self.match('湘行散'), [])
+
+    def test_short_query(self):
+        """trigram不能匹配不足3个字符的查询，检索索引尚未建立时改用LIKE查询"""
+        from sqlalchemy import event
+        from db.book_tools import search_books
+        from db.db import get_engine
+        from models import BookGram, BookPinyin
+        create_book({'isbn': self.isbn, 'title': '边城集', 'author': '沈从文'})
+        with DBSession() as session:
+            session.query(BookGram).delete()
+            session.query(BookPinyin).delete()
+        self.assertEqual(self.match('边城'), [])
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(get_engine(), 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, get_engine(), 'before_cursor_execute', listener)
+        self.assertEqual([book['isbn'] for book in search_books('title', '边城')], [self.isbn])
+        self.assertTrue(any(' LIKE ' in sql for sql in statements))
+        self.assertFalse(any(' MATCH ' in sql for sql in statements))
+        statements.clear()
+        self.assertEqual([book['isbn'] for book in search_books('title', '边城集')], [self.isbn])
+        self.assertTrue(any(' MATCH ' in sql for sql in statements))
+
+class TestBulkImport(TempDatabaseTestCase):
+    """批量导入"""
+
+    def test_partial_columns(self):
+        """已存在的书籍只更新导入文件中有值的列，新增数和更新数准确"""
+        import io
+        from db import counters
+        from db.book_tools import get_books_count, search_books
+        from db.bulk_import import import_books
+        create_book({'isbn': '9787512666931', 'title': '边城', 'author': '沈从文', 'publisher': '出版社',
+                     'publish_year': 2002, 'page': 200})
+        version = counters.get_count(counters.CATALOG_VERSION)
+        report = import_books(io.StringIO('isbn,title\n9787512666931,边城(新版)\n9787519430238,牛虻\n'), 'csv')
+        self.assertEqual((report['inserted'], report['updated'], report['rejected']), (1, 1, 0))
+        book = get_book_by_isbn('9787512666931')
+        self.assertEqual(book['title'], '边城(新版)')
+        self.assertEqual((book['author'], book['publisher'], book['publish_year'], book['page']),
+                         ('沈从文', '出版社', 2002, 200))
+        self.assertEqual(get_books_count(), 2)
+        self.assertEqual(counters.get_count(counters.CATALOG_VERSION), version + 1)
+        # 未导入的作者仍在检索索引中
+        self.assertEqual(search_books('author', '沈从文')[0]['isbn'], '9787512666931')
+
+        report = import_books(io.StringIO('[{"isbn": "9787519430238", "title": "牛虻", "page": "208页"}]'), 'json')
+        self.assertEqual((report['inserted'], report['updated']), (0, 1))
+        self.assertEqual(get_book_by_isbn('9787519430238')['page'], 208)
+        self.assertEqual(get_books_count(), 2)
+
+    def test_concurrent_counts(self):
+        """多个线程同时导入相同的ISBN，新增数合计等于实际新增的书籍数"""
+        from concurrent.futures import ThreadPoolExecutor
+        from db.book_tools import get_books_count
+        from db.bulk_import import write_books
+        books = {f'978{n:010d}': {'isbn': f'978{n:010d}', 'title': f'书{n}'} for n in range(50)}
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: write_books(dict(books)), range(4)))
+        self.assertEqual(sum(inserted for inserted, _ in results), 50)
+        self.assertEqual(sum(updated for _, updated in results), 150)
+        self.assertEqual(get_books_count(), 50)
+
 if __name__ == '__main__':
     unittest.main()
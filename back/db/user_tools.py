@@ -2,7 +2,7 @@
 # back/db/user_tools.py
 
 from models import User
-from db import DBSession
+from db import DBSession, savepoint, counters
 
 def authenticate_user(username, password):
     """验证用户凭据"""
@@ -67,10 +67,13 @@ def register_user(username, hashed_password, role='user'):
             
             # 创建新用户
             user = User(username=username, password=hashed_password, role=role)
-            session.add(user)
             
             try:
-                session.commit()
+                # 在保存点中插入，失败时只撤销本次注册，请求中之前的写入保留
+                with savepoint(session):
+                    session.add(user)
+                    session.flush()
+                    counters.bump(session, counters.USERS, 1)
                 session.refresh(user)
                 if user in session:
                     return user
@@ -79,8 +82,7 @@ def register_user(username, hashed_password, role='user'):
                     return session.query(User).get(user.user_id)
             except Exception as commit_error:
                 print(f"提交失败: {str(commit_error)}")
-                session.rollback()
-                print("事务已回滚")
+                print("事务已回滚到保存点")
                 
                 # 检查是否是唯一约束违反
                 if "UNIQUE constraint failed" in str(commit_error):
@@ -114,8 +116,12 @@ def delete_user(username):
         if not user:
             return False
             
+        user_id = user.user_id
         session.delete(user)
-        session.commit()
+        session.flush()
+        counters.bump(session, counters.USERS, -1)
+        counters.drop(session, counters.user_books_key(user_id))
+        counters.drop(session, counters.shelf_version_key(user_id))
         return True
 
 def get_all_users(page=1, per_page=10):
@@ -134,8 +140,8 @@ def get_all_users(page=1, per_page=10):
         users = session.query(User).order_by(User.user_id)\
             .offset(offset).limit(per_page).all()
             
-        # 获取总数
-        total = session.query(User).count()
+        # 获取总数(读取计数缓存)
+        total = counters.get_count(counters.USERS)
         
         return users, total
 
@@ -167,7 +173,7 @@ def update_user(user_id, update_data):
         if 'password' in update_data:
             user.set_password(update_data['password'])
         
-        session.commit()
+        session.flush()
         
         return {
             'user_id': user.user_id,
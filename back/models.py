@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 # back/models.py
 
-from sqlalchemy import Column, Integer, String, ForeignKey, CheckConstraint
+from sqlalchemy import Column, Float, Integer, String, ForeignKey, CheckConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 import hashlib
 
+# 表结构由db/migrations.py中的迁移创建，修改模型时需追加相应的迁移
 Base = declarative_base()
 
 class User(Base):
@@ -24,6 +25,7 @@ class User(Base):
         CheckConstraint('length(username) BETWEEN 4 AND 20', name='check_username_length'),
         CheckConstraint('length(password) = 64', name='check_password_length'),  # sha256哈希固定64字符
         CheckConstraint("role IN ('admin', 'user')", name='check_role_values'),
+        Index('ix_user_role', 'role'),
     )
 
     def set_password(self, hashed_password):
@@ -91,6 +93,17 @@ class Book(Base):
         CheckConstraint('length(isbn) BETWEEN 10 AND 13', name='check_isbn_length'),
         CheckConstraint('publish_year BETWEEN 1800 AND 2100', name='check_publish_year'),
         CheckConstraint('page > 0', name='check_page_positive'),
+        # 按书名键集分页
+        Index('ix_book_title_isbn', 'title', 'isbn'),
+        # 按作者等值查询
+        Index('ix_book_author_isbn', 'author', 'isbn'),
+        # 按分面筛选，带isbn可按ISBN顺序分页而无需排序
+        Index('ix_book_genre_isbn', 'genre', 'isbn'),
+        Index('ix_book_country_isbn', 'country', 'isbn'),
+        Index('ix_book_era_isbn', 'era', 'isbn'),
+        Index('ix_book_publisher_isbn', 'publisher', 'isbn'),
+        Index('ix_book_publish_year_isbn', 'publish_year', 'isbn'),
+        Index('ix_book_opac_nlc_class_isbn', 'opac_nlc_class', 'isbn'),
     )
 
 class UserBook(Base):
@@ -107,8 +120,85 @@ class UserBook(Base):
     
     __table_args__ = (
         CheckConstraint('nums > 0', name='check_nums_positive'),
+        # 按isbn查找书架记录，覆盖user_id和nums
+        Index('ix_userbook_isbn', 'isbn', 'user_id', 'nums'),
     )
 
-def init_models(engine):
-    """初始化模型，创建所有表"""
-    Base.metadata.create_all(engine)
+class Counter(Base):
+    """计数缓存模型，保存书籍、用户、用户书架等总数"""
+    __tablename__ = 'Counter'
+
+    name = Column(String(64), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+class BookFacet(Base):
+    """分面计数，由Book表上的触发器增量维护(见db/facets.py)"""
+    __tablename__ = 'BookFacet'
+
+    dimension = Column(String(20), primary_key=True)
+    value = Column(String(100), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_bookfacet_dimension_count', 'dimension', 'count'),
+        {'sqlite_with_rowid': False},
+    )
+
+class ShelfStat(Base):
+    """用户书架汇总(书籍种数、册数)，由书架写操作在同一事务中增量维护(见db/stats.py)"""
+    __tablename__ = 'ShelfStat'
+
+    user_id = Column(Integer, ForeignKey('User.user_id', ondelete="CASCADE"), primary_key=True)
+    books = Column(Integer, nullable=False, default=0)
+    copies = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_shelfstat_copies', 'copies'),
+    )
+
+class EnrichJob(Base):
+    """书籍信息补全任务，每个ISBN一条(见db/enrich_queue.py)"""
+    __tablename__ = 'EnrichJob'
+
+    isbn = Column(String(13), primary_key=True)
+    # pending/running/done/not_found/failed
+    status = Column(String(10), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    # 下次执行时间(Unix时间戳)，执行中为租约到期时间
+    run_at = Column(Float, nullable=False)
+    error = Column(String(255))
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+    __table_args__ = (
+        CheckConstraint("status IN ('pending', 'running', 'done', 'not_found', 'failed')",
+                        name='check_enrich_status'),
+        Index('ix_enrichjob_status_run_at', 'status', 'run_at'),
+        {'sqlite_with_rowid': False},
+    )
+
+class BookGram(Base):
+    """书名/作者字符二元组倒排索引"""
+    __tablename__ = 'BookGram'
+
+    field = Column(String(10), primary_key=True)  # 'title' or 'author'
+    gram = Column(String(2), primary_key=True)
+    isbn = Column(String(13), ForeignKey('Book.isbn', ondelete="CASCADE"), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_bookgram_isbn', 'isbn'),
+        {'sqlite_with_rowid': False},
+    )
+
+class BookPinyin(Base):
+    """书名/作者全拼与首字母索引"""
+    __tablename__ = 'BookPinyin'
+
+    field = Column(String(10), primary_key=True)  # 'title' or 'author'
+    key = Column(String(255), primary_key=True)
+    isbn = Column(String(13), ForeignKey('Book.isbn', ondelete="CASCADE"), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_bookpinyin_isbn', 'isbn'),
+        {'sqlite_with_rowid': False},
+    )
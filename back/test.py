@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""接口测试(使用临时数据库和Flask测试客户端，不访问网络)"""
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+os.environ.setdefault('SECRET_KEY', 'test-secret')
+os.environ.setdefault('ALLOWED_ORIGINS', 'http://localhost')
+
+import unittest
+
+import jwt
+from flask.json.provider import DefaultJSONProvider
+
+from app import app
+from db import DBSession
+from db import test as db_test
+from db.book_tools import add_book_to_user, create_book, delete_book, remove_book_from_user, update_book
+from models import User
+from tools.json_provider import FastJSONProvider, dumps_bytes
+
+
+class ApiTestCase(db_test.TempDatabaseTestCase):
+    """接口测试基类: 临时数据库中有一个角色为role的用户，self.headers为其认证头"""
+    role = 'user'
+
+    def setUp(self):
+        super().setUp()
+        app.testing = True
+        self.client = app.test_client()
+        with DBSession() as session:
+            session.add(User(username='api_test', password='0' * 64, role=self.role))
+        with DBSession() as session:
+            self.user_id = session.query(User.user_id).filter_by(username='api_test').scalar()
+        token = jwt.encode({'user_id': self.user_id, 'exp': datetime.utcnow() + timedelta(hours=1)},
+                           app.config['SECRET_KEY'], algorithm='HS256')
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+
+class TestBookshelfApi(ApiTestCase):
+    isbn = '9787512666931'
+
+    def test_remove_quantity(self):
+        """无效的数量返回400且不修改书架，数量不小于现有数量时移除整条记录，不在书架中返回404"""
+        create_book({'isbn': self.isbn, 'title': '边城'})
+        add_book_to_user(self.isbn, self.user_id, 3)
+        for quantity in ('abc', '-1', '0', '1.5', ''):
+            response = self.client.delete(f'/api/bookshelf/{self.isbn}?quantity={quantity}', headers=self.headers)
+            self.assertEqual(response.status_code, 400, quantity)
+        response = self.client.delete(f'/api/bookshelf/{self.isbn}?quantity=1', headers=self.headers)
+        self.assertEqual(response.get_json()['current_count'], 2)
+        response = self.client.delete(f'/api/bookshelf/{self.isbn}?quantity=5', headers=self.headers)
+        self.assertEqual(response.get_json()['current_count'], 0)
+        response = self.client.delete(f'/api/bookshelf/{self.isbn}', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_etag(self):
+        """书架和书籍未变化时返回304，修改书架或书籍后ETag改变"""
+        create_book({'isbn': self.isbn, 'title': '边城'})
+        add_book_to_user(self.isbn, self.user_id, 1)
+
+        def get(etag=None, query=''):
+            headers = dict(self.headers, **({'If-None-Match': etag} if etag else {}))
+            return self.client.get(f'/api/bookshelf/books{query}', headers=headers)
+
+        response = get()
+        self.assertEqual(response.status_code, 200)
+        etag = response.get_etag()[0]
+        self.assertTrue(etag)
+        response = get(etag)
+        self.assertEqual((response.status_code, response.get_data()), (304, b''))
+        self.assertEqual(response.get_etag()[0], etag)
+        self.assertNotEqual(get(query='?per_page=5').get_etag()[0], etag)
+
+        add_book_to_user(self.isbn, self.user_id, 1)
+        response = get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['items'][0]['nums'], 2)
+        self.assertNotEqual(response.get_etag()[0], etag)
+        etag = response.get_etag()[0]
+        update_book(self.isbn, {'title': '边城(新版)'})
+        response = get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.get_etag()[0], etag)
+
+
+class TestJsonProvider(unittest.TestCase):
+    """orjson编码与Flask默认实现输出相同的值"""
+    data = {
+        'created_at': datetime(2024, 1, 2, 3, 4, 5),
+        'published': date(2024, 1, 2),
+        'price': Decimal('39.80'),
+        'title': '活着, "余华"',
+        'tags': [None, True, 1.5],
+    }
+
+    def test_round_trip(self):
+        expected = DefaultJSONProvider(app).loads(DefaultJSONProvider(app).dumps(self.data))
+        self.assertEqual(expected['created_at'], 'Tue, 02 Jan 2024 03:04:05 GMT')
+        self.assertEqual(expected['price'], '39.80')
+        provider = FastJSONProvider(app)
+        self.assertEqual(provider.loads(provider.dumps(self.data)), expected)
+        self.assertEqual(provider.loads(dumps_bytes(self.data)), expected)
+        # 中文不转义为\uXXXX
+        self.assertIn('活着'.encode('utf-8'), dumps_bytes(self.data))
+
+    def test_response(self):
+        with app.app_context():
+            response = FastJSONProvider(app).response(self.data)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.get_json()['price'], '39.80')
+
+
+class TestBooksApi(ApiTestCase):
+
+    def test_fields(self):
+        """fields参数只返回所选字段(isbn总是返回)，不支持的字段返回400"""
+        create_book({'isbn': '9787506365437', 'title': '活着', 'author': '余华', 'publisher': '作家出版社'})
+        response = self.client.get('/api/books?fields=title,author', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        items = response.get_json()['items']
+        self.assertEqual(items, [{'isbn': '9787506365437', 'title': '活着', 'author': '余华'}])
+        self.assertEqual(list(items[0]), ['isbn', 'title', 'author'])
+        response = self.client.get('/api/books?fields=title,password', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_cursor(self):
+        """键集分页: 排序键重复时逐页遍历不重复不遗漏，篡改的游标返回400"""
+        titles = ['同名'] * 5 + ['边城', '呐喊']
+        books = [{'isbn': f'978750000000{i}', 'title': title} for i, title in enumerate(titles)]
+        for book in reversed(books):
+            create_book(book)
+        for sort, key in (('title', lambda book: (book['title'], book['isbn'])), ('isbn', lambda book: book['isbn'])):
+            seen, cursor = [], ''
+            while cursor is not None:
+                response = self.client.get(f'/api/books?cursor={cursor}&sort={sort}&per_page=2&fields=title',
+                                           headers=self.headers)
+                self.assertEqual(response.status_code, 200)
+                data = response.get_json()
+                self.assertLessEqual(len(data['items']), 2)
+                seen += data['items']
+                cursor = data['next_cursor']
+            self.assertEqual(seen, sorted(books, key=key), sort)
+
+        def encode(raw):
+            return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+        for cursor in ('abc', '游标', encode('["title","同名"]'), encode('["password","x"]'),
+                       encode('{"0":"isbn"}'), encode('5')):
+            response = self.client.get(f'/api/books?cursor={cursor}', headers=self.headers)
+            self.assertEqual(response.status_code, 400, cursor)
+
+
+
+class TestFacetsApi(ApiTestCase):
+
+    def facets(self):
+        response = self.client.get('/api/books/facets?dimensions=genre,publish_year,opac_nlc_class')
+        self.assertEqual(response.status_code, 200)
+        return {dimension: {item['value']: item['count'] for item in items}
+                for dimension, items in response.get_json().items()}
+
+    def test_counts(self):
+        """插入、修改、删除书籍后分面计数随之变化，计数为0的取值不返回"""
+        create_book({'isbn': '9787512666931', 'title': '边城', 'genre': '小说', 'publish_year': 2002,
+                     'opac_nlc_class': 'I246.5'})
+        create_book({'isbn': '9787519430238', 'title': '牛虻', 'genre': '小说', 'publish_year': 2002,
+                     'opac_nlc_class': 'i561.44'})
+        create_book({'isbn': '9787020002207', 'title': '史记', 'genre': '历史', 'opac_nlc_class': 'K204.2'})
+        self.assertEqual(self.facets(), {
+            'genre': {'小说': 2, '历史': 1},
+            'publish_year': {2002: 2},
+            'opac_nlc_class': {'I': 2, 'K': 1},
+        })
+        update_book('9787519430238', {'genre': '历史', 'publish_year': 1990})
+        self.assertEqual(self.facets()['genre'], {'小说': 1, '历史': 2})
+        self.assertEqual(self.facets()['publish_year'], {2002: 1, 1990: 1})
+        delete_book('9787512666931')
+        self.assertEqual(self.facets(), {
+            'genre': {'历史': 2},
+            'publish_year': {1990: 1},
+            'opac_nlc_class': {'I': 1, 'K': 1},
+        })
+        response = self.client.get('/api/books/facets?dimensions=password')
+        self.assertEqual(response.status_code, 400)
+
+
+
+class TestExportApi(ApiTestCase):
+    role = 'admin'
+    books = [
+        {'isbn': '9787020024759', 'title': '围城, "新版"', 'author': '钱锺书'},
+        {'isbn': '9787506365437', 'title': '活着', 'author': '余华, 著'},
+    ]
+
+    def export(self, query):
+        response = self.client.get(f'/api/books/export?{query}', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_csv(self):
+        """CSV按fields的顺序输出表头，书名中的逗号和引号正确转义，可被csv模块还原"""
+        for book in reversed(self.books):
+            create_book(book)
+        response = self.export('format=csv&fields=title,author')
+        self.assertEqual(response.mimetype, 'text/csv')
+        text = response.get_data().decode('utf-8')
+        self.assertTrue(text.startswith('\ufeffisbn,title,author\r\n'))
+        self.assertIn('9787020024759,"围城, ""新版""",钱锺书\r\n', text)
+        rows = list(csv.DictReader(io.StringIO(text.lstrip('\ufeff'))))
+        self.assertEqual(rows, self.books)
+
+    def test_ndjson(self):
+        """NDJSON每行一本书，按ISBN排序，压缩后内容相同"""
+        for book in reversed(self.books):
+            create_book(book)
+        body = self.export('format=ndjson&fields=title,author').get_data()
+        self.assertEqual([json.loads(line) for line in body.splitlines()], self.books)
+        self.assertIn('围城'.encode('utf-8'), body)
+        compressed = self.export('format=ndjson&fields=title,author&gzip=1')
+        self.assertEqual(compressed.mimetype, 'application/gzip')
+        self.assertEqual(gzip.decompress(compressed.get_data()), body)
+        response = self.client.get('/api/books/export?format=xml', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+
+
+class TestStatsApi(ApiTestCase):
+    role = 'admin'
+
+    def shelves(self):
+        response = self.client.get('/api/stats', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['shelves']
+
+    def test_shelves(self):
+        """添加、部分移除、全部移除书架书籍后书架汇总准确"""
+        create_book({'isbn': '9787512666931', 'title': '边城', 'page': 120})
+        create_book({'isbn': '9787519430238', 'title': '牛虻', 'page': 1500})
+        pages = self.client.get('/api/stats', headers=self.headers).get_json()['books']['pages']
+        self.assertEqual(pages, [{'min': 100, 'max': 199, 'count': 1}, {'min': 1000, 'max': None, 'count': 1}])
+
+        add_book_to_user('9787512666931', self.user_id, 3)
+        add_book_to_user('9787519430238', self.user_id, 1)
+        self.assertEqual(self.shelves(), {'users': 1, 'books': 2, 'copies': 4, 'top': [
+            {'user_id': self.user_id, 'username': 'api_test', 'books': 2, 'copies': 4}]})
+        remove_book_from_user('9787512666931', self.user_id, 2)
+        self.assertEqual(self.shelves()['top'], [
+            {'user_id': self.user_id, 'username': 'api_test', 'books': 2, 'copies': 2}])
+        remove_book_from_user('9787512666931', self.user_id)
+        self.assertEqual((self.shelves()['books'], self.shelves()['copies']), (1, 1))
+        remove_book_from_user('9787519430238', self.user_id, 5)
+        self.assertEqual(self.shelves(), {'users': 0, 'books': 0, 'copies': 0, 'top': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,9 @@
 
 import json
 import re
-from .nlc_isbn import get_book_info, validate_isbn
+from .nlc_isbn import (
+    NlcUnavailable, get_book_info, lookup_book_info, validate_isbn, canonical, isbn10_to_isbn13, isbn13_to_isbn10
+)
 
 
 def get_book_data(book_data):
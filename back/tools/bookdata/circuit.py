@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# circuit.py
+"""上游服务熔断器
+
+国家图书馆响应缓慢或不可用时，每次查询都要等到超时，线程池很快全部阻塞在失效的连接上。
+熔断器按上游主机统计连续失败(网络错误、超时、5xx)次数:
+    - closed(正常): 连续失败达到failure_threshold次后转为open
+    - open(熔断): 直接拒绝调用(快速失败)，reset_timeout秒后转为half_open
+    - half_open(试探): 只放行half_open_max个试探调用，成功则恢复closed，失败则重新open
+状态变化写入日志，状态、转换次数、拒绝次数等由metrics()导出。
+
+配置(环境变量，作用于get_breaker创建的熔断器):
+    NLC_BREAKER_THRESHOLD: 连续失败多少次后熔断(默认5)
+    NLC_BREAKER_RESET: 熔断后多少秒开始试探(默认30)
+"""
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+
+class CircuitOpenError(Exception):
+    """熔断期间被拒绝的调用"""
+
+
+class CircuitBreaker:
+    """熔断器，线程安全
+    Args:
+        name: 名称(上游主机)，用于日志
+        failure_threshold: 连续失败多少次后熔断
+        reset_timeout: 熔断后多少秒开始试探
+        half_open_max: 试探状态下同时放行的调用数
+    """
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, half_open_max=1):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.half_open_max = max(1, half_open_max)
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self._metrics = {'successes': 0, 'failures': 0, 'rejected': 0, 'transitions': {}}
+
+    def _transition(self, state):
+        key = f'{self.state}->{state}'
+        self._metrics['transitions'][key] = self._metrics['transitions'].get(key, 0) + 1
+        logger.warning(f"{self.name} 熔断器: {self.state} -> {state}")
+        self.state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state != HALF_OPEN:
+            self._probes = 0
+
+    def allow(self):
+        """是否放行一次调用；放行后必须调用record_success或record_failure"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self._probes < self.half_open_max:
+                self._probes += 1
+                return True
+            self._metrics['rejected'] += 1
+            return False
+
+    def retry_after(self):
+        """熔断状态下距离开始试探的秒数"""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self._metrics['successes'] += 1
+            self._failures = 0
+            if self.state == HALF_OPEN:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._metrics['failures'] += 1
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                self._transition(OPEN)
+
+    def call(self, fn, *args, **kwargs):
+        """通过熔断器调用fn，fn抛出的异常均计为失败
+        Raises:
+            CircuitOpenError: 熔断中
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} 熔断中，{self.retry_after():.0f}秒后重试")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def metrics(self):
+        """熔断器指标
+        Returns:
+            dict: {'state', 'consecutive_failures', 'successes', 'failures', 'rejected',
+                   'transitions': {'closed->open': 次数, ...}, 'retry_after'}
+        """
+        retry_after = self.retry_after()
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self._failures,
+                'successes': self._metrics['successes'],
+                'failures': self._metrics['failures'],
+                'rejected': self._metrics['rejected'],
+                'transitions': dict(self._metrics['transitions']),
+                'retry_after': round(retry_after, 3)
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    """进程内按上游主机共享的熔断器，按环境变量配置"""
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(
+                host,
+                failure_threshold=int(os.getenv('NLC_BREAKER_THRESHOLD') or DEFAULT_FAILURE_THRESHOLD),
+                reset_timeout=float(os.getenv('NLC_BREAKER_RESET') or DEFAULT_RESET_TIMEOUT)
+            )
+        return breaker
+
+
+def all_metrics():
+    """进程内所有熔断器的指标 {主机: 指标}"""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {host: breaker.metrics() for host, breaker in breakers.items()}
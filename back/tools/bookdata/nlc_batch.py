@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# nlc_batch.py
+"""国家图书馆批量查询
+
+isbn2meta逐个串行查询。批量查询时由线程池并发执行，
+并发数可配置；同一主机的请求经令牌桶限速，网络错误和429/5xx响应按带随机抖动的指数退避重试，
+结果按完成顺序逐条产出，调用方可边查询边入库。
+各查询线程经同一个NlcClient(nlc_client.py)检索，共用其会话URL和keep-alive连接池。
+与单本查询一样，每本书的查询(含重试和退避)有总时限，并经按主机共享的熔断器执行。
+
+配置(环境变量):
+    NLC_BASE_URL: 国家图书馆OPAC地址(默认 http://opac.nlc.cn/F，测试时可指向本地服务)
+    NLC_BATCH_WORKERS: 并发查询数(默认4)
+    NLC_RATE_LIMIT: 每个主机每秒最多请求数(默认2，0表示不限速)
+    NLC_RETRIES: 失败后的最大重试次数(默认3)
+    NLC_DEADLINE: 每本书查询的总时限秒数(默认15)
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from urllib.parse import urlsplit
+
+from .circuit import CircuitOpenError, get_breaker
+from .nlc_client import DEFAULT_DEADLINE, DeadlineExceeded, NlcClient
+from .nlc_index import offline_enabled
+from .nlc_isbn import BASE_URL, NlcUnavailable, validate_isbn
+
+logger = logging.getLogger(__name__)
+
+# 视为临时故障、可以重试的HTTP状态码
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def _retryable(error):
+    """网络错误、限流、服务端错误和会话失效可以重试，超出时限和其他HTTP错误不重试"""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    return getattr(error, 'status', None) in (None, *RETRY_STATUS)
+
+
+class RateLimiter:
+    """按主机限速的令牌桶，线程安全
+    Args:
+        rate: 每个主机每秒最多请求数，小于等于0时不限速
+        burst: 允许的突发请求数
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._buckets = {}  # 主机 -> (剩余令牌数, 上次更新时间)
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        """取得一个令牌，必要时等待"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            # 令牌数可以为负，表示已预约的请求，后来者依次排队
+            tokens -= 1
+            self._buckets[host] = (tokens, now)
+            delay = -tokens / self.rate if tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _env_number(name, default, cast=int):
+    value = os.getenv(name)
+    return cast(value) if value else default
+
+
+# 进程内共享的限速器，所有批量查询共同遵守同一主机的速率限制
+default_rate_limiter = RateLimiter(_env_number('NLC_RATE_LIMIT', 2.0, float))
+
+
+class NlcBatchClient:
+    """国家图书馆批量查询客户端
+    Args:
+        base_url: OPAC地址
+        workers: 并发查询数
+        rate_limiter: 限速器，默认使用进程共享的default_rate_limiter
+        retries: 失败后的最大重试次数
+        backoff: 退避基数(秒)，第n次重试前等待 [0, backoff * 2^n) 内的随机时长
+        timeout: 单次请求超时(秒)
+        cache: 可选的查询结果缓存(NlcCache)，命中时不访问国家图书馆
+        index: 可选的本地元数据索引(NlcIndex)，先于缓存查询，查到的书追加到索引
+        deadline: 每本书查询(含重试和退避)的总时限(秒)
+        breaker: 熔断器，默认使用按主机共享的get_breaker(host)
+    """
+
+    def __init__(self, base_url=None, workers=None, rate_limiter=None, retries=None,
+                 backoff=0.5, timeout=10, cache=None, index=None, deadline=None, breaker=None):
+        self.base_url = base_url or os.getenv('NLC_BASE_URL') or BASE_URL
+        self.workers = max(1, workers or _env_number('NLC_BATCH_WORKERS', 4))
+        self.rate_limiter = rate_limiter or default_rate_limiter
+        self.retries = _env_number('NLC_RETRIES', 3) if retries is None else retries
+        self.backoff = backoff
+        self.cache = cache
+        self.index = index
+        self.deadline = _env_number('NLC_DEADLINE', DEFAULT_DEADLINE, float) if deadline is None else deadline
+        self.breaker = breaker or get_breaker(urlsplit(self.base_url).netloc)
+        # 每个查询线程保留一个空闲连接；重试由本类按退避策略进行，熔断按每本书计
+        self.client = NlcClient(self.base_url, timeout=timeout, pool_size=self.workers, deadline=self.deadline,
+                                breaker=self.breaker, rate_limiter=self.rate_limiter)
+
+    def _remaining(self, deadline):
+        """距查询截止时间的秒数
+        Raises:
+            DeadlineExceeded: 已超出时限(不再重试)
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"超出查询时限({self.deadline}秒)")
+        return remaining
+
+    def _fetch_retrying(self, isbn):
+        """临时故障按退避策略重试，直到重试次数用尽或超出时限
+        请求出错时NlcClient丢弃会话URL，下次重试重新取得；会话失效时NlcClient自行重新取得会话后重试一次
+        """
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                return self.client.search(isbn, deadline, refresh_on_error=False)
+            except NlcUnavailable as e:
+                if attempt >= self.retries or not _retryable(e):
+                    raise
+                delay = min(random.uniform(0, self.backoff * 2 ** attempt), self._remaining(deadline))
+                logger.info(f"查询 {isbn} 失败({e})，{delay:.2f}秒后第{attempt + 1}次重试")
+                time.sleep(delay)
+                attempt += 1
+
+    def fetch(self, isbn):
+        """查询一本书，临时故障按退避策略重试
+        Returns:
+            dict: 原始书籍数据(同isbn2meta)，查无此书时为None
+        Raises:
+            NlcUnavailable: 重试次数用尽、不可重试的HTTP错误、超出时限、熔断中，或离线模式下索引和缓存均未命中
+        """
+        if self.index is not None:
+            data = self.index.get(isbn)
+            if data:
+                return dict(data, isbn=isbn)
+        if self.cache is not None:
+            hit, data = self.cache.get(isbn)
+            if hit:
+                return data
+        if offline_enabled():
+            raise NlcUnavailable(f"离线模式: 本地索引中没有 {isbn}")
+        try:
+            data = self.breaker.call(self._fetch_retrying, isbn)
+        except CircuitOpenError as e:
+            raise NlcUnavailable(str(e)) from e
+        if self.cache is not None:
+            self.cache.put(isbn, data)
+        if self.index is not None and data:
+            self.index.put(isbn, data)
+        return data
+
+    def _fetch_result(self, isbn):
+        try:
+            return isbn, self.fetch(isbn), None
+        except Exception as e:
+            return isbn, None, str(e) or e.__class__.__name__
+
+    def fetch_many(self, isbns):
+        """并发查询多本书，按完成顺序逐条产出结果
+        同时在途的任务数不超过并发数的两倍，大批量ISBN不会一次性全部提交
+        Yields:
+            tuple: (ISBN, 原始书籍数据或None, 错误信息或None)；无效ISBN直接产出错误
+        """
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='nlc-batch') as executor:
+            for isbn in isbns:
+                clean_isbn = validate_isbn(isbn)
+                if not clean_isbn:
+                    yield isbn, None, '无效的ISBN'
+                    continue
+                pending.add(executor.submit(self._fetch_result, clean_isbn))
+                if len(pending) >= self.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in as_completed(pending):
+                yield future.result()
+
+    def close(self):
+        """关闭连接池中的空闲连接"""
+        self.client.close()
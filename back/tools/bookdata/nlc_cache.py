@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# nlc_cache.py
+"""国家图书馆查询结果缓存
+
+get_book_info访问国家图书馆前先读缓存，命中时直接返回，不再抓取页面。
+缓存保存在本地SQLite文件中(WAL模式)，gunicorn的各个工作进程共享同一文件，每个进程的每个线程使用各自的连接。
+键为标准化后的ISBN(canonical)，值为isbn2meta返回的原始数据；查无此书的结果同样缓存(负缓存)，
+有效期较短，网络错误等临时故障不缓存。缓存读写出错时只记录日志，按未命中处理，不影响查询。
+命中/未命中次数先在进程内累计，每FLUSH_EVERY次合并到缓存文件的计数表，由各进程共享。
+
+配置(环境变量):
+    NLC_CACHE_PATH: 缓存文件路径(默认为Flask实例目录下的 back/instance/nlc_cache.db)，设为off关闭缓存
+    NLC_CACHE_TTL: 查到的书籍的缓存秒数(默认30天)
+    NLC_CACHE_NEGATIVE_TTL: 查无此书的缓存秒数(默认1天)
+
+用法: python -m tools.bookdata.nlc_cache stats|purge|clear
+"""
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 运行时生成的文件放在实例目录，不写入代码目录
+DEFAULT_PATH = Path(__file__).resolve().parents[2] / 'instance' / 'nlc_cache.db'
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_NEGATIVE_TTL = 24 * 3600
+# 进程内累计多少次查询后合并一次计数
+FLUSH_EVERY = 100
+COUNTERS = ('hits', 'negative_hits', 'misses', 'writes')
+
+_SCHEMA = (
+    # data为NULL表示查无此书
+    "CREATE TABLE IF NOT EXISTS NlcCache ("
+    "isbn TEXT PRIMARY KEY, data TEXT, expires_at REAL NOT NULL) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS NlcCacheStat (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID",
+)
+
+
+class NlcCache:
+    """基于SQLite文件的查询结果缓存，线程安全，可由多个进程共享
+    Args:
+        path: 缓存文件路径
+        ttl: 查到的书籍的缓存秒数
+        negative_ttl: 查无此书的缓存秒数
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.path = str(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = dict.fromkeys(COUNTERS, 0)
+        self._events = 0
+
+    def _connect(self):
+        # 连接不能跨进程使用，fork后的工作进程重新建立连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for ddl in _SCHEMA:
+            conn.execute(ddl)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self._pending[name] += 1
+            self._events += 1
+            if self._events < FLUSH_EVERY:
+                return
+        self.flush()
+
+    def get(self, isbn):
+        """读取缓存
+        Returns:
+            tuple: (是否命中, 原始书籍数据)，命中负缓存时数据为None
+        """
+        try:
+            row = self._connect().execute(
+                'SELECT data FROM NlcCache WHERE isbn = ? AND expires_at > ?', (isbn, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"读取查询缓存失败: {e}")
+            row = None
+        if row is None:
+            self._count('misses')
+            return False, None
+        if row[0] is None:
+            self._count('negative_hits')
+            return True, None
+        self._count('hits')
+        return True, json.loads(row[0])
+
+    def put(self, isbn, data):
+        """写入查询结果，data为空表示查无此书"""
+        if data:
+            value, ttl = json.dumps(data, ensure_ascii=False), self.ttl
+        else:
+            value, ttl = None, self.negative_ttl
+        if ttl <= 0:
+            return
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO NlcCache(isbn, data, expires_at) VALUES (?, ?, ?)',
+                (isbn, value, time.time() + ttl)
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"写入查询缓存失败: {e}")
+            return
+        self._count('writes')
+
+    def flush(self):
+        """把进程内累计的计数合并到缓存文件"""
+        with self._lock:
+            pending = [(name, value) for name, value in self._pending.items() if value]
+            self._pending = dict.fromkeys(COUNTERS, 0)
+            self._events = 0
+        if not pending:
+            return
+        try:
+            self._connect().executemany(
+                'INSERT INTO NlcCacheStat(name, value) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', pending
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"合并查询缓存计数失败: {e}")
+
+    def stats(self):
+        """所有进程累计的缓存统计
+        Returns:
+            dict: {'entries', 'negative_entries', 'expired', 'hits', 'negative_hits', 'misses', 'writes', 'hit_rate'}
+        """
+        self.flush()
+        conn = self._connect()
+        entries, negative, expired = conn.execute(
+            'SELECT count(*), count(*) - count(data), coalesce(sum(expires_at <= ?), 0) FROM NlcCache',
+            (time.time(),)
+        ).fetchone()
+        result = {'entries': entries, 'negative_entries': negative, 'expired': expired,
+                  **dict.fromkeys(COUNTERS, 0)}
+        result.update(conn.execute('SELECT name, value FROM NlcCacheStat').fetchall())
+        lookups = result['hits'] + result['negative_hits'] + result['misses']
+        result['hit_rate'] = round((result['hits'] + result['negative_hits']) / lookups, 4) if lookups else 0.0
+        return result
+
+    def purge(self):
+        """删除已过期的条目
+        Returns:
+            int: 删除的条目数
+        """
+        return self._connect().execute('DELETE FROM NlcCache WHERE expires_at <= ?', (time.time(),)).rowcount
+
+    def clear(self):
+        """清空缓存和计数"""
+        conn = self._connect()
+        conn.execute('DELETE FROM NlcCache')
+        conn.execute('DELETE FROM NlcCacheStat')
+        with self._lock:
+            self._pending = dict.fromkeys(COUNTERS, 0)
+            self._events = 0
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_cache():
+    """按环境变量配置创建的进程共享缓存，关闭缓存时返回None"""
+    global _default_cache
+    path = os.getenv('NLC_CACHE_PATH') or str(DEFAULT_PATH)
+    if path.lower() == 'off':
+        return None
+    with _default_lock:
+        if _default_cache is None or _default_cache.path != path:
+            if _default_cache is not None:
+                _default_cache.flush()
+            _default_cache = NlcCache(
+                path,
+                ttl=int(os.getenv('NLC_CACHE_TTL') or DEFAULT_TTL),
+                negative_ttl=int(os.getenv('NLC_CACHE_NEGATIVE_TTL') or DEFAULT_NEGATIVE_TTL)
+            )
+        return _default_cache
+
+
+@atexit.register
+def _flush_default():
+    if _default_cache is not None:
+        _default_cache.flush()
+
+
+if __name__ == '__main__':
+    cache = get_cache()
+    command = sys.argv[1] if len(sys.argv) == 2 else None
+    if cache is None or command not in ('stats', 'purge', 'clear'):
+        print('用法: python -m tools.bookdata.nlc_cache stats|purge|clear (需启用缓存)')
+        sys.exit(1)
+    if command == 'stats':
+        print(json.dumps(cache.stats(), ensure_ascii=False, indent=2))
+    elif command == 'purge':
+        print(f'已删除 {cache.purge()} 条过期缓存')
+    else:
+        cache.clear()
+        print('已清空查询缓存')
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+# nlc_client.py
+"""国家图书馆单本查询客户端
+
+原先每次查询先请求一次首页取会话URL，随后丢弃会话URL，用urlopen新建连接检索，每本书两次往返、两次建连。
+NlcClient保持与OPAC主机的keep-alive连接池，并缓存会话URL，直接在会话URL上检索，每次查询只需一次往返。
+会话空闲超过session_ttl、请求出错或OPAC返回重新登录页时丢弃会话URL，重新取得后自动重试一次。
+每次查询记录各阶段耗时(建连、首字节、读取、解析)，可按线程取最近一次的耗时或取进程内累计统计。
+
+上游保护: 每次查询(含取会话和重试)有总时限deadline，每个网络操作的超时不超过剩余时间；
+查询经按主机共享的熔断器(见circuit.py)执行，连续失败后快速失败，不再等待超时。
+批量查询(nlc_batch.py)经search在同一连接池和会话上检索，由批量查询自行限速、重试和熔断。
+
+配置(环境变量):
+    NLC_BASE_URL: 国家图书馆OPAC地址(默认 http://opac.nlc.cn/F)
+    NLC_SESSION_TTL: 会话URL的最长空闲秒数(默认300)
+    NLC_POOL_SIZE: 保留的空闲连接数(默认4)
+    NLC_DEADLINE: 单次查询的总时限秒数(默认15)
+"""
+
+import gzip
+import http.client
+import logging
+import os
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit
+
+from .circuit import CircuitOpenError, get_breaker
+from .headers import get_opacnlc_headers
+from .nlc_isbn import BASE_URL, SEARCH_QUERY_TEMPLATE, NlcUnavailable, dynamic_url_pattern
+from .nlc_parser import parse_page
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_TTL = 300
+DEFAULT_POOL_SIZE = 4
+DEFAULT_DEADLINE = 15
+PHASES = ('connect', 'first_byte', 'read', 'parse')
+# 会话失效时OPAC返回跳转到登录会话的首页，而不是检索结果
+SESSION_EXPIRED_MARKER = 'file_name=login-session'
+
+
+class DeadlineExceeded(NlcUnavailable):
+    """超出查询总时限"""
+
+
+class RequestError(NlcUnavailable):
+    """单次请求失败
+    Args:
+        status: 非200响应的HTTP状态码，网络错误和超时时为None
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def _new_timing():
+    return {'requests': 0, 'connections': 0, 'session_refreshes': 0, 'timeouts': 0,
+            **dict.fromkeys(PHASES, 0.0)}
+
+
+class ConnectionPool:
+    """同一主机的keep-alive连接池，线程安全
+    Args:
+        url: 主机地址(http或https)
+        timeout: 建连和读取的超时(秒)
+        size: 保留的空闲连接数，超出的连接用完即关闭
+    """
+
+    def __init__(self, url, timeout=10, size=DEFAULT_POOL_SIZE):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' \
+            else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取出一个连接
+        Returns:
+            tuple: (连接, 是否为复用的空闲连接)
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class NlcClient:
+    """国家图书馆单本查询客户端，线程安全
+    Args:
+        base_url: OPAC地址
+        timeout: 单次请求超时(秒)
+        session_ttl: 会话URL的最长空闲秒数，超过后重新取得
+        pool_size: 保留的空闲连接数
+        deadline: 单次查询的总时限(秒)
+        breaker: 熔断器，默认使用按主机共享的get_breaker(host)
+        rate_limiter: 可选的限速器(见nlc_batch.RateLimiter)，每次请求前取得令牌
+    """
+
+    def __init__(self, base_url=None, timeout=10, session_ttl=None, pool_size=None, deadline=None,
+                 breaker=None, rate_limiter=None):
+        self.base_url = base_url or os.getenv('NLC_BASE_URL') or BASE_URL
+        self.pid = os.getpid()
+        self.session_ttl = int(os.getenv('NLC_SESSION_TTL') or DEFAULT_SESSION_TTL) \
+            if session_ttl is None else session_ttl
+        self.deadline = float(os.getenv('NLC_DEADLINE') or DEFAULT_DEADLINE) if deadline is None else deadline
+        self.host = urlsplit(self.base_url).netloc
+        self.breaker = breaker or get_breaker(self.host)
+        self.rate_limiter = rate_limiter
+        self.pool = ConnectionPool(self.base_url, timeout,
+                                   pool_size or int(os.getenv('NLC_POOL_SIZE') or DEFAULT_POOL_SIZE))
+        self._session_url = None
+        self._session_used = 0.0
+        self._session_lock = threading.Lock()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {'lookups': 0, 'requests': 0, 'connections': 0, 'session_refreshes': 0, 'timeouts': 0,
+                       **{f'{phase}_seconds': 0.0 for phase in PHASES}}
+
+    def _headers(self):
+        headers = get_opacnlc_headers()
+        headers.pop('Proxy-Connection', None)
+        headers['Host'] = self.host
+        headers['Connection'] = 'keep-alive'
+        return headers
+
+    def _get(self, url, timing, deadline):
+        """在池中的连接上发送GET请求，返回解码后的页面
+        Args:
+            deadline: 查询的截止时间(time.monotonic)
+        Raises:
+            RequestError: 网络错误、超时或非200响应
+            DeadlineExceeded: 超出查询时限
+        """
+        parts = urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.host)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timing['timeouts'] += 1
+                raise DeadlineExceeded(f"超出查询时限({self.deadline}秒)")
+            conn, reused = self.pool.acquire()
+            timeout = min(self.pool.timeout, remaining)
+            try:
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                else:
+                    conn.timeout = timeout
+                    start = time.perf_counter()
+                    conn.connect()
+                    timing['connect'] += time.perf_counter() - start
+                    timing['connections'] += 1
+                start = time.perf_counter()
+                conn.request('GET', path, headers=self._headers())
+                response = conn.getresponse()
+                timing['first_byte'] += time.perf_counter() - start
+                start = time.perf_counter()
+                body = response.read()
+                timing['read'] += time.perf_counter() - start
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if isinstance(e, TimeoutError):
+                    timing['timeouts'] += 1
+                # 复用的空闲连接可能已被服务端关闭，换新连接重试
+                elif reused:
+                    continue
+                raise RequestError(f"请求 {url} 失败: {e}") from e
+            timing['requests'] += 1
+            if response.will_close:
+                conn.close()
+            else:
+                self.pool.release(conn)
+            break
+
+        if response.status != 200:
+            raise RequestError(f"请求 {url} 失败: HTTP {response.status}", response.status)
+        encoding = response.getheader('Content-Encoding', '')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        return body.decode('utf-8', errors='replace')
+
+    def _session_valid(self, now):
+        return self._session_url is not None and now - self._session_used <= self.session_ttl
+
+    def _session(self, timing, deadline, update_status):
+        """取得会话URL，空闲超时后重新访问首页
+        首页请求在锁外进行，其他线程不必等待；并发刷新时保留先写入的会话URL
+        """
+        with self._session_lock:
+            now = time.monotonic()
+            if self._session_valid(now):
+                self._session_used = now
+                return self._session_url
+        match = dynamic_url_pattern(self.base_url).search(self._get(self.base_url, timing, deadline))
+        if not match:
+            raise NlcUnavailable("无法找到动态URL")
+        timing['session_refreshes'] += 1
+        with self._session_lock:
+            now = time.monotonic()
+            if not self._session_valid(now):
+                self._session_url = match.group(0)
+                update_status(f"动态URL: {self._session_url}")
+            self._session_used = now
+            return self._session_url
+
+    def _invalidate(self, session_url):
+        with self._session_lock:
+            if self._session_url == session_url:
+                self._session_url = None
+
+    def lookup(self, isbn, update_status=logger.debug):
+        """在会话URL上检索一本书
+        Args:
+            isbn: 标准化后的ISBN
+        Returns:
+            dict: 原始书籍数据，查无此书时为None
+        Raises:
+            NlcUnavailable: 重新取得会话后仍然失败、超出时限或熔断中
+        """
+        timing = _new_timing()
+        try:
+            deadline = time.monotonic() + self.deadline
+            return self.breaker.call(self._lookup, isbn, update_status, timing, deadline)
+        except CircuitOpenError as e:
+            raise NlcUnavailable(str(e)) from e
+        finally:
+            self._record(timing)
+
+    def search(self, isbn, deadline, update_status=logger.debug, refresh_on_error=True):
+        """在会话URL上检索一本书，不经熔断器(供自行熔断和重试的批量查询使用)
+        Args:
+            isbn: 标准化后的ISBN
+            deadline: 查询的截止时间(time.monotonic)
+            refresh_on_error: 请求出错时是否重新取得会话后重试一次，会话失效时总是重试
+        Returns:
+            dict: 原始书籍数据，查无此书时为None
+        Raises:
+            NlcUnavailable: 请求失败(RequestError)、超出时限(DeadlineExceeded)或会话失效
+        """
+        timing = _new_timing()
+        try:
+            return self._lookup(isbn, update_status, timing, deadline, refresh_on_error)
+        finally:
+            self._record(timing)
+
+    def _lookup(self, isbn, update_status, timing, deadline, refresh_on_error=True):
+        for attempt in range(2):
+            session_url = self._session(timing, deadline, update_status)
+            try:
+                html = self._get(session_url + SEARCH_QUERY_TEMPLATE.format(isbn=isbn), timing, deadline)
+            except NlcUnavailable as e:
+                error, retry = e, refresh_on_error
+            else:
+                if SESSION_EXPIRED_MARKER not in html:
+                    break
+                error, retry = NlcUnavailable("会话已失效"), True
+            self._invalidate(session_url)
+            if attempt or not retry:
+                raise error
+            update_status(f"{error}，重新取得会话后重试")
+
+        start = time.perf_counter()
+        result = parse_page(html, isbn, update_status)
+        timing['parse'] = time.perf_counter() - start
+        update_status("查询耗时: " + ", ".join(f"{phase} {timing[phase] * 1000:.1f}ms" for phase in PHASES))
+        return result
+
+    def _record(self, timing):
+        self._local.timing = timing
+        with self._stats_lock:
+            self._stats['lookups'] += 1
+            for name in ('requests', 'connections', 'session_refreshes', 'timeouts'):
+                self._stats[name] += timing[name]
+            for phase in PHASES:
+                self._stats[f'{phase}_seconds'] += timing[phase]
+
+    def last_timing(self):
+        """当前线程最近一次查询的各阶段耗时(秒)和请求数、新建连接数，尚未查询时为None"""
+        return getattr(self._local, 'timing', None)
+
+    def stats(self):
+        """进程内累计的查询次数、请求数、新建连接数、会话刷新次数、超时次数和各阶段总耗时(秒)"""
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def close(self):
+        self.pool.close()
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_client():
+    """按环境变量配置创建的进程共享客户端(fork后的工作进程重新创建)"""
+    global _default_client
+    base_url = os.getenv('NLC_BASE_URL') or BASE_URL
+    with _default_lock:
+        client = _default_client
+        if client is None or client.pid != os.getpid() or client.base_url != base_url:
+            client = _default_client = NlcClient(base_url)
+        return client
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# nlc_index.py
+"""本地书籍元数据索引
+
+data.json等国家图书馆格式的数据(isbn2meta返回的原始书籍数据)导入本地SQLite索引后，
+lookup_book_info和批量查询先查索引，命中时不访问网络；从国家图书馆查到的新书随即追加到索引。
+与查询缓存(nlc_cache.py)不同，索引中的记录不过期，也不保存查无此书的结果。
+
+键为标准化后的ISBN-13(ISBN-10转换为978前缀的ISBN-13)，值为紧凑的JSON文本。
+种子文件(默认data.json)在首次使用或文件修改后导入，已有的记录不被种子覆盖；
+导入外部数据时默认覆盖已有记录。数据文件为JSON数组或每行一条记录的NDJSON，可以是gzip压缩的(.gz)。
+
+离线模式(NLC_OFFLINE)下索引未命中时直接按国家图书馆不可用处理，不访问网络，供无法联网的测试和基准测试环境使用。
+
+配置(环境变量):
+    NLC_INDEX_PATH: 索引文件路径(默认为Flask实例目录下的 back/instance/nlc_index.db)，设为off关闭索引
+    NLC_INDEX_SEED: 种子文件路径，多个用os.pathsep分隔(默认 tools/bookdata/data.json)，设为off不导入
+    NLC_OFFLINE: 设为1时只查本地索引
+
+用法:
+    python -m tools.bookdata.nlc_index stats                 索引记录数和来源
+    python -m tools.bookdata.nlc_index seed                  导入种子文件
+    python -m tools.bookdata.nlc_index merge 文件... [--keep]  导入外部数据，--keep时不覆盖已有记录
+    python -m tools.bookdata.nlc_index export 文件           导出全部记录为NDJSON
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 运行时生成的文件放在实例目录，不写入代码目录
+DEFAULT_PATH = Path(__file__).resolve().parents[2] / 'instance' / 'nlc_index.db'
+DEFAULT_SEED = Path(__file__).resolve().parent / 'data.json'
+# 导入时每批写入的记录数
+MERGE_BATCH_SIZE = 1000
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS NlcRecord ("
+    "isbn TEXT PRIMARY KEY, data TEXT NOT NULL, source TEXT NOT NULL, updated_at REAL NOT NULL) WITHOUT ROWID",
+    # 已导入的种子文件及其修改时间和大小
+    "CREATE TABLE IF NOT EXISTS NlcIndexSeed ("
+    "path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL) WITHOUT ROWID",
+)
+
+
+def index_key(isbn):
+    """索引键: 标准化后的ISBN-13，ISBN无效时为None"""
+    # 在此处导入: nlc_isbn在查询时依赖本模块
+    from .nlc_isbn import isbn10_to_isbn13, validate_isbn
+    clean_isbn = validate_isbn(isbn) if isinstance(isbn, str) else None
+    if clean_isbn and len(clean_isbn) == 10:
+        return isbn10_to_isbn13(clean_isbn)
+    return clean_isbn
+
+
+def offline_enabled():
+    """是否只查本地索引，不访问国家图书馆"""
+    return os.getenv('NLC_OFFLINE', '0').lower() not in ('0', 'false', 'no', '')
+
+
+def read_records(path):
+    """逐条读取数据文件中的记录
+    Args:
+        path: JSON数组或NDJSON文件，.gz结尾时按gzip解压
+    """
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8-sig') as fp:
+        first = fp.readline()
+        while first and not first.strip():
+            first = fp.readline()
+        if first.lstrip().startswith('['):
+            yield from json.loads(first + fp.read())
+            return
+        for line in itertools.chain([first], fp):
+            if line.strip():
+                yield json.loads(line)
+
+
+class NlcIndex:
+    """基于SQLite文件的书籍元数据索引，线程安全，可由多个进程共享
+    Args:
+        path: 索引文件路径
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    def _connect(self):
+        # 连接不能跨进程使用，fork后的工作进程重新建立连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for ddl in _SCHEMA:
+            conn.execute(ddl)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, isbn):
+        """查询一本书
+        Returns:
+            dict: 原始书籍数据，索引中没有或ISBN无效时为None
+        """
+        key = index_key(isbn)
+        if not key:
+            return None
+        try:
+            row = self._connect().execute('SELECT data FROM NlcRecord WHERE isbn = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"读取元数据索引失败: {e}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def put(self, isbn, data, source='nlc'):
+        """追加(或更新)一条查询结果，data为空时忽略"""
+        key = index_key(isbn)
+        if not key or not data:
+            return
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO NlcRecord(isbn, data, source, updated_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(data, ensure_ascii=False, separators=(',', ':')), source, time.time())
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"写入元数据索引失败: {e}")
+
+    def merge(self, records, source, replace=True):
+        """批量导入记录
+        Args:
+            records: 原始书籍数据的可迭代对象，按其中的isbn字段建立索引
+            source: 来源(文件名等)，记录在索引中
+            replace: 是否覆盖已有记录
+        Returns:
+            dict: {'added': 写入数, 'skipped': 已存在而未覆盖数, 'invalid': ISBN无效或缺少书名的记录数}
+        """
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        statement = f'{verb} INTO NlcRecord(isbn, data, source, updated_at) VALUES (?, ?, ?, ?)'
+        report = {'added': 0, 'skipped': 0, 'invalid': 0}
+        conn = self._connect()
+        now = time.time()
+        batch = []
+
+        def flush():
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                before = conn.total_changes
+                conn.executemany(statement, batch)
+                added = conn.total_changes - before
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            report['added'] += added
+            report['skipped'] += len(batch) - added
+            batch.clear()
+
+        for record in records:
+            key = index_key(record.get('isbn')) if isinstance(record, dict) else None
+            if not key or not record.get('title'):
+                report['invalid'] += 1
+                continue
+            batch.append((key, json.dumps(record, ensure_ascii=False, separators=(',', ':')), source, now))
+            if len(batch) >= MERGE_BATCH_SIZE:
+                flush()
+        if batch:
+            flush()
+        return report
+
+    def merge_file(self, path, replace=True):
+        """导入数据文件(见read_records)"""
+        return self.merge(read_records(path), Path(path).name, replace)
+
+    def seed(self, paths):
+        """导入尚未导入或导入后被修改的种子文件，不覆盖已有记录
+        Returns:
+            dict: {文件路径: merge的结果}，只包含本次导入的文件
+        """
+        reports = {}
+        conn = self._connect()
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            row = conn.execute('SELECT mtime, size FROM NlcIndexSeed WHERE path = ?', (str(path),)).fetchone()
+            if row == (stat.st_mtime, stat.st_size):
+                continue
+            reports[str(path)] = self.merge_file(path, replace=False)
+            conn.execute('INSERT OR REPLACE INTO NlcIndexSeed(path, mtime, size) VALUES (?, ?, ?)',
+                         (str(path), stat.st_mtime, stat.st_size))
+            logger.info(f"已导入种子文件 {path}: {reports[str(path)]}")
+        return reports
+
+    def export(self, fp):
+        """把全部记录按ISBN顺序写为NDJSON
+        Returns:
+            int: 记录数
+        """
+        count = 0
+        for (data,) in self._connect().execute('SELECT data FROM NlcRecord ORDER BY isbn'):
+            fp.write(data + '\n')
+            count += 1
+        return count
+
+    def stats(self):
+        """索引统计
+        Returns:
+            dict: {'records', 'sources': {来源: 记录数}, 'seeds': [已导入的种子文件]}
+        """
+        conn = self._connect()
+        sources = dict(conn.execute('SELECT source, count(*) FROM NlcRecord GROUP BY source').fetchall())
+        return {
+            'records': sum(sources.values()),
+            'sources': sources,
+            'seeds': [path for (path,) in conn.execute('SELECT path FROM NlcIndexSeed ORDER BY path')]
+        }
+
+
+def seed_paths():
+    value = os.getenv('NLC_INDEX_SEED') or str(DEFAULT_SEED)
+    if value.lower() == 'off':
+        return []
+    return [path for path in value.split(os.pathsep) if path]
+
+
+_default_index = None
+_default_lock = threading.Lock()
+
+
+def get_index():
+    """按环境变量配置创建的进程共享索引(首次创建时导入种子文件)，关闭索引时返回None"""
+    global _default_index
+    path = os.getenv('NLC_INDEX_PATH') or str(DEFAULT_PATH)
+    if path.lower() == 'off':
+        return None
+    with _default_lock:
+        if _default_index is None or _default_index.path != path:
+            index = NlcIndex(path)
+            try:
+                index.seed(seed_paths())
+            except (OSError, ValueError, sqlite3.Error) as e:
+                logger.warning(f"导入种子文件失败: {e}")
+            _default_index = index
+        return _default_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地书籍元数据索引')
+    parser.add_argument('command', choices=['stats', 'seed', 'merge', 'export'])
+    parser.add_argument('paths', nargs='*', help='数据文件(merge)或导出文件(export)')
+    parser.add_argument('--keep', action='store_true', help='merge时不覆盖已有记录')
+    args = parser.parse_args()
+
+    path = os.getenv('NLC_INDEX_PATH') or str(DEFAULT_PATH)
+    if path.lower() == 'off':
+        parser.error('索引已关闭(NLC_INDEX_PATH=off)')
+    index = NlcIndex(path)
+    if args.command == 'stats':
+        print(json.dumps(index.stats(), ensure_ascii=False, indent=2))
+    elif args.command == 'seed':
+        print(json.dumps(index.seed(seed_paths()), ensure_ascii=False, indent=2))
+    elif args.command == 'merge':
+        if not args.paths:
+            parser.error('merge需要至少一个数据文件')
+        for file in args.paths:
+            print(f"{file}: {json.dumps(index.merge_file(file, replace=not args.keep), ensure_ascii=False)}")
+    else:
+        if len(args.paths) != 1:
+            parser.error('export需要一个导出文件')
+        with open(args.paths[0], 'w', encoding='utf-8') as fp:
+            print(f'已导出 {index.export(fp)} 条记录')
+
+
+if __name__ == '__main__':
+    main()
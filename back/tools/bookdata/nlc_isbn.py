@@ -5,9 +5,11 @@ import re
 import json
 import urllib.request
 import logging
-from bs4 import BeautifulSoup
+from urllib.parse import urlsplit
 
 from .headers import get_opacnlc_headers
+from .nlc_cache import get_cache
+from .nlc_index import get_index, offline_enabled
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -15,17 +17,25 @@ logger = logging.getLogger(__name__)
 
 
 BASE_URL = "http://opac.nlc.cn/F"
-SEARCH_URL_TEMPLATE = BASE_URL + "?func=find-b&find_code=ISB&request={isbn}&local_base=NLC01" + \
-                      "&filter_code_1=WLN&filter_request_1=&filter_code_2=WYR&filter_request_2=" + \
-                      ("&filter_code_3=WYR&filter_request_3=&filter_code_4=WFM&filter_request_4=&filter_code_5=WSL"
-                       "&filter_request_5=")
+SEARCH_QUERY_TEMPLATE = "?func=find-b&find_code=ISB&request={isbn}&local_base=NLC01" + \
+                        "&filter_code_1=WLN&filter_request_1=&filter_code_2=WYR&filter_request_2=" + \
+                        ("&filter_code_3=WYR&filter_request_3=&filter_code_4=WFM&filter_request_4=&filter_code_5=WSL"
+                         "&filter_request_5=")
+SEARCH_URL_TEMPLATE = BASE_URL + SEARCH_QUERY_TEMPLATE
 
 
-def get_dynamic_url(update_status):
+def dynamic_url_pattern(base_url=BASE_URL):
+    """首页中会话URL的匹配模式，如 http://opac.nlc.cn:80/F/XXXX"""
+    parts = urlsplit(base_url)
+    prefix = re.escape(f"{parts.scheme}://{parts.hostname}") + r"(?::\d+)?" + re.escape(parts.path)
+    return re.compile(prefix + r"/[^\s?]*")
+
+
+def get_dynamic_url(update_status, base_url=BASE_URL):
     try:
-        response = urllib.request.urlopen(urllib.request.Request(BASE_URL, headers=get_opacnlc_headers()), timeout=10)
+        response = urllib.request.urlopen(urllib.request.Request(base_url, headers=get_opacnlc_headers()), timeout=10)
         response_text = response.read().decode('utf-8')
-        dynamic_url_match = re.search(r"http://opac.nlc.cn:80/F/[^\s?]*", response_text)
+        dynamic_url_match = dynamic_url_pattern(base_url).search(response_text)
         if dynamic_url_match:
             update_status(f"动态URL: {dynamic_url_match.group(0)}")
             return dynamic_url_match.group(0)
@@ -36,7 +46,25 @@ def get_dynamic_url(update_status):
         return None
 
 
+class NlcUnavailable(Exception):
+    """国家图书馆无法访问(网络错误等)，与查无此书区分，结果不应缓存"""
+
+
 def isbn2meta(isbn, update_status):
+    try:
+        return fetch_metadata(isbn, update_status)
+    except NlcUnavailable as e:
+        update_status(str(e))
+        return None
+
+
+def fetch_metadata(isbn, update_status):
+    """经进程共享的NlcClient(见nlc_client.py)查询国家图书馆
+    Returns:
+        dict: 原始书籍数据，查无此书或ISBN无效时为None
+    Raises:
+        NlcUnavailable: 网络错误等临时故障
+    """
     if not isinstance(isbn, str):
         update_status("ISBN必须是字符串")
         return None
@@ -55,20 +83,9 @@ def isbn2meta(isbn, update_status):
         update_status(f"无效的ISBN代码: {isbn} (标准化后: {clean_isbn})")
         return None
 
-    dynamic_url = get_dynamic_url(update_status)
-    if not dynamic_url:
-        return None
-
-    search_url = SEARCH_URL_TEMPLATE.format(isbn=clean_isbn)
-    update_status(f"构造的搜索URL: {search_url}")
-    try:
-        response = urllib.request.urlopen(urllib.request.Request(search_url, headers=get_opacnlc_headers()), timeout=10)
-        response_text = response.read().decode('utf-8')
-        soup = BeautifulSoup(response_text, "html.parser")
-        return parse_metadata(soup, clean_isbn, update_status)
-    except Exception as e:
-        update_status(f"获取元数据时出错: {e}")
-        return None
+    # 在此处导入: nlc_client依赖本模块的检索模板和解析函数
+    from .nlc_client import get_client
+    return get_client().lookup(clean_isbn, update_status)
 
 
 def clean_string(text):
@@ -80,76 +97,86 @@ def clean_string(text):
     return text
 
 def parse_metadata(soup, clean_isbn, update_status):
-    data = {}
-    prev_td1 = ''
-    prev_td2 = ''
-
     try:
         table = soup.find("table", attrs={"id": "td"})
         if not table:
             update_status("未找到数据表格")
             return None
-
-        tr_elements = table.find_all('tr')
-        for tr in tr_elements:
-            td_elements = tr.find_all('td', class_='td1')
-            if len(td_elements) == 2:
-                td1 = clean_string(td_elements[0].get_text())
-                td2 = clean_string(td_elements[1].get_text())
-                if not td1 and not td2:
-                    continue
-                if td1:
-                    data[td1] = td2
-                else:
-                    data[prev_td1] = '\n'.join([prev_td2, td2])
-                prev_td1 = td1
-                prev_td2 = td2
-
-        # 处理出版信息
-        pub_info = data.get("出版项", "")
-        pubdate = ""
-        publisher = ""
-        if pub_info:
-            pubdate_match = re.search(r',\s*(\d{4})', pub_info)
-            pubdate = pubdate_match.group(1) if pubdate_match else ""
-            publisher_match = re.search(r':\s*(.+?)\s*,', pub_info)
-            publisher = publisher_match.group(1) if publisher_match else ""
-
-        # 处理标签
-        tags = []
-        subject = data.get("主题", "")
-        if subject:
-            tags.extend([clean_string(tag) for tag in re.split(r'[-—–&]+', subject) if clean_string(tag)])
-        class_num = data.get("中图分类号", "")
-        if class_num:
-            tags.append(f"中图分类:{clean_string(class_num)}")
-        if publisher:
-            tags.append(f"出版社:{publisher}")
-        if pubdate:
-            tags.append(f"出版年:{pubdate}")
-
-        # 处理作者
-        authors = []
-        author_text = data.get("著者", "")
-        if author_text:
-            authors = [clean_string(author) for author in re.split(r'[;&]', author_text) if clean_string(author)]
-
-        metadata = {
-            "title": clean_string(data.get("题名与责任", clean_isbn)),
-            "tags": [tag for tag in tags if tag],
-            "comments": clean_string(data.get("内容提要", "")),
-            "publisher": publisher,
-            "pubdate": pubdate,
-            "authors": authors,
-            "isbn": clean_isbn,
-            "pages": clean_string(data.get("载体形态项", "")),
-        }
-        return metadata
+        rows = ([td.get_text() for td in tr.find_all('td', class_='td1')] for tr in table.find_all('tr'))
+        return build_metadata(collect_fields(rows), clean_isbn)
     except Exception as e:
         update_status(f"解析元数据时出错: {e}")
         return None
 
 
+def collect_fields(rows):
+    """把详细记录表格的行合并为 {字段名: 值}
+    Args:
+        rows: 每行中class为td1的单元格文本列表，只处理恰好两个单元格(字段名、值)的行
+    """
+    data = {}
+    prev_td1 = ''
+    prev_td2 = ''
+    for cells in rows:
+        if len(cells) == 2:
+            td1 = clean_string(cells[0])
+            td2 = clean_string(cells[1])
+            if not td1 and not td2:
+                continue
+            if td1:
+                data[td1] = td2
+            else:
+                # 字段名为空的行是上一字段的续行
+                data[prev_td1] = '\n'.join([prev_td2, td2])
+            prev_td1 = td1
+            prev_td2 = td2
+    return data
+
+
+def build_metadata(data, clean_isbn):
+    """由详细记录的字段生成原始书籍数据"""
+    # 处理出版信息
+    pub_info = data.get("出版项", "")
+    pubdate = ""
+    publisher = ""
+    if pub_info:
+        pubdate_match = re.search(r',\s*(\d{4})', pub_info)
+        pubdate = pubdate_match.group(1) if pubdate_match else ""
+        publisher_match = re.search(r':\s*(.+?)\s*,', pub_info)
+        publisher = publisher_match.group(1) if publisher_match else ""
+
+    # 处理标签
+    tags = []
+    subject = data.get("主题", "")
+    if subject:
+        tags.extend([clean_string(tag) for tag in re.split(r'[-—–&]+', subject) if clean_string(tag)])
+    class_num = data.get("中图分类号", "")
+    if class_num:
+        tags.append(f"中图分类:{clean_string(class_num)}")
+    if publisher:
+        tags.append(f"出版社:{publisher}")
+    if pubdate:
+        tags.append(f"出版年:{pubdate}")
+
+    # 处理作者
+    authors = []
+    author_text = data.get("著者", "")
+    if author_text:
+        authors = [clean_string(author) for author in re.split(r'[;&]', author_text) if clean_string(author)]
+
+    metadata = {
+        "title": clean_string(data.get("题名与责任", clean_isbn)),
+        "tags": [tag for tag in tags if tag],
+        "comments": clean_string(data.get("内容提要", "")),
+        "publisher": publisher,
+        "pubdate": pubdate,
+        "authors": authors,
+        "isbn": clean_isbn,
+        "pages": clean_string(data.get("载体形态项", "")),
+    }
+    return metadata
+
+
 
 
 
@@ -170,14 +197,11 @@ def is_isbn10(isbn10):
     isbn10 = canonical(isbn10)
     if len(isbn10) != 10:
         return False
-    total = sum((i + 1) * int(x) for i, x in enumerate(isbn10[:-1]))
-    check = 11 - (total % 11)
-    if check == 10:
-        check_char = 'X'
-    elif check == 11:
-        check_char = '0'
-    else:
-        check_char = str(check)
+    if not isbn10[:-1].isdigit():
+        return False
+    # 前9位按权重1~9求和，模11即为校验位(10记为X)
+    check = sum((i + 1) * int(x) for i, x in enumerate(isbn10[:-1])) % 11
+    check_char = 'X' if check == 10 else str(check)
     return isbn10[-1].upper() == check_char
 
 def is_isbn13(isbn13):
@@ -185,7 +209,7 @@ def is_isbn13(isbn13):
     isbn13 = canonical(isbn13)
     if len(isbn13) != 13:
         return False
-    if isbn13[0:3] not in ('978', '979'):
+    if isbn13[0:3] not in ('978', '979') or not isbn13.isdigit():
         return False
     total = sum((i % 2 * 2 + 1) * int(x) for i, x in enumerate(isbn13[:-1]))
     check = 10 - (total % 10)
@@ -193,6 +217,21 @@ def is_isbn13(isbn13):
         check = 0
     return int(isbn13[-1]) == check
 
+def isbn10_to_isbn13(isbn10):
+    """ISBN-10转换为978前缀的ISBN-13"""
+    body = '978' + canonical(isbn10)[:9]
+    total = sum((i % 2 * 2 + 1) * int(x) for i, x in enumerate(body))
+    return body + str((10 - total % 10) % 10)
+
+def isbn13_to_isbn10(isbn13):
+    """978前缀的ISBN-13转换为ISBN-10，无法转换时返回None"""
+    isbn13 = canonical(isbn13)
+    if len(isbn13) != 13 or not isbn13.startswith('978'):
+        return None
+    body = isbn13[3:12]
+    check = (11 - sum((10 - i) * int(x) for i, x in enumerate(body)) % 11) % 11
+    return body + ('X' if check == 10 else str(check))
+
 def validate_isbn(isbn):
     """验证并规范化ISBN号码"""
     clean_isbn = canonical(isbn)
@@ -204,16 +243,52 @@ def validate_isbn(isbn):
         return clean_isbn
     return None
 
+def lookup_book_info(isbn):
+    """
+    通过ISBN获取书籍信息，依次查本地元数据索引(见nlc_index.py)、查询缓存(见nlc_cache.py)和国家图书馆，
+    查到和查无此书的结果写入缓存，查到的书追加到索引
+    :param isbn: ISBN号码
+    :return: 原始书籍数据字典，查无此书或ISBN无效时为None
+    :raises NlcUnavailable: 网络错误等临时故障(不缓存)，或离线模式下索引和缓存均未命中
+    """
+    def update_status(message):
+        logger.info(message)
+
+    key = canonical(isbn) if isinstance(isbn, str) else ''
+    index = get_index() if key else None
+    if index is not None:
+        book_data = index.get(key)
+        if book_data:
+            # 与从国家图书馆查询时一致，isbn为查询时使用的ISBN
+            return dict(book_data, isbn=key)
+
+    cache = get_cache() if key else None
+    if cache is not None:
+        hit, book_data = cache.get(key)
+        if hit:
+            return book_data
+
+    if key and offline_enabled():
+        raise NlcUnavailable(f"离线模式: 本地索引中没有 {key}")
+    book_data = fetch_metadata(isbn, update_status)
+    if cache is not None:
+        cache.put(key, book_data)
+    if index is not None and book_data:
+        index.put(key, book_data)
+    return book_data
+
 def get_book_info(isbn):
     """
     通过ISBN获取书籍信息并返回JSON格式数据
     :param isbn: ISBN号码
     :return: 包含书籍信息的字典，可直接转为JSON
     """
-    def update_status(message):
-        logger.info(message)
-    
-    book_data = isbn2meta(isbn, update_status)
+    try:
+        book_data = lookup_book_info(isbn)
+    except NlcUnavailable as e:
+        # 临时故障不缓存，下次查询重新访问国家图书馆
+        logger.info(str(e))
+        return {"error": "Book not found"}
     return book_data if book_data else {"error": "Book not found"}
 
 ## 测试
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# nlc_parser.py
+"""国家图书馆详细记录页面解析
+
+parse_metadata先用纯Python的html.parser建立完整的BeautifulSoup树，再在表格中find_all所有行和单元格，
+只为取出十来个字段，批量补全时解析占了大部分CPU。
+scan引擎只用正则表达式定位详细记录表格(table#td)、逐行截取class为td1的单元格并去掉标签，
+结果与parse_metadata相同(由测试在fixtures中的录制页面上逐一比对)；
+遇到表格中嵌套表格等scan不处理的结构时回退到BeautifulSoup解析。
+
+配置(环境变量):
+    NLC_PARSER: 解析引擎，scan(默认)或bs4
+
+用法: python -m tools.bookdata.nlc_parser [--rounds 200] [页面文件...]
+    比对两种引擎在录制页面(默认fixtures目录)上的结果并测量每页的解析耗时
+"""
+
+import argparse
+import html
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from .nlc_isbn import build_metadata, collect_fields, parse_metadata
+
+ENGINES = ('scan', 'bs4')
+DEFAULT_ENGINE = 'scan'
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+
+_TABLE_RE = re.compile(r'<table\b[^>]*?\bid\s*=\s*(?:"td"|\'td\'|td\b)[^>]*>', re.I)
+_TABLE_END_RE = re.compile(r'</table\s*>', re.I)
+_NESTED_TABLE_RE = re.compile(r'<table\b', re.I)
+_ROW_SPLIT_RE = re.compile(r'<tr\b[^>]*>', re.I)
+_CELL_RE = re.compile(r'<td\b([^>]*)>(.*?)</td\s*>', re.I | re.S)
+_CLASS_RE = re.compile(r'\bclass\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.I)
+_TAG_RE = re.compile(r'<!--.*?-->|<[^>]*>', re.S)
+
+
+def _is_td1(attrs):
+    match = _CLASS_RE.search(attrs)
+    if not match:
+        return False
+    return 'td1' in (match.group(1) or match.group(2) or match.group(3) or '').split()
+
+
+def _text(fragment):
+    return html.unescape(_TAG_RE.sub('', fragment))
+
+
+def scan_fields(page):
+    """用正则表达式取出详细记录表格的字段
+    Returns:
+        dict: {字段名: 值}，页面中没有详细记录表格时为None
+    Raises:
+        ValueError: 表格结构不是scan能处理的(如嵌套表格)
+    """
+    start = _TABLE_RE.search(page)
+    if not start:
+        return None
+    end = _TABLE_END_RE.search(page, start.end())
+    table = page[start.end():end.start() if end else len(page)]
+    if _NESTED_TABLE_RE.search(table):
+        raise ValueError('详细记录表格中有嵌套表格')
+    rows = (
+        [_text(cell) for attrs, cell in _CELL_RE.findall(row) if _is_td1(attrs)]
+        for row in _ROW_SPLIT_RE.split(table)[1:]
+    )
+    return collect_fields(rows)
+
+
+def get_engine():
+    engine = (os.getenv('NLC_PARSER') or DEFAULT_ENGINE).lower()
+    return engine if engine in ENGINES else DEFAULT_ENGINE
+
+
+def parse_page(page, clean_isbn, update_status, engine=None):
+    """解析详细记录页面
+    Args:
+        page: 页面HTML文本
+        clean_isbn: 标准化后的ISBN
+        engine: scan或bs4，默认读取NLC_PARSER
+    Returns:
+        dict: 原始书籍数据，页面中没有详细记录(查无此书)时为None
+    """
+    if (engine or get_engine()) == 'scan':
+        try:
+            data = scan_fields(page)
+        except ValueError as e:
+            update_status(f"{e}，改用BeautifulSoup解析")
+        except Exception as e:
+            update_status(f"解析元数据时出错: {e}")
+            return None
+        else:
+            if data is None:
+                update_status("未找到数据表格")
+                return None
+            return build_metadata(data, clean_isbn)
+    return parse_metadata(BeautifulSoup(page, 'html.parser'), clean_isbn, update_status)
+
+
+def benchmark(paths, rounds):
+    """比对并测量两种引擎
+    Returns:
+        list: [(文件名, 结果是否一致, bs4每页微秒数, scan每页微秒数)]
+    """
+    report = []
+    for path in paths:
+        page = Path(path).read_text(encoding='utf-8')
+        isbn = re.sub(r'\D', '', Path(path).stem) or '0000000000000'
+        results = {}
+        timings = {}
+        for engine in ('bs4', 'scan'):
+            results[engine] = parse_page(page, isbn, lambda message: None, engine)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                parse_page(page, isbn, lambda message: None, engine)
+            timings[engine] = (time.perf_counter() - start) / rounds * 1e6
+        report.append((Path(path).name, results['bs4'] == results['scan'], timings['bs4'], timings['scan']))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比对并测量国家图书馆页面解析引擎')
+    parser.add_argument('pages', nargs='*', help='页面文件(默认fixtures目录下的全部页面)')
+    parser.add_argument('--rounds', type=int, default=200, help='每个页面的解析次数')
+    args = parser.parse_args()
+
+    paths = args.pages or sorted(FIXTURES.glob('*.html'))
+    report = benchmark(paths, args.rounds)
+    print(f"{'页面':<32}{'一致':>6}{'bs4(us)':>12}{'scan(us)':>12}{'加速':>8}")
+    for name, same, bs4_us, scan_us in report:
+        print(f"{name:<32}{'是' if same else '否':>6}{bs4_us:>12.1f}{scan_us:>12.1f}{bs4_us / scan_us:>7.1f}x")
+    if not all(same for _, same, _, _ in report):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
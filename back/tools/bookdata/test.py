@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import unittest
+from tools.bookdata.nlc_batch import NlcBatchClient, RateLimiter
+from tools.bookdata.circuit import CircuitBreaker
+from tools.bookdata import nlc_cache
+from tools.bookdata.nlc_cache import NlcCache
+from tools.bookdata.nlc_client import NlcClient
+from tools.bookdata.nlc_index import NlcIndex
+from tools.bookdata.nlc_isbn import NlcUnavailable, get_book_info, isbn13_to_isbn10
+from tools.bookdata.nlc_parser import benchmark, parse_page
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+def set_env(test, **env):
+    """设置环境变量，测试结束后恢复"""
+    for name, value in env.items():
+        old = os.environ.get(name)
+        test.addCleanup(lambda name=name, old=old: os.environ.pop(name, None) if old is None
+                        else os.environ.__setitem__(name, old))
+        os.environ[name] = value
+
+
+def setUpModule():
+    """国家图书馆查询缓存和本地索引写入临时目录，测试不在项目中留下数据文件"""
+    tmpdir = tempfile.TemporaryDirectory()
+    unittest.addModuleCleanup(tmpdir.cleanup)
+    for name, file in (('NLC_CACHE_PATH', 'nlc_cache.db'), ('NLC_INDEX_PATH', 'nlc_index.db')):
+        old = os.environ.get(name)
+        unittest.addModuleCleanup(lambda name=name, old=old: os.environ.pop(name, None) if old is None
+                                  else os.environ.__setitem__(name, old))
+        os.environ[name] = os.path.join(tmpdir.name, file)
+    # 删除临时目录前合并缓存计数，退出时不再写入
+    unittest.addModuleCleanup(nlc_cache._flush_default)
+
+
+class FakeNlcServer:
+    """回放fixtures中录制页面的本地国家图书馆服务
+    failures: ISBN -> 返回503的次数，用于模拟临时故障
+    keep_alive: 使用HTTP/1.1保持连接，connections记录建立的连接数
+    expired: 前几次检索返回重新登录的首页，模拟会话失效
+    """
+
+    def __init__(self, delay=0.0, failures=None, keep_alive=False, expired=0):
+        self.delay = delay
+        self.failures = dict(failures or {})
+        self.expired = expired
+        self.requests = []
+        self.paths = []
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' if keep_alive else 'HTTP/1.0'
+            # 响应头和正文分两次写出，保持连接时需关闭Nagle算法以免延迟确认拖慢响应
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_port}/F'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, request):
+        isbn = parse_qs(urlsplit(request.path).query).get('request', [None])[0]
+        with self._lock:
+            self.requests.append((time.monotonic(), isbn))
+            self.paths.append(urlsplit(request.path).path)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            fail = self.failures.get(isbn, 0) > 0
+            if fail:
+                self.failures[isbn] -= 1
+            expired = isbn is not None and self.expired > 0
+            if expired:
+                self.expired -= 1
+        try:
+            time.sleep(self.delay)
+            if fail:
+                request.send_response(503)
+                request.send_header('Content-Length', '0')
+                request.end_headers()
+                return
+            if isbn is None or expired:
+                page = 'home.html'
+            elif (FIXTURES / f'record_{isbn}.html').exists():
+                page = f'record_{isbn}.html'
+            else:
+                page = 'not_found.html'
+            body = (FIXTURES / page).read_text(encoding='utf-8')
+            body = body.replace('http://opac.nlc.cn:80/F', self.base_url).encode('utf-8')
+            request.send_response(200)
+            request.send_header('Content-Type', 'text/html; charset=utf-8')
+            request.send_header('Content-Length', str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+class TestNlcBatch(unittest.TestCase):
+    found = ['9787512666931', '9787519430238']
+    missing = ['9787020002207', '9787544253994', '9787530210291', '9787208061644']
+
+    def test_fetch_many(self):
+        """并发查询: 查到的书与录制数据一致，查不到的返回None"""
+        with FakeNlcServer() as server:
+            client = NlcBatchClient(server.base_url, workers=3, rate_limiter=RateLimiter(0))
+            results = {isbn: (data, error) for isbn, data, error in client.fetch_many(self.found + self.missing)}
+        self.assertEqual(set(results), set(self.found + self.missing))
+        self.assertEqual(results['9787512666931'][0]['title'], '边城 [专著] / 沈从文著')
+        self.assertEqual(results['9787519430238'][0]['pages'], '208页 ; 23cm')
+        for isbn in self.missing:
+            self.assertEqual(results[isbn], (None, None))
+
+    def test_bounded_concurrency(self):
+        """同时在途的请求数不超过并发数"""
+        isbns = self.missing * 3
+        with FakeNlcServer(delay=0.05) as server:
+            client = NlcBatchClient(server.base_url, workers=2, rate_limiter=RateLimiter(0))
+            list(client.fetch_many(isbns))
+        self.assertLessEqual(server.max_active, 2)
+
+    def test_rate_limit(self):
+        """同一主机的请求间隔不小于1/rate"""
+        with FakeNlcServer() as server:
+            client = NlcBatchClient(server.base_url, workers=4, rate_limiter=RateLimiter(20))
+            list(client.fetch_many(self.missing))
+        times = sorted(t for t, _ in server.requests)
+        self.assertGreaterEqual(times[-1] - times[0], (len(times) - 1) / 20 * 0.9)
+
+    def test_retry(self):
+        """临时故障重试后成功，超过重试次数时报告错误"""
+        failures = {'9787512666931': 2, '9787519430238': 5}
+        with FakeNlcServer(failures=failures) as server:
+            client = NlcBatchClient(server.base_url, workers=2, rate_limiter=RateLimiter(0),
+                                    retries=2, backoff=0.01)
+            results = {isbn: (data, error) for isbn, data, error in client.fetch_many(self.found)}
+        self.assertIsNotNone(results['9787512666931'][0])
+        self.assertIsNone(results['9787519430238'][0])
+        self.assertIn('503', results['9787519430238'][1])
+
+    def test_deadline_and_breaker(self):
+        """重试和退避不超过每本书的总时限，连续失败后熔断，不再访问上游"""
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+        with FakeNlcServer(delay=1.0) as server:
+            client = NlcBatchClient(server.base_url, rate_limiter=RateLimiter(0), backoff=0.01,
+                                    deadline=0.3, breaker=breaker)
+            start = time.monotonic()
+            with self.assertRaisesRegex(NlcUnavailable, '超出查询时限'):
+                client.fetch('9787512666931')
+            self.assertLess(time.monotonic() - start, 0.8)
+            requests = len(server.requests)
+            with self.assertRaisesRegex(NlcUnavailable, '熔断中'):
+                client.fetch('9787519430238')
+            self.assertEqual(len(server.requests), requests)
+
+    def test_session(self):
+        """在会话URL上检索，会话失效时重新取得会话后重试"""
+        with FakeNlcServer(expired=1) as server:
+            client = NlcBatchClient(server.base_url, workers=1, rate_limiter=RateLimiter(0), retries=0)
+            results = {isbn: data for isbn, data, _ in client.fetch_many(self.found)}
+        self.assertTrue(all(results.values()))
+        searches = [path for (_, isbn), path in zip(server.requests, server.paths) if isbn]
+        self.assertEqual(len(searches), 3)
+        self.assertTrue(all(path.startswith('/F/') for path in searches))
+        self.assertEqual(server.paths.count('/F'), 2)
+
+    def test_keep_alive(self):
+        """各查询复用NlcClient的会话URL和keep-alive连接"""
+        with FakeNlcServer(keep_alive=True) as server:
+            client = NlcBatchClient(server.base_url, workers=1, rate_limiter=RateLimiter(0))
+            list(client.fetch_many(self.found + self.missing))
+            client.close()
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.requests), 1 + len(self.found + self.missing))
+
+
+class TestNlcClient(unittest.TestCase):
+    def test_keep_alive(self):
+        """会话URL和连接复用: 首次查询两次请求，之后每次查询一次请求，全程一个连接"""
+        with FakeNlcServer(keep_alive=True) as server:
+            client = NlcClient(server.base_url)
+            self.assertEqual(client.lookup('9787512666931')['title'], '边城 [专著] / 沈从文著')
+            for isbn in TestNlcBatch.found + TestNlcBatch.missing:
+                client.lookup(isbn)
+                self.assertEqual(client.last_timing()['requests'], 1)
+            client.close()
+        self.assertEqual(len(server.requests), 2 + len(TestNlcBatch.found + TestNlcBatch.missing))
+        self.assertEqual(server.connections, 1)
+        stats = client.stats()
+        self.assertEqual((stats['connections'], stats['session_refreshes']), (1, 1))
+        self.assertGreater(stats['parse_seconds'], 0)
+
+    def test_session_refresh(self):
+        """请求出错时重新取得会话并重试一次，会话空闲超时后重新取得"""
+        with FakeNlcServer(failures={'9787512666931': 1, '9787519430238': 2}) as server:
+            client = NlcClient(server.base_url)
+            self.assertIsNotNone(client.lookup('9787512666931'))
+            self.assertEqual(client.last_timing()['session_refreshes'], 2)
+            with self.assertRaises(NlcUnavailable):
+                client.lookup('9787519430238')
+            client.session_ttl = 0
+            time.sleep(0.01)
+            client.lookup('9787020002207')
+            self.assertEqual(client.last_timing()['requests'], 2)
+
+    def test_deadline(self):
+        """上游响应慢于总时限时按时限失败，不等待单次请求超时"""
+        with FakeNlcServer(delay=1.0) as server:
+            client = NlcClient(server.base_url, deadline=0.2, breaker=CircuitBreaker('test'))
+            start = time.monotonic()
+            with self.assertRaises(NlcUnavailable):
+                client.lookup('9787512666931')
+            self.assertLess(time.monotonic() - start, 0.6)
+            self.assertEqual(client.stats()['timeouts'], 1)
+
+    def test_circuit_breaker(self):
+        """连续失败后熔断并快速失败，到期后试探成功则恢复"""
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.2)
+        with FakeNlcServer(failures={None: 2}) as server:
+            client = NlcClient(server.base_url, breaker=breaker)
+            for _ in range(2):
+                with self.assertRaises(NlcUnavailable):
+                    client.lookup('9787512666931')
+            requests = len(server.requests)
+            with self.assertRaisesRegex(NlcUnavailable, '熔断中'):
+                client.lookup('9787512666931')
+            self.assertEqual(len(server.requests), requests)
+            time.sleep(0.25)
+            self.assertIsNotNone(client.lookup('9787512666931'))
+        metrics = breaker.metrics()
+        self.assertEqual(metrics['state'], 'closed')
+        self.assertEqual(metrics['rejected'], 1)
+        self.assertEqual(metrics['transitions'],
+                         {'closed->open': 1, 'open->half_open': 1, 'half_open->closed': 1})
+
+
+class TestNlcParser(unittest.TestCase):
+    def test_equivalence(self):
+        """scan引擎在录制页面及其变体上的结果与BeautifulSoup解析相同"""
+        for path in sorted(FIXTURES.glob('*.html')):
+            page = path.read_text(encoding='utf-8')
+            variants = [
+                page,
+                page.replace('<td class="td1">', '<TD class=\'td1 wide\'>'),
+                page.replace('</td>\n</tr>', '<!-- x --></td><td class="td2">-</td>\n</tr>'),
+                page.replace('&nbsp;', '&#160;&amp;').replace('<tr>', '<tr class="row">'),
+            ]
+            for variant in variants:
+                with self.subTest(page=path.name):
+                    self.assertEqual(parse_page(variant, '9787512666931', lambda message: None, 'scan'),
+                                     parse_page(variant, '9787512666931', lambda message: None, 'bs4'))
+
+    def test_nested_table(self):
+        """scan不处理的嵌套表格回退到BeautifulSoup"""
+        page = (FIXTURES / 'record_9787512666931.html').read_text(encoding='utf-8')
+        page = page.replace('中文图书阅览区', '<table><tr><td class="td1">中文图书阅览区</td></tr></table>')
+        messages = []
+        self.assertEqual(parse_page(page, '9787512666931', messages.append, 'scan'),
+                         parse_page(page, '9787512666931', lambda message: None, 'bs4'))
+        self.assertIn('改用BeautifulSoup解析', messages[0])
+
+    def test_speedup(self):
+        """详细记录页面上scan至少比BeautifulSoup快10倍"""
+        for name, same, bs4_us, scan_us in benchmark(sorted(FIXTURES.glob('record_*.html')), 20):
+            self.assertTrue(same, name)
+            self.assertGreater(bs4_us / scan_us, 10, name)
+
+
+class TestNlcCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = f'{self.tmpdir.name}/nlc_cache.db'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_ttl(self):
+        """查到的书和查无此书分别按各自的有效期缓存，计数由共享同一文件的实例合计"""
+        cache = NlcCache(self.path, ttl=60, negative_ttl=0.2)
+        cache.put('9787512666931', {'title': '边城'})
+        cache.put('9787020002207', None)
+        other = NlcCache(self.path)
+        self.assertEqual(other.get('9787512666931'), (True, {'title': '边城'}))
+        self.assertEqual(other.get('9787020002207'), (True, None))
+        self.assertEqual(other.get('9787519430238'), (False, None))
+        time.sleep(0.3)
+        self.assertEqual(cache.get('9787020002207'), (False, None))
+        self.assertEqual(cache.purge(), 1)
+        cache.flush()
+        stats = other.stats()
+        self.assertEqual((stats['hits'], stats['negative_hits'], stats['misses']), (1, 1, 2))
+        self.assertEqual(stats['entries'], 1)
+
+    def test_batch_client(self):
+        """批量查询命中缓存时不再访问国家图书馆"""
+        cache = NlcCache(self.path)
+        isbns = TestNlcBatch.found + TestNlcBatch.missing
+        with FakeNlcServer() as server:
+            client = NlcBatchClient(server.base_url, workers=2, rate_limiter=RateLimiter(0), cache=cache)
+            first = {isbn: data for isbn, data, _ in client.fetch_many(isbns)}
+            requests = len(server.requests)
+            second = {isbn: data for isbn, data, _ in client.fetch_many(isbns)}
+        self.assertEqual(first, second)
+        self.assertEqual(len(server.requests), requests)
+
+
+class TestNlcIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = f'{self.tmpdir.name}/nlc_index.db'
+        self.seed = json.loads((Path(__file__).parent / 'data.json').read_text(encoding='utf-8'))
+
+    def test_offline(self):
+        """离线模式下从种子文件导入的索引查询(含ISBN-10)，未命中时不访问网络"""
+        set_env(self, NLC_INDEX_PATH=self.path, NLC_CACHE_PATH='off', NLC_OFFLINE='1',
+                NLC_BASE_URL='http://127.0.0.1:9/F')
+        record = self.seed[0]
+        self.assertEqual(get_book_info('978-7-5126-6693-1'), record)
+        isbn10 = isbn13_to_isbn10(record['isbn'])
+        self.assertEqual(get_book_info(isbn10), dict(record, isbn=isbn10))
+        self.assertEqual(get_book_info('9787020002207'), {"error": "Book not found"})
+        self.assertEqual(NlcIndex(self.path).seed([Path(__file__).parent / 'data.json']), {})
+
+    def test_merge_and_append(self):
+        """导入外部数据(NDJSON)默认覆盖、--keep时保留；在线查到的书追加到索引"""
+        index = NlcIndex(self.path)
+        self.assertEqual(index.merge(self.seed[:1], 'data.json'), {'added': 1, 'skipped': 0, 'invalid': 0})
+        dump = f'{self.tmpdir.name}/dump.ndjson'
+        with open(dump, 'w', encoding='utf-8') as fp:
+            for record in [dict(self.seed[0], title='边城'), {'isbn': '123', 'title': 'x'}]:
+                fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.assertEqual(index.merge_file(dump, replace=False), {'added': 0, 'skipped': 1, 'invalid': 1})
+        self.assertEqual(index.merge_file(dump)['added'], 1)
+        self.assertEqual(index.get(self.seed[0]['isbn'])['title'], '边城')
+
+        isbn = self.seed[1]['isbn']
+        with FakeNlcServer() as server:
+            set_env(self, NLC_INDEX_PATH=self.path, NLC_INDEX_SEED='off', NLC_CACHE_PATH='off',
+                    NLC_BASE_URL=server.base_url)
+            self.assertEqual(get_book_info(isbn)['title'], self.seed[1]['title'])
+            requests = len(server.requests)
+            self.assertEqual(get_book_info(isbn), index.get(isbn))
+        self.assertEqual(len(server.requests), requests)
+        self.assertEqual(index.stats()['sources'], {'dump.ndjson': 1, 'nlc': 1})
+
+
+class TestEnrichment(unittest.TestCase):
+    def setUp(self):
+        from db import dispose_engine
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.old_url = os.environ.get('DATABASE_URL')
+        os.environ['DATABASE_URL'] = f'sqlite:///{self.tmpdir.name}/test.db'
+        dispose_engine()
+
+    def tearDown(self):
+        from db import dispose_engine
+        dispose_engine()
+        if self.old_url is None:
+            os.environ.pop('DATABASE_URL', None)
+        else:
+            os.environ['DATABASE_URL'] = self.old_url
+        self.tmpdir.cleanup()
+
+    def test_enrich_isbns(self):
+        """批量补全: 查到的书分批入库，已存在的书跳过"""
+        from db.book_tools import get_book_by_isbn, get_books_count
+        from db.enrichment import enrich_isbns
+        isbns = TestNlcBatch.found + TestNlcBatch.missing + ['123']
+        with FakeNlcServer() as server:
+            client = NlcBatchClient(server.base_url, workers=3, rate_limiter=RateLimiter(0))
+            report = enrich_isbns(isbns, client=client, batch_size=1)
+            self.assertEqual(report['written'], 2)
+            self.assertEqual(report['not_found'], 4)
+            self.assertEqual(report['failed'], 1)
+            self.assertEqual(get_book_by_isbn('9787519430238')['title'], '牛虻 [专著] = The gadfly')
+            self.assertEqual(get_books_count(), 2)
+
+            report = enrich_isbns(TestNlcBatch.found, client=client)
+            self.assertEqual(report['skipped'], 2)
+            self.assertEqual(report['written'], 0)
+
+    def test_concurrent_create(self):
+        """同一ISBN的并发创建只查询一次国家图书馆、入库一次，等待者共享结果"""
+        from concurrent.futures import ThreadPoolExecutor
+        from db.book_tools import create_book_isbn, get_books_count
+        isbn = '9787519430238'
+        with FakeNlcServer(delay=0.2) as server:
+            set_env(self, NLC_BASE_URL=server.base_url, NLC_CACHE_PATH='off', NLC_INDEX_PATH='off',
+                    ENRICH_ASYNC='0')
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(create_book_isbn, [isbn] * 8))
+        self.assertTrue(all(result['success'] for result in results), results)
+        self.assertEqual([i for _, i in server.requests].count(isbn), 1)
+        self.assertEqual(get_books_count(), 1)
+
+    def test_concurrent_create_in_requests(self):
+        """请求中并发创建同一ISBN: 入库在返回结果、释放锁之前提交，等待的请求都能取得书籍"""
+        from concurrent.futures import ThreadPoolExecutor
+        from flask import Flask, jsonify
+        from db import init_app
+        from db.book_tools import create_book_isbn, get_books_count
+        app = Flask(__name__)
+        init_app(app)
+
+        @app.route('/books/<isbn>', methods=['POST'])
+        def create(isbn):
+            return jsonify(create_book_isbn(isbn))
+
+        isbn = '9787519430238'
+        with FakeNlcServer(delay=0.2) as server:
+            set_env(self, NLC_BASE_URL=server.base_url, NLC_CACHE_PATH='off', NLC_INDEX_PATH='off',
+                    ENRICH_ASYNC='0')
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda _: app.test_client().post(f'/books/{isbn}').get_json(),
+                                            range(8)))
+        self.assertTrue(all(result['success'] for result in results), results)
+        self.assertTrue(all(result['book']['isbn'] == isbn for result in results))
+        self.assertEqual([i for _, i in server.requests].count(isbn), 1)
+        self.assertEqual(get_books_count(), 1)
+
+    def test_idle_poll_is_read_only(self):
+        """队列中没有到期任务时领取任务不获取写锁，其他连接持有写锁时也立即返回"""
+        from db import enrich_queue
+        from db.db import get_engine
+        enrich_queue.enqueue_isbns(TestNlcBatch.missing[:1])
+        self.assertIsNotNone(enrich_queue.claim_job())
+        raw = get_engine().raw_connection()
+        try:
+            raw.driver_connection.execute('BEGIN IMMEDIATE')
+            start = time.monotonic()
+            self.assertIsNone(enrich_queue.claim_job())
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            raw.driver_connection.rollback()
+            raw.close()
+
+    def test_enrich_queue(self):
+        """异步补全: 占位记录立即入库，任务去重，临时故障退避重试，完成后更新书籍，查无此书时清理占位记录"""
+        from db import DBSession, enrich_queue
+        from db.book_tools import (add_book_to_user, create_book_isbn, enqueue_enrichment, get_book_by_isbn,
+                                   get_books_count, search_books)
+        from models import User
+        found, missing, shelved = TestNlcBatch.found, TestNlcBatch.missing[0], TestNlcBatch.missing[1]
+        with DBSession() as session:
+            session.add(User(username='queue_test', password='0' * 64))
+        with DBSession() as session:
+            user_id = session.query(User.user_id).filter_by(username='queue_test').scalar()
+
+        with FakeNlcServer(failures={found[1]: 2}) as server:
+            set_env(self, NLC_BASE_URL=server.base_url, NLC_CACHE_PATH='off', NLC_INDEX_PATH='off',
+                    ENRICH_BACKOFF='0', ENRICH_ASYNC='1')
+            result = add_book_to_user(found[0], user_id)
+            self.assertEqual(result['enrichment'], 'pending')
+            self.assertEqual(get_book_by_isbn(found[0])['title'], found[0])
+            self.assertEqual(create_book_isbn(missing)['enrichment'], 'pending')
+            add_book_to_user(shelved, user_id)
+            self.assertEqual(enqueue_enrichment([found[1], missing, found[1]]), [found[1]])
+            self.assertEqual(enqueue_enrichment([found[0], found[1]]), [])
+            self.assertEqual(server.requests, [])
+
+            report = enrich_queue.run_pending()
+            # 搜索查无此书的ISBN不重新执行已结束的任务
+            with self.assertRaises(Exception):
+                search_books('isbn', missing)
+            self.assertEqual(enrich_queue.run_pending(), {})
+        self.assertEqual(report, {'done': 2, 'not_found': 2, 'pending': 1})
+        self.assertEqual(get_book_by_isbn(found[0])['title'], '边城 [专著]')
+        self.assertEqual(get_book_by_isbn(found[1])['title'], '牛虻 [专著] = The gadfly')
+        # 查无此书: 未加入书架的占位记录被删除，书架上的保留
+        self.assertIsNone(get_book_by_isbn(missing))
+        self.assertEqual(get_book_by_isbn(shelved)['title'], shelved)
+        self.assertEqual(get_books_count(), 3)
+        job = enrich_queue.get_job(found[1])
+        self.assertEqual((job['status'], job['attempts']), ('done', 2))
+        self.assertEqual(enrich_queue.get_job(missing)['status'], 'not_found')
+        self.assertEqual(enrich_queue.get_queue_stats()['not_found'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# json_provider.py
+"""Flask JSON编码
+
+安装了orjson时使用orjson编解码，未安装时回退到Flask默认实现。
+与默认实现的区别: 不按键排序，中文直接输出为UTF-8而不转义为\\uXXXX(响应体更小)。
+"""
+
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时使用标准库json
+    orjson = None
+
+if orjson is not None:
+    # 日期等类型交给Flask默认的default处理，保持原有格式
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def dumps_bytes(obj):
+    """编码为UTF-8字节串(供流式输出等场景使用)"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=_OPTIONS)
+    return json.dumps(obj, default=DefaultJSONProvider.default, ensure_ascii=False).encode('utf-8')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """使用orjson的JSON提供者"""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=_OPTIONS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=_OPTIONS)
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
+
+
+def init_json(app):
+    """orjson可用时为应用启用FastJSONProvider
+    Returns:
+        bool: 是否已启用
+    """
+    if orjson is None:
+        return False
+    app.json = FastJSONProvider(app)
+    return True